@@ -0,0 +1,136 @@
+"""
+Synthetic images and size sets for the benchmarks, made the same way every run.
+"""
+import io
+import struct
+
+from PIL import Image, ImageChops
+
+
+# Size sets like the ones sites use, as the Size fields of each of their sizes
+SIZE_SETS = {
+	"article": [
+		dict(slug="lead", width=800, height=600, retina=True),
+		dict(slug="inline", width=400, height=300),
+		dict(slug="teaser", width=200, height=150),
+		dict(slug="wide", width=1200, height=600),
+		dict(slug="square", width=100, height=100, auto_size=1),
+	],
+	"gallery": [
+		dict(slug="full", width=1200, height=900),
+		dict(slug="large", width=960, height=720),
+		dict(slug="medium", width=640, height=480),
+		dict(slug="small", width=320, height=240),
+		dict(slug="strip", width=240, height=180),
+		dict(slug="thumb", width=160, height=120),
+		dict(slug="tiny", width=120, height=90),
+		dict(slug="icon", width=80, height=60),
+	],
+	"thumbnails": [
+		dict(slug="square-%s" % side, width=side, height=side, auto_size=1)
+		for side in (300, 240, 200, 180, 150, 120, 100, 90, 75, 60, 50, 40, 32, 24, 16)
+	],
+	"responsive": [
+		dict(slug="hero", width=960, height=None, auto_size=2, srcset="480w,720w,1440w,1920w"),
+		dict(slug="card", width=360, height=240, srcset="1.5x,2x,3x"),
+	],
+}
+
+
+# EXIF payloads: (ImageDescription, UserComment, bytes of maker note)
+EXIF_PAYLOADS = {
+	"none": None,
+	"camera": ("Harbor at dusk", "Photo by A. Photographer", 2000),
+	"large": ("Harbor at dusk, seen from the breakwater" * 5, "Photo by A. Photographer / Agency" * 5, 60000),
+}
+
+# (name, width, height, format, mode, EXIF payload)
+FIXTURES = [
+	("small-jpeg", 800, 600, "JPEG", "RGB", "none"),
+	("photo-jpeg", 3000, 2000, "JPEG", "RGB", "camera"),
+	("portrait-jpeg", 2000, 3000, "JPEG", "RGB", "large"),
+	("large-jpeg", 6000, 4000, "JPEG", "RGB", "camera"),
+	("graphic-png", 1600, 1200, "PNG", "RGB", "none"),
+	("alpha-png", 1200, 1200, "PNG", "RGBA", "none"),
+	("gray-jpeg", 2400, 1800, "JPEG", "L", "camera"),
+]
+
+
+def make_photo(width, height, mode="RGB"):
+	""" A photo-like image: smooth gradients with noisy detail, so resampling and compressing have something to do """
+	noise = Image.effect_noise((max(width // 8, 1), max(height // 8, 1)), 64).resize((width, height), Image.BICUBIC)
+	gradient = Image.linear_gradient("L").resize((width, height))
+	img = Image.merge("RGB", (noise, gradient, ImageChops.invert(noise)))
+	if mode == "RGBA":
+		img.putalpha(gradient.rotate(90))
+		return img
+	return img.convert(mode)
+
+def ifd(entries, offset, next_ifd=0):
+	"""
+	A little endian TIFF IFD for (tag, type, count, value bytes) entries, starting
+	offset bytes into the TIFF data, followed by the values that don't fit in an entry
+	"""
+	entries = sorted(entries)
+	data_offset = offset + 2 + len(entries) * 12 + 4
+
+	table, data = [struct.pack("<H", len(entries))], []
+	for tag, field_type, count, value in entries:
+		if len(value) <= 4:
+			table.append(struct.pack("<HHI", tag, field_type, count) + value.ljust(4, b"\0"))
+		else:
+			table.append(struct.pack("<HHII", tag, field_type, count, data_offset))
+			# values start on word boundaries
+			value += b"\0" * (len(value) % 2)
+			data.append(value)
+			data_offset += len(value)
+	table.append(struct.pack("<I", next_ifd))
+
+	return b"".join(table + data)
+
+def make_exif(payload):
+	""" APP1 EXIF data with a caption, attribution, camera and a maker note of the size given, or None """
+	if EXIF_PAYLOADS[payload] is None:
+		return None
+	description, comment, maker_note_bytes = EXIF_PAYLOADS[payload]
+
+	def ascii(tag, text):
+		text = text.encode("ascii") + b"\0"
+		return (tag, 2, len(text), text)
+
+	def undefined(tag, value):
+		return (tag, 7, len(value), value)
+
+	exif_entries = [
+		ascii(0x9003, "2015:06:01 19:45:00"),
+		undefined(0x9286, b"ASCII\0\0\0" + comment.encode("ascii")),
+		undefined(0x927C, bytes(bytearray(index % 251 for index in range(maker_note_bytes)))),
+	]
+	image_entries = [
+		ascii(0x010E, description),
+		ascii(0x010F, "Benchmark"),
+		ascii(0x0110, "Synthetic 1"),
+		(0x0112, 3, 1, struct.pack("<H", 1)),
+		ascii(0x013B, "A. Photographer"),
+		ascii(0x8298, "Copyright Benchmark"),
+	]
+
+	# The Exif IFD pointer is a fixed size, so IFD0's length is known before the Exif IFD's offset is
+	image_length = len(ifd(image_entries + [(0x8769, 4, 1, b"\0" * 4)], 8))
+	exif_ifd = ifd(exif_entries, 8 + image_length)
+	image_ifd = ifd(image_entries + [(0x8769, 4, 1, struct.pack("<I", 8 + image_length))], 8)
+
+	return b"Exif\0\0" + b"II*\0" + struct.pack("<I", 8) + image_ifd + exif_ifd
+
+def make_fixture(width, height, format, mode, payload):
+	""" The bytes of an image file """
+	params = {}
+	if format == "JPEG":
+		params["quality"] = 90
+	exif = make_exif(payload)
+	if exif:
+		params["exif"] = exif
+
+	f = io.BytesIO()
+	make_photo(width, height, mode).save(f, format, **params)
+	return f.getvalue()
@@ -0,0 +1,274 @@
+"""
+Benchmarks each stage of making thumbnails, for synthetic images of different
+sizes, formats and EXIF payloads, and the size sets in fixtures.SIZE_SETS.
+
+	$ python benchmarks/pipeline.py --repeat 3
+	$ python benchmarks/pipeline.py --fixtures photo-jpeg,alpha-png --stages crop_save --json before.json
+
+Runs against benchmarks/settings.py, with SQLite and the files it writes in a
+scratch folder. Each run of a stage is in its own forked process, so its peak
+RSS is its own. Reports the best wall and CPU time of the runs, the most the
+resident memory grew by, and the bytes of files written.
+
+Stages:
+	rescale               utils.rescale from the decoded original to every size
+	create_cropped_image  utils.create_cropped_image for a crop of each aspect ratio
+	create_thumbnail      Image.create_thumbnail for every size
+	crop_save             Crop.save for a crop of each aspect ratio, which renders its sizes
+	exif                  reading the EXIF tags and metadata of the original, as the upload view does
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import multiprocessing
+from collections import OrderedDict
+from optparse import OptionParser
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+import django
+django.setup()
+
+from django.conf import settings
+from django.core.files import File
+from django.core.management import call_command
+from django.db import connections
+from PIL import Image
+
+from cropduster import utils
+from cropduster.models import Image as CropDusterImage, Crop, Size, SizeSet, AUTO_CROP, MANUALLY_CROP, required_dimensions
+from cropduster.registry import registry
+from cropduster.views import EXIF_TAGS
+
+import fixtures
+
+
+def crop_areas(width, height, sizes):
+	""" The largest centered crop of each aspect ratio among the manually cropped sizes, with the sizes it is for """
+	areas = OrderedDict()
+	for size in sizes:
+		if size.auto_size == MANUALLY_CROP and size.width and size.height:
+			areas.setdefault(size.aspect_ratio, []).append(size)
+
+	crops = []
+	for ratio, ratio_sizes in areas.items():
+		ratio = float(ratio_sizes[0].width) / ratio_sizes[0].height
+		crop_w, crop_h = min(width, int(height * ratio)), min(height, int(width / ratio))
+		crops.append(((width - crop_w) // 2, (height - crop_h) // 2, crop_w, crop_h, ratio_sizes))
+	return crops
+
+
+def setup_rescale(context):
+	img = Image.open(context["path"])
+	img.load()
+	targets = []
+	for size in context["sizes"]:
+		for version in size.versions_within(img.size):
+			targets.append((version.width or 0, version.height or 0, size.auto_size == AUTO_CROP))
+	return img, targets
+
+def run_rescale(args):
+	img, targets = args
+	for width, height, auto_crop in targets:
+		utils.rescale(img, width, height, auto_crop=auto_crop)
+
+def setup_create_cropped_image(context):
+	return context["path"], context["crops"]
+
+def run_create_cropped_image(args):
+	path, crops = args
+	for x, y, width, height, sizes in crops:
+		min_width, min_height = required_dimensions(sizes)
+		utils.create_cropped_image(path, x, y, width, height, min_width=min_width, min_height=min_height)
+
+def setup_create_thumbnail(context):
+	return CropDusterImage.objects.get(id=context["image_id"]), context["sizes"]
+
+def run_create_thumbnail(args):
+	image, sizes = args
+	for size in sizes:
+		image.create_thumbnail(size, force_crop=True)
+
+def setup_crop_save(context):
+	image = CropDusterImage.objects.get(id=context["image_id"])
+	Crop.objects.filter(image=image).delete()
+	return [
+		Crop(image=image, size=sizes[0], crop_x=x, crop_y=y, crop_w=width, crop_h=height)
+		for x, y, width, height, sizes in context["crops"]
+	]
+
+def run_crop_save(crops):
+	for crop in crops:
+		crop.save()
+
+def setup_exif(context):
+	return context["path"]
+
+def run_exif(path):
+	with open(path, "rb") as f:
+		utils.image_metadata(f, utils.read_exif(f, utils.METADATA_TAGS + EXIF_TAGS))
+
+STAGES = OrderedDict([
+	("rescale", (setup_rescale, run_rescale)),
+	("create_cropped_image", (setup_create_cropped_image, run_create_cropped_image)),
+	("create_thumbnail", (setup_create_thumbnail, run_create_thumbnail)),
+	("crop_save", (setup_crop_save, run_crop_save)),
+	("exif", (setup_exif, run_exif)),
+])
+
+
+def files_written():
+	""" The size and modification time of every file under MEDIA_ROOT """
+	files = {}
+	for folder, dirs, names in os.walk(settings.MEDIA_ROOT):
+		for name in names:
+			path = os.path.join(folder, name)
+			stat = os.stat(path)
+			files[path] = (stat.st_size, stat.st_mtime)
+	return files
+
+def max_rss():
+	""" Peak resident memory of this process in bytes """
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss if sys.platform == "darwin" else rss * 1024
+
+def measure(stage, context, results):
+	""" Runs a stage once, in a forked process, and puts what it measured on the results queue """
+	setup, run = STAGES[stage]
+	args = setup(context)
+
+	before = files_written()
+	start_rss = max_rss()
+	start_times = os.times()
+	start = time.time()
+
+	run(args)
+
+	wall = time.time() - start
+	end_times = os.times()
+	after = files_written()
+
+	results.put({
+		"wall": wall,
+		"cpu": (end_times[0] - start_times[0]) + (end_times[1] - start_times[1]),
+		"rss_growth": max_rss() - start_rss,
+		"bytes_written": sum(stat[0] for path, stat in after.items() if before.get(path) != stat),
+	})
+
+def benchmark(stage, context, repeat):
+	""" Best wall and CPU time, largest memory growth and bytes written of repeated runs of a stage """
+	runs = []
+	for i in range(repeat):
+		# the forked process makes its own database connection
+		for connection in connections.all():
+			connection.close()
+
+		results = multiprocessing.Queue()
+		process = multiprocessing.Process(target=measure, args=(stage, context, results))
+		process.start()
+		runs.append(results.get())
+		process.join()
+
+	return {
+		"wall": min(run["wall"] for run in runs),
+		"cpu": min(run["cpu"] for run in runs),
+		"rss_growth": max(run["rss_growth"] for run in runs),
+		"bytes_written": runs[-1]["bytes_written"],
+	}
+
+
+def reset():
+	""" Starts from an empty database and media folder """
+	connections["default"].close()
+	if os.path.exists(settings.DATABASES["default"]["NAME"]):
+		os.remove(settings.DATABASES["default"]["NAME"])
+	shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+	os.makedirs(settings.MEDIA_ROOT)
+	call_command("migrate", verbosity=0, interactive=False)
+
+def make_size_set(name):
+	size_set = SizeSet.objects.create(name=name, slug=name)
+	for fields in fixtures.SIZE_SETS[name]:
+		Size.objects.create(size_set=size_set, name=fields["slug"], **fields)
+	return size_set
+
+def make_context(fixture, size_set):
+	""" Writes a fixture and uploads it as an image with the size set """
+	name, width, height, format, mode, payload = fixture
+	path = os.path.join(os.path.dirname(settings.MEDIA_ROOT.rstrip("/")), "fixtures", "%s.%s" % (name, format.lower()))
+	if not os.path.exists(path):
+		if not os.path.exists(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, "wb") as f:
+			f.write(fixtures.make_fixture(width, height, format, mode, payload))
+
+	image = CropDusterImage(size_set=size_set)
+	with open(path, "rb") as f:
+		image.image.save(os.path.basename(path), File(f))
+
+	sizes = registry.sizes(size_set.id)
+	return {
+		"path": image.image.path,
+		"image_id": image.id,
+		"sizes": sizes,
+		"crops": crop_areas(width, height, sizes),
+	}
+
+
+def main():
+	parser = OptionParser(usage="%prog [options]")
+	parser.add_option("--fixtures", help="Comma separated fixtures to run, out of %s" % ", ".join(fixture[0] for fixture in fixtures.FIXTURES))
+	parser.add_option("--size_sets", help="Comma separated size sets to run, out of %s" % ", ".join(sorted(fixtures.SIZE_SETS)))
+	parser.add_option("--stages", help="Comma separated stages to run, out of %s" % ", ".join(STAGES))
+	parser.add_option("--repeat", type="int", default=3, help="Runs of each stage, the best is reported")
+	parser.add_option("--json", help="Also write the results to this file, to compare runs")
+	options, args = parser.parse_args()
+
+	def chosen(option, choices):
+		if not option:
+			return list(choices)
+		names = option.split(",")
+		for name in names:
+			if name not in choices:
+				parser.error("No %s, choose from %s" % (name, ", ".join(choices)))
+		return names
+
+	fixture_names = chosen(options.fixtures, [fixture[0] for fixture in fixtures.FIXTURES])
+	size_set_names = chosen(options.size_sets, sorted(fixtures.SIZE_SETS))
+	stages = chosen(options.stages, list(STAGES))
+
+	reset()
+	size_sets = dict((name, make_size_set(name)) for name in size_set_names)
+
+	print "%-15s %-12s %-22s %10s %10s %10s %12s" % ("fixture", "size set", "stage", "wall ms", "cpu ms", "rss MB", "written KB")
+	results = []
+	for fixture in fixtures.FIXTURES:
+		if fixture[0] not in fixture_names:
+			continue
+		for size_set_name in size_set_names:
+			context = make_context(fixture, size_sets[size_set_name])
+			for stage in stages:
+				result = benchmark(stage, context, options.repeat)
+				result.update(fixture=fixture[0], size_set=size_set_name, stage=stage)
+				results.append(result)
+				print "%-15s %-12s %-22s %10.1f %10.1f %10.1f %12.1f" % (
+					fixture[0], size_set_name, stage, result["wall"] * 1000, result["cpu"] * 1000,
+					result["rss_growth"] / 1048576.0, result["bytes_written"] / 1024.0,
+				)
+
+	if options.json:
+		with open(options.json, "w") as f:
+			json.dump({"results": results}, f, indent=1)
+
+	if "CROPDUSTER_BENCHMARK_DIR" not in os.environ:
+		shutil.rmtree(settings.BENCHMARK_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	main()
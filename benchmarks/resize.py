@@ -0,0 +1,96 @@
+"""
+Compares the ways thumbnails can be resized, on the size sets in
+fixtures.SIZE_SETS, by rendering every size in a set from one synthetic crop.
+
+	$ python benchmarks/resize.py --source 2400x1800 --repeat 5
+
+utils.rescale is PIL resizing each size from the whole crop, as cropduster used to,
+and ResizePyramid resizing each from the smallest size already made that is large
+enough. Also reports how far the pyramid's thumbnails are from utils.rescale's, as
+the mean and largest difference of a pixel channel.
+"""
+import os
+import sys
+import time
+from optparse import OptionParser
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+import django
+django.setup()
+
+from PIL import ImageChops, ImageStat
+
+from cropduster import utils
+from cropduster.models import Size, AUTO_CROP
+
+from fixtures import SIZE_SETS, make_photo
+
+
+def size_set_targets(name, source_size):
+	""" The (width, height, auto_crop) of each size in a set, with its retina and responsive versions """
+	targets = []
+	for fields in SIZE_SETS[name]:
+		size = Size(**fields)
+		for version in size.versions_within(source_size):
+			targets.append((version.width or 0, version.height or 0, size.auto_size == AUTO_CROP))
+	return targets
+
+def render_direct(img, targets):
+	return [utils.rescale(img, width, height, auto_crop=auto_crop) for width, height, auto_crop in targets]
+
+def render_pyramid(img, targets):
+	pyramid = utils.ResizePyramid(img)
+	return [pyramid.rescale(width, height, auto_crop=auto_crop) for width, height, auto_crop in targets]
+
+RESIZERS = [
+	("utils.rescale", render_direct),
+	("ResizePyramid", render_pyramid),
+]
+
+
+def compare(thumbs, expected):
+	""" Mean and largest difference of a pixel channel between two lists of thumbnails """
+	means, largest = [], 0
+	for thumb, other in zip(thumbs, expected):
+		stat = ImageStat.Stat(ImageChops.difference(thumb, other))
+		means.append(sum(stat.mean) / len(stat.mean))
+		largest = max([largest] + [high for low, high in stat.extrema])
+	return sum(means) / len(means), largest
+
+def main():
+	parser = OptionParser(usage="%prog [options] [size set ...]")
+	parser.add_option("--source", default="2400x1800", help="WIDTHxHEIGHT of the crop the sizes are rendered from")
+	parser.add_option("--repeat", type="int", default=3, help="Times each set is rendered, the best time is reported")
+	options, names = parser.parse_args()
+
+	for name in names:
+		if name not in SIZE_SETS:
+			parser.error("No size set %s, choose from %s" % (name, ", ".join(sorted(SIZE_SETS))))
+
+	width, height = [int(side) for side in options.source.split("x")]
+	img = make_photo(width, height)
+
+	print "%-12s %-15s %10s %10s %10s" % ("size set", "resizer", "best ms", "mean diff", "max diff")
+	for name in names or sorted(SIZE_SETS):
+		targets = size_set_targets(name, img.size)
+		expected = None
+		for resizer_name, render in RESIZERS:
+			best = None
+			for i in range(options.repeat):
+				start = time.time()
+				thumbs = render(img, targets)
+				elapsed = time.time() - start
+				best = elapsed if best is None else min(best, elapsed)
+
+			if expected is None:
+				expected = thumbs
+			mean, largest = compare(thumbs, expected)
+			print "%-12s %-15s %10.1f %10.2f %10d" % (name, resizer_name, best * 1000, mean, largest)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,35 @@
+"""
+Django settings for running the benchmarks locally, with SQLite and the files
+they write in a scratch folder, CROPDUSTER_BENCHMARK_DIR or one in the temp folder.
+"""
+import os
+import tempfile
+
+BENCHMARK_DIR = os.environ.get("CROPDUSTER_BENCHMARK_DIR") or os.path.join(tempfile.gettempdir(), "cropduster-benchmark")
+
+SECRET_KEY = "benchmark"
+DEBUG = False
+
+DATABASES = {
+	"default": {
+		"ENGINE": "django.db.backends.sqlite3",
+		"NAME": os.path.join(BENCHMARK_DIR, "benchmark.sqlite3"),
+	}
+}
+
+INSTALLED_APPS = (
+	"cropduster",
+)
+MIDDLEWARE_CLASSES = ()
+
+CACHES = {
+	"default": {
+		"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+	}
+}
+
+MEDIA_ROOT = os.path.join(BENCHMARK_DIR, "media") + "/"
+MEDIA_URL = "/media/"
+STATIC_URL = "/static/"
+
+CROPDUSTER_LOCK_DIR = os.path.join(BENCHMARK_DIR, "locks")
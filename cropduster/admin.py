@@ -18,6 +18,14 @@ class SizeInline(admin.TabularInline):
 				"aspect_ratio",
 				"create_on_request",
 				"retina",
+				"formats",
+				"quality",
+				"progressive",
+				"optimize",
+				"subsampling",
+				"compress_level",
+				"strip_metadata",
+				"srcset",
 			)
 		}),
 	)
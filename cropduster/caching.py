@@ -0,0 +1,266 @@
+"""
+Row cache for models that are read far more often than they are written.
+
+Models with a CachingManager have their get() calls by primary key or by a unique
+key (a unique field, or a unique_together set) cached, along with lookups that
+found nothing. Rows are kept in a small per-request LRU in front of the Django
+cache, and saving or deleting a row drops its entries from both.
+
+A saved row may not be committed yet when its entries are dropped, so for a
+while afterwards its keys are marked as written rather than emptied, and rows
+read meanwhile aren't cached. Code that writes based on the rows it reads, such
+as rendering thumbnails, reads them from the database inside uncached(). Worker
+loops empty the per-thread LRU before each job with local_cache.clear().
+"""
+import copy
+import hashlib
+import threading
+from functools import wraps
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import models
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_save, post_delete
+
+
+CROPDUSTER_CACHE_TIMEOUT = getattr(settings, "CROPDUSTER_CACHE_TIMEOUT", 60 * 60)
+CROPDUSTER_LOCAL_CACHE_SIZE = getattr(settings, "CROPDUSTER_LOCAL_CACHE_SIZE", 1000)
+CROPDUSTER_CACHE_WRITE_WINDOW = getattr(settings, "CROPDUSTER_CACHE_WRITE_WINDOW", 60)
+
+# Cached in place of rows that don't exist
+DOES_NOT_EXIST = "DoesNotExist"
+
+# Cached in place of rows saved or deleted in the last CROPDUSTER_CACHE_WRITE_WINDOW seconds
+WRITTEN = "Written"
+
+
+class LocalCache(threading.local):
+	""" Per-thread LRU, emptied at the start of each request so it never serves stale rows for long """
+
+	def __init__(self, size=CROPDUSTER_LOCAL_CACHE_SIZE):
+		self.size = size
+		self.rows = OrderedDict()
+		# how many uncached() blocks this thread is in
+		self.bypass = 0
+
+	def get(self, key):
+		try:
+			value = self.rows.pop(key)
+		except KeyError:
+			return None
+		self.rows[key] = value
+		return value
+
+	def set(self, key, value):
+		self.rows.pop(key, None)
+		self.rows[key] = value
+		while len(self.rows) > self.size:
+			self.rows.popitem(last=False)
+
+	def delete(self, key):
+		self.rows.pop(key, None)
+
+	def clear(self, **kwargs):
+		self.rows.clear()
+
+local_cache = LocalCache()
+request_started.connect(local_cache.clear)
+
+
+class uncached(object):
+	""" 
+	Context manager in which rows are read from the database rather than the caches, 
+	for code that writes based on them, so a stale row or miss is never acted on
+	"""
+
+	def __enter__(self):
+		local_cache.bypass += 1
+		return self
+
+	def __exit__(self, *exc_info):
+		local_cache.bypass -= 1
+
+	def __call__(self, func):
+		""" Used as a decorator, runs the function in the block """
+		@wraps(func)
+		def wrapped(*args, **kwargs):
+			with self:
+				return func(*args, **kwargs)
+		return wrapped
+
+
+def unique_keys(model):
+	""" Gets the sets of field attnames that each identify a single row of the model """
+
+	keys = [(model._meta.pk.attname,)]
+	for field in model._meta.fields:
+		if field.unique and not field.primary_key:
+			keys.append((field.attname,))
+	for fields in model._meta.unique_together:
+		keys.append(tuple(sorted(model._meta.get_field(name).attname for name in fields)))
+	return keys
+
+def make_key(model, lookup):
+	""" Cache key for a row, from attname => value for one of the model's unique keys """
+
+	lookup = u",".join(u"%s=%s" % (attname, lookup[attname]) for attname in sorted(lookup))
+	return "cropduster:row:%s.%s:%s" % (
+		model._meta.app_label,
+		model._meta.model_name,
+		hashlib.md5(lookup.encode("utf-8")).hexdigest(),
+	)
+
+def normalize_lookup(model, kwargs):
+	"""
+	Turns get() kwargs into attname => value if they are exact lookups on one of
+	the model's unique keys, otherwise returns None
+	"""
+
+	# fields can be looked up by name or attname, such as image or image_id
+	fields = {"pk": model._meta.pk}
+	for field in model._meta.fields:
+		fields[field.name] = field
+		fields[field.attname] = field
+
+	lookup = {}
+	for name, value in kwargs.items():
+		if name.endswith("__exact"):
+			name = name[:-len("__exact")]
+
+		field = fields.get(name)
+		if field is None:
+			return None
+
+		if field.rel:
+			# foreign keys can be looked up by object or by id
+			value = getattr(value, "pk", value)
+			target = field.rel.get_related_field()
+		else:
+			target = field
+
+		try:
+			value = target.to_python(value)
+		except Exception:
+			return None
+		lookup[field.attname] = value
+
+	if tuple(sorted(lookup)) not in unique_keys(model):
+		return None
+	return lookup
+
+def cacheable(obj):
+	""" A copy of the row to cache, without any related objects cached on it """
+
+	obj = copy.copy(obj)
+	obj._state = copy.copy(obj._state)
+	for attr in list(obj.__dict__):
+		if attr.startswith("_") and attr.endswith("_cache"):
+			del obj.__dict__[attr]
+	return obj
+
+
+class CachingQuerySet(QuerySet):
+
+	def __init__(self, *args, **kwargs):
+		super(CachingQuerySet, self).__init__(*args, **kwargs)
+		self._cache_lookup = None
+
+	def _clone(self, *args, **kwargs):
+		clone = super(CachingQuerySet, self)._clone(*args, **kwargs)
+		clone._cache_lookup = None
+		return clone
+
+	def _is_plain(self):
+		""" Whether this is still an unfiltered query for whole rows, so that a get() can be cached """
+		return (
+			type(self) is CachingQuerySet and
+			not self.query.where and
+			not self.query.select_related and
+			not self.query.deferred_loading[0] and
+			not self.query.extra and
+			self.query.low_mark == 0 and self.query.high_mark is None
+		)
+
+	def filter(self, *args, **kwargs):
+		clone = super(CachingQuerySet, self).filter(*args, **kwargs)
+		# Related object descriptors call filter(pk=...).get()
+		if not args and self._is_plain():
+			clone._cache_lookup = kwargs
+		return clone
+
+	def get(self, *args, **kwargs):
+		lookup = None
+		if not args:
+			if kwargs and self._is_plain():
+				lookup = normalize_lookup(self.model, kwargs)
+			elif not kwargs and self._cache_lookup:
+				lookup = normalize_lookup(self.model, self._cache_lookup)
+
+		if lookup is None or local_cache.bypass:
+			return super(CachingQuerySet, self).get(*args, **kwargs)
+
+		key = make_key(self.model, lookup)
+
+		obj = local_cache.get(key)
+		if obj is None:
+			obj = cache.get(key)
+			if obj == WRITTEN:
+				# the write may not be committed, so what the database has now isn't cached
+				return super(CachingQuerySet, self).get(*args, **kwargs)
+			if obj is not None:
+				local_cache.set(key, obj)
+
+		if obj is None:
+			try:
+				obj = super(CachingQuerySet, self).get(*args, **kwargs)
+			except self.model.DoesNotExist:
+				obj = DOES_NOT_EXIST
+			else:
+				obj = cacheable(obj)
+			# add rather than set, so a row read before a write doesn't replace its mark
+			cache.add(key, obj, CROPDUSTER_CACHE_TIMEOUT)
+			local_cache.set(key, obj)
+
+		if obj == DOES_NOT_EXIST:
+			raise self.model.DoesNotExist("%s matching query does not exist." % self.model._meta.object_name)
+		return cacheable(obj)
+
+
+def invalidate(sender, instance, **kwargs):
+	""" 
+	Signal handler that drops a saved or deleted row from the caches, marking its keys 
+	as written for long enough that the transaction it was saved in has committed
+	"""
+
+	keys = instance.cache_keys()
+	for key in keys:
+		local_cache.delete(key)
+	cache.set_many(dict((key, WRITTEN) for key in keys), CROPDUSTER_CACHE_WRITE_WINDOW)
+
+
+class CachingMixin(object):
+	""" Model mixin for rows cached by a CachingManager """
+
+	def cache_keys(self):
+		""" Cache keys for every unique key of this row """
+		keys = []
+		for attnames in unique_keys(type(self)):
+			lookup = dict((attname, getattr(self, attname)) for attname in attnames)
+			if None not in lookup.values():
+				keys.append(make_key(type(self), lookup))
+		return keys
+
+
+class CachingManager(models.Manager.from_queryset(CachingQuerySet)):
+	""" Manager that caches get() by primary or unique key, and is used for related objects too """
+
+	use_for_related_fields = True
+
+	def contribute_to_class(self, model, name):
+		super(CachingManager, self).contribute_to_class(model, name)
+		if issubclass(model, CachingMixin):
+			post_save.connect(invalidate, sender=model)
+			post_delete.connect(invalidate, sender=model)
@@ -20,6 +20,10 @@
 #
 # where TAG is a valid tag name, ex 'DateTimeOriginal'
 #
+# To read only some tags, pass their full names, and processing stops
+# as soon as all of them are found, without MakerNotes or thumbnails:
+#    tags = EXIF.process_file(f, tags=['Image Orientation', 'EXIF DateTimeOriginal'])
+#
 # These 2 are useful when you are retrieving a large list of images
 #
 #
@@ -82,6 +86,9 @@
 # ----- See 'changes.txt' file for all contributors and changes ----- #
 #
 
+import mmap
+import struct
+
 
 # Don't throw an exception when given an out of range character.
 def make_string(seq):
@@ -432,6 +439,9 @@ GPS_TAGS = {
 # 0x9286 is user comment
 IGNORE_TAGS=(0x9286, 0x927C)
 
+# tags pointing to other IFDs, which are followed even when only some tags are read
+IFD_POINTERS=('ExifOffset', 'GPSInfo', 'InteroperabilityOffset')
+
 # http://tomtia.plala.jp/DigitalCamera/MakerNote/index.asp
 def nikon_ev_bias(seq):
     # First digit seems to be in steps of 1/6 EV.
@@ -1224,6 +1234,9 @@ class Ratio:
             self.num = self.num / div
             self.den = self.den / div
 
+# struct formats of the integer sizes in IFD entries, unsigned
+INT_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
 # for ease of dealing with tags
 class IFD_Tag:
     def __init__(self, printable, tag, field_type, values, field_offset,
@@ -1251,23 +1264,56 @@ class IFD_Tag:
                                         self.field_offset)
 
 # class that handles an EXIF header
+# data is the TIFF data the offsets are from, read once from the file, as a
+# memoryview so that reading values out of it doesn't copy it, or the file
+# memory mapped
 class EXIF_header:
-    def __init__(self, file, endian, offset, fake_exif, strict, debug=0):
-        self.file = file
+    def __init__(self, data, endian, offset, fake_exif, strict, debug=0):
+        self.data = data
         self.endian = endian
+        self.byte_order = '<' if endian == 'I' else '>'
         self.offset = offset
         self.fake_exif = fake_exif
         self.strict = strict
         self.debug = debug
         self.tags = {}
+        # the full names of the tags to read, or None for all of them
+        self.wanted = None
+
+    # whether a tag, or any tag of an IFD, is to be read
+    def wants(self, name):
+        if self.wanted is None:
+            return True
+        return any(tag == name or tag.startswith(name + ' ') for tag in self.wanted)
+
+    # whether every tag to be read has been
+    def found_all(self):
+        return self.wanted is not None and self.wanted.issubset(self.tags)
+
+    # read length bytes, or as many as there are
+    def read(self, offset, length):
+        start = self.offset + offset
+        if start < 0:
+            return ''
+        data = self.data[start:start + length]
+        if isinstance(data, memoryview):
+            return data.tobytes()
+        return data
 
     # convert slice to integer, based on sign and endian flags
     # usually this offset is assumed to be relative to the beginning of the
     # start of the EXIF information.  For some cameras that use relative tags,
     # this offset may be relative to some other starting point.
     def s2n(self, offset, length, signed=0):
-        self.file.seek(self.offset+offset)
-        slice=self.file.read(length)
+        start = self.offset + offset
+        format = INT_FORMATS.get(length)
+        if format and 0 <= start and start + length <= len(self.data):
+            if signed:
+                format = format.lower()
+            return struct.unpack_from(self.byte_order + format, self.data, start)[0]
+
+        # odd lengths, and values running past the end of the data
+        slice = self.read(offset, length)
         if self.endian == 'I':
             val=s2n_intel(slice)
         else:
@@ -1279,6 +1325,16 @@ class EXIF_header:
                 val=val-(msb << 1)
         return val
 
+    # convert count integers in a row to a list, all at once
+    def s2n_list(self, offset, length, count, signed=0):
+        start = self.offset + offset
+        format = INT_FORMATS.get(length)
+        if format and 0 <= start and start + length * count <= len(self.data):
+            if signed:
+                format = format.lower()
+            return list(struct.unpack_from('%s%d%s' % (self.byte_order, count, format), self.data, start))
+        return [self.s2n(offset + i * length, length, signed) for i in range(count)]
+
     # convert offset to string
     def n2s(self, offset, length):
         s = ''
@@ -1327,8 +1383,14 @@ class EXIF_header:
             else:
                 tag_name = 'Tag 0x%04X' % tag
 
-            # ignore certain tags for faster processing
-            if not (not detailed and tag in IGNORE_TAGS):
+            # ignore certain tags for faster processing, or all those not
+            # asked for, apart from the pointers to other IFDs
+            if self.wanted is not None:
+                process = (ifd_name + ' ' + tag_name in self.wanted
+                           or tag_name in IFD_POINTERS)
+            else:
+                process = not (not detailed and tag in IGNORE_TAGS)
+            if process:
                 field_type = self.s2n(entry + 2, 2)
                 
                 # unknown field type
@@ -1367,8 +1429,7 @@ class EXIF_header:
                     # XXX investigate
                     # sometimes gets too big to fit in int value
                     if count != 0 and count < (2**31):
-                        self.file.seek(self.offset + offset)
-                        values = self.file.read(count)
+                        values = self.read(offset, count)
                         #print values
                         # Drop any garbage after a null.
                         values = values.split('\x00', 1)[0]
@@ -1382,22 +1443,17 @@ class EXIF_header:
                     # some entries get too big to handle could be malformed
                     # file or problem with self.s2n
                     if count < 1000:
-                        for dummy in range(count):
-                            if field_type in (5, 10):
-                                # a ratio
-                                value = Ratio(self.s2n(offset, 4, signed),
-                                              self.s2n(offset + 4, 4, signed))
-                            else:
-                                value = self.s2n(offset, typelen, signed)
-                            values.append(value)
-                            offset = offset + typelen
+                        if field_type in (5, 10):
+                            # ratios
+                            terms = self.s2n_list(offset, 4, count * 2, signed)
+                            values = [Ratio(terms[i], terms[i + 1])
+                                      for i in range(0, len(terms), 2)]
+                        else:
+                            values = self.s2n_list(offset, typelen, count, signed)
                     # The test above causes problems with tags that are 
                     # supposed to have long values!  Fix up one important case.
                     elif tag_name == 'MakerNote' :
-                        for dummy in range(count):
-                            value = self.s2n(offset, typelen, signed)
-                            values.append(value)
-                            offset = offset + typelen
+                        values = self.s2n_list(offset, typelen, count, signed)
                     #else :
                     #    print "Warning: dropping large tag:", tag, tag_name
                 
@@ -1430,7 +1486,7 @@ class EXIF_header:
                     print ' debug:   %s: %s' % (tag_name,
                                                 repr(self.tags[ifd_name + ' ' + tag_name]))
 
-            if tag_name == stop_tag:
+            if tag_name == stop_tag or self.found_all():
                 break
 
     # extract uncompressed TIFF thumbnail (like pulling teeth)
@@ -1444,8 +1500,7 @@ class EXIF_header:
         else:
             tiff = 'II*\x00\x08\x00\x00\x00'
         # ... plus thumbnail IFD data plus a null "next IFD" pointer
-        self.file.seek(self.offset+thumb_ifd)
-        tiff += self.file.read(entries*12+2)+'\x00\x00\x00\x00'
+        tiff += self.read(thumb_ifd, entries*12+2)+'\x00\x00\x00\x00'
 
         # fix up large value offset pointers into data area
         for i in range(entries):
@@ -1472,8 +1527,7 @@ class EXIF_header:
                     strip_off = newoff
                     strip_len = 4
                 # get original data and store it
-                self.file.seek(self.offset + oldoff)
-                tiff += self.file.read(count * typelen)
+                tiff += self.read(oldoff, count * typelen)
 
         # add pixel strips and update strip offset info
         old_offsets = self.tags['Thumbnail StripOffsets'].values
@@ -1484,8 +1538,7 @@ class EXIF_header:
             tiff = tiff[:strip_off] + offset + tiff[strip_off + strip_len:]
             strip_off += strip_len
             # add pixel strip to end
-            self.file.seek(self.offset + old_offsets[i])
-            tiff += self.file.read(old_counts[i])
+            tiff += self.read(old_offsets[i], old_counts[i])
 
         self.tags['TIFFThumbnail'] = tiff
 
@@ -1610,10 +1663,26 @@ class EXIF_header:
             self.tags['MakerNote '+name]=IFD_Tag(str(val), None, 0, None,
                                                  None, None)
 
+# the whole of a file, memory mapped if it's on disk, or read into memory.
+# process_file closes the memory map once it's done with it
+def map_file(f):
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        f.seek(0)
+        return memoryview(f.read())
+
 # process an image file (expects an open file object)
 # this is the function that has to deal with all the arbitrary nasty bits
 # of the EXIF standard
-def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
+# The EXIF data is read with one read of the APP1 segment of a JPEG, the rest
+# of the file is skipped over. The IFDs of a TIFF can be anywhere in it, so
+# it's memory mapped if it's on disk, and only the pages read are loaded
+# Given tags, the full names of the tags to read, only those and the pointers
+# to the IFDs they're in are read, the IFDs none of them are in are skipped,
+# and processing stops once all of them are found, without decoding
+# MakerNotes or extracting thumbnails
+def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False, tags=None):
     # yah it's cheesy...
     global detailed
     detailed = details
@@ -1625,22 +1694,21 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     data = f.read(12)
     if data[0:4] in ['II*\x00', 'MM\x00*']:
         # it's a TIFF file
-        f.seek(0)
-        endian = f.read(1)
-        f.read(1)
-        offset = 0
+        tiff = map_file(f)
+        endian = data[0:1]
     elif data[0:2] == '\xFF\xD8':
         # it's a JPEG file
         while data[2] == '\xFF' and data[6:10] in ('JFIF', 'JFXX', 'OLYM', 'Phot'):
             length = ord(data[4])*256+ord(data[5])
-            f.read(length-8)
+            f.seek(length-8, 1)
             # fake an EXIF beginning of file
             data = '\xFF\x00'+f.read(10)
             fake_exif = 1
         if data[2] == '\xFF' and data[6:10] == 'Exif':
-            # detected EXIF header
-            offset = f.tell()
-            endian = f.read(1)
+            # detected EXIF header, the TIFF data is the rest of the segment
+            length = ord(data[4])*256+ord(data[5])
+            tiff = memoryview(f.read(length-8))
+            endian = tiff[0:1].tobytes()
         else:
             # no EXIF information
             return {}
@@ -1648,13 +1716,26 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
         # file format not recognized
         return {}
 
+    try:
+        return read_tags(tiff, endian, fake_exif, stop_tag, strict, debug, tags)
+    finally:
+        # the tags read are copies, so the file can be unmapped
+        if isinstance(tiff, mmap.mmap):
+            tiff.close()
+
+# read the tags of the TIFF data of a file, as process_file returns them
+def read_tags(tiff, endian, fake_exif, stop_tag='UNDEF', strict=False, debug=False, tags=None):
     # deal with the EXIF info we found
     if debug:
         print {'I': 'Intel', 'M': 'Motorola'}[endian], 'format'
-    hdr = EXIF_header(f, endian, offset, fake_exif, strict, debug)
+    hdr = EXIF_header(tiff, endian, 0, fake_exif, strict, debug)
+    if tags is not None:
+        hdr.wanted = set(tags)
     ifd_list = hdr.list_IFDs()
     ctr = 0
     for i in ifd_list:
+        if hdr.found_all():
+            break
         if ctr == 0:
             IFD_name = 'Image'
         elif ctr == 1:
@@ -1662,18 +1743,22 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
             thumb_ifd = i
         else:
             IFD_name = 'IFD %d' % ctr
+        # the first IFD is read for its pointers to the EXIF and GPS IFDs
+        if ctr > 0 and not hdr.wants(IFD_name):
+            ctr += 1
+            continue
         if debug:
             print ' IFD %d (%s) at offset %d:' % (ctr, IFD_name, i)
         hdr.dump_IFD(i, IFD_name, stop_tag=stop_tag)
         # EXIF IFD
         exif_off = hdr.tags.get(IFD_name+' ExifOffset')
-        if exif_off:
+        if exif_off and hdr.wants('EXIF') and not hdr.found_all():
             if debug:
                 print ' EXIF SubIFD at offset %d:' % exif_off.values[0]
             hdr.dump_IFD(exif_off.values[0], 'EXIF', stop_tag=stop_tag)
             # Interoperability IFD contained in EXIF IFD
             intr_off = hdr.tags.get('EXIF SubIFD InteroperabilityOffset')
-            if intr_off:
+            if intr_off and hdr.wants('EXIF Interoperability') and not hdr.found_all():
                 if debug:
                     print ' EXIF Interoperability SubSubIFD at offset %d:' \
                           % intr_off.values[0]
@@ -1681,12 +1766,16 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
                              dict=INTR_TAGS, stop_tag=stop_tag)
         # GPS IFD
         gps_off = hdr.tags.get(IFD_name+' GPSInfo')
-        if gps_off:
+        if gps_off and hdr.wants('GPS') and not hdr.found_all():
             if debug:
                 print ' GPS SubIFD at offset %d:' % gps_off.values[0]
             hdr.dump_IFD(gps_off.values[0], 'GPS', dict=GPS_TAGS, stop_tag=stop_tag)
         ctr += 1
 
+    # only the tags asked for are read
+    if hdr.wanted is not None:
+        return hdr.tags
+
     # extract uncompressed TIFF thumbnail
     thumb = hdr.tags.get('Thumbnail Compression')
     if thumb and thumb.printable == 'Uncompressed TIFF':
@@ -1695,9 +1784,8 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     # JPEG thumbnail (thankfully the JPEG data is stored as a unit)
     thumb_off = hdr.tags.get('Thumbnail JPEGInterchangeFormat')
     if thumb_off:
-        f.seek(offset+thumb_off.values[0])
         size = hdr.tags['Thumbnail JPEGInterchangeFormatLength'].values[0]
-        hdr.tags['JPEGThumbnail'] = f.read(size)
+        hdr.tags['JPEGThumbnail'] = hdr.read(thumb_off.values[0], size)
 
     # deal with MakerNote contained in EXIF IFD
     # (Some apps use MakerNote tags but do not use a format for which we
@@ -1710,8 +1798,7 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     if 'JPEGThumbnail' not in hdr.tags:
         thumb_off=hdr.tags.get('MakerNote JPEGThumbnail')
         if thumb_off:
-            f.seek(offset+thumb_off.values[0])
-            hdr.tags['JPEGThumbnail']=file.read(thumb_off.field_length)
+            hdr.tags['JPEGThumbnail']=hdr.read(thumb_off.values[0], thumb_off.field_length)
 
     return hdr.tags
 
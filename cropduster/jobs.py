@@ -0,0 +1,179 @@
+"""
+Thumbnail rendering jobs.
+
+By default thumbnails are rendered as soon as an image or crop is saved. Set
+CROPDUSTER_QUEUE_BACKEND to the dotted path of one of the backends below to
+render them in the background instead, so saving returns immediately.
+"""
+import logging
+from datetime import timedelta
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from cropduster.caching import local_cache, uncached
+
+
+CROPDUSTER_QUEUE_BACKEND = getattr(settings, "CROPDUSTER_QUEUE_BACKEND", "cropduster.jobs.SyncBackend")
+CROPDUSTER_QUEUE_THREADS = getattr(settings, "CROPDUSTER_QUEUE_THREADS", 2)
+CROPDUSTER_QUEUE_TIMEOUT = getattr(settings, "CROPDUSTER_QUEUE_TIMEOUT", 3600)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+STATUS_CHOICES = (
+	(PENDING, "Pending"),
+	(RUNNING, "Running"),
+	(DONE, "Done"),
+	(FAILED, "Failed"),
+)
+
+logger = logging.getLogger(__name__)
+
+
+def render(image, crop=None):
+	""" Renders the thumbnails for a job, either the image's auto sizes or the sizes of a crop """
+
+	if crop is not None:
+		crop.create_thumbnails()
+	else:
+		image.create_auto_thumbnails()
+
+def summarize(statuses):
+	""" Reduces the statuses of all of an image's jobs to one, jobs with no record being done """
+
+	statuses = set(statuses)
+	for status in (RUNNING, PENDING, FAILED):
+		if status in statuses:
+			return status
+	return DONE
+
+
+class SyncBackend(object):
+	""" Renders thumbnails straight away, in the process saving the image """
+
+	def enqueue(self, image, crop=None):
+		render(image, crop)
+
+	def status(self, image):
+		return DONE
+
+
+class ThreadPoolBackend(object):
+	"""
+	Renders thumbnails in a pool of CROPDUSTER_QUEUE_THREADS threads in the current process.
+	A job that is already waiting for a thread is not queued again. Jobs are queued by id, and 
+	render the image and crop as they are when a thread gets to them, however often they were 
+	saved while waiting
+	"""
+
+	def __init__(self, threads=CROPDUSTER_QUEUE_THREADS):
+		self.pool = ThreadPool(threads)
+		self.lock = Lock()
+		# (image id, crop id) => status of jobs not done yet
+		self.jobs = {}
+
+	def enqueue(self, image, crop=None):
+		key = (image.id, crop.id if crop is not None else None)
+
+		with self.lock:
+			if self.jobs.get(key) == PENDING:
+				return
+			self.jobs[key] = PENDING
+
+		self.pool.apply_async(self.work, (key,))
+
+	def work(self, key):
+		try:
+			self.run(key)
+		finally:
+			# Each thread gets its own database connection
+			connection.close()
+
+	def run(self, key):
+		from cropduster.models import Image, Crop
+
+		image_id, crop_id = key
+		with self.lock:
+			self.jobs[key] = RUNNING
+
+		try:
+			# rows this thread cached for earlier jobs may have changed since
+			local_cache.clear()
+			with uncached():
+				image = Image.objects.get(pk=image_id)
+				crop = Crop.objects.get(pk=crop_id) if crop_id is not None else None
+				render(image, crop)
+		except Exception:
+			logger.exception("Failed to render thumbnails for image %s", image_id)
+			status = FAILED
+		else:
+			status = DONE
+
+		with self.lock:
+			# Leave the job alone if it was queued again while running
+			if self.jobs.get(key) == RUNNING:
+				if status == DONE:
+					del self.jobs[key]
+				else:
+					self.jobs[key] = status
+
+	def status(self, image):
+		with self.lock:
+			return summarize(status for (image_id, crop_id), status in self.jobs.items() if image_id == image.id)
+
+
+class DatabaseBackend(object):
+	"""
+	Stores jobs as RenderJob rows for the process_render_jobs management command to render.
+	A job that is already pending is not queued again, finished jobs are deleted. Jobs still
+	running CROPDUSTER_QUEUE_TIMEOUT seconds after they were claimed lost their worker, and
+	are pending again
+	"""
+
+	def enqueue(self, image, crop=None):
+		from cropduster.models import RenderJob
+
+		jobs = RenderJob.objects.filter(image=image, crop=crop)
+		if not jobs.filter(status=PENDING).exists():
+			# This job supersedes any earlier failures
+			jobs.filter(status=FAILED).delete()
+			RenderJob.objects.create(image=image, crop=crop)
+
+	def status(self, image):
+		from cropduster.models import RenderJob
+
+		cutoff = stale_cutoff()
+		return summarize(
+			PENDING if status == RUNNING and (claimed_at is None or claimed_at < cutoff) else status
+			for status, claimed_at in RenderJob.objects.filter(image=image).values_list("status", "claimed_at")
+		)
+
+def stale_cutoff():
+	""" The time before which running jobs were claimed by workers that have since died """
+	return timezone.now() - timedelta(seconds=CROPDUSTER_QUEUE_TIMEOUT)
+
+
+_backend = None
+
+def get_backend():
+	""" Gets the configured backend, shared across the process """
+
+	global _backend
+	if _backend is None:
+		_backend = import_string(CROPDUSTER_QUEUE_BACKEND)()
+	return _backend
+
+def enqueue(image, crop=None):
+	""" Queues rendering the thumbnails for an image's auto sizes, or for a crop if given """
+	get_backend().enqueue(image, crop)
+
+def status(image):
+	""" Gets the rendering status of an image: pending, running, done or failed """
+	return get_backend().status(image)
@@ -0,0 +1,126 @@
+"""
+Single-flight locks for rendering thumbnails on demand.
+
+When a thumbnail is missing, every request that needs it would otherwise decode
+the original and render it at once. Whoever takes the lock for an (image, size)
+renders it, and everyone else waits for them to finish. Processes on one machine
+are coordinated with a file lock, and machines with an entry in the Django cache,
+which needs a cache shared between them, such as memcached. Lock files are removed
+by whoever held them as they let go, so CROPDUSTER_LOCK_DIR only holds the locks
+of thumbnails being rendered.
+"""
+import os
+import time
+import uuid
+import hashlib
+import tempfile
+
+try:
+	import fcntl
+except ImportError:
+	# Not on Windows, which falls back on the cache lock alone
+	fcntl = None
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+CROPDUSTER_LOCK_DIR = getattr(settings, "CROPDUSTER_LOCK_DIR", os.path.join(tempfile.gettempdir(), "cropduster-locks"))
+CROPDUSTER_LOCK_TIMEOUT = getattr(settings, "CROPDUSTER_LOCK_TIMEOUT", 60)
+CROPDUSTER_LOCK_WAIT = getattr(settings, "CROPDUSTER_LOCK_WAIT", 10)
+
+# Seconds between attempts to take a lock that someone else holds
+POLL_INTERVAL = 0.05
+
+
+class RenderLock(object):
+	"""
+	Lock on rendering one thumbnail. Holders that die keep the file lock no longer
+	than their process, and the cache lock for at most CROPDUSTER_LOCK_TIMEOUT seconds
+	"""
+
+	def __init__(self, image_id, slug, timeout=CROPDUSTER_LOCK_TIMEOUT):
+		self.name = "%s:%s" % (image_id, slug)
+		self.key = "cropduster:lock:%s" % hashlib.md5(self.name.encode("utf-8")).hexdigest()
+		self.path = os.path.join(CROPDUSTER_LOCK_DIR, self.key.rsplit(":", 1)[1] + ".lock")
+		self.timeout = timeout
+		self.token = None
+		self.fd = None
+		self.locked = False
+
+	def acquire_file(self):
+		if fcntl is None:
+			return True
+
+		if self.fd is None:
+			if not os.path.exists(CROPDUSTER_LOCK_DIR):
+				try:
+					os.makedirs(CROPDUSTER_LOCK_DIR)
+				except OSError:
+					# Made by someone else in the meantime
+					pass
+			self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+
+		try:
+			fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError:
+			return False
+
+		# The holder before may have removed the file since it was opened, in which case
+		# this is a lock on nothing, and the lock is taken on the file now in its place
+		try:
+			current = os.stat(self.path)
+		except OSError:
+			current = None
+		opened = os.fstat(self.fd)
+		if current is None or (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino):
+			os.close(self.fd)
+			self.fd = None
+			return self.acquire_file()
+
+		self.locked = True
+		return True
+
+	def acquire_cache(self):
+		token = uuid.uuid4().hex
+		if cache.add(self.key, token, self.timeout):
+			self.token = token
+			return True
+		return False
+
+	def acquire(self, wait=CROPDUSTER_LOCK_WAIT):
+		""" Takes the lock, waiting up to wait seconds for it. Returns whether it was taken """
+		deadline = time.time() + wait
+
+		while not self.acquire_file():
+			if time.time() >= deadline:
+				self.close()
+				return False
+			time.sleep(POLL_INTERVAL)
+
+		while not self.acquire_cache():
+			if time.time() >= deadline:
+				self.close()
+				return False
+			time.sleep(POLL_INTERVAL)
+
+		return True
+
+	def release(self):
+		# Only remove the cache lock if it hasn't expired and been taken by someone else
+		if self.token is not None and cache.get(self.key) == self.token:
+			cache.delete(self.key)
+		self.token = None
+		self.close()
+
+	def close(self):
+		""" Gives up the file lock, removing the file first if it was held so that waiters move on to a new one """
+		if self.fd is not None:
+			if self.locked:
+				try:
+					os.unlink(self.path)
+				except OSError:
+					pass
+			os.close(self.fd)
+			self.fd = None
+		self.locked = False
@@ -11,10 +11,8 @@ from optparse import make_option
 
 from django.core.management.base import BaseCommand, CommandError
 
-from cropduster.models import Image as CropDusterImage,CropDusterField as CDF
-from cropduster.utils import create_cropped_image, rescale
+from cropduster.models import Image as CropDusterImage, split_thumbnail_slug
 import apputils
-import Image
 
 class Command(BaseCommand):
     args = "app1 [app2...]"
@@ -54,7 +52,7 @@ class Command(BaseCommand):
 
     def get_derived_paths(self, cd_image):
         """
-        Gets the derived image paths.
+        Gets the derived image paths from the image's thumbnail manifest.
 
         @param cd_image: Cropduster image to use
         @type  cd_image: CropDusterImage
@@ -62,11 +60,13 @@ class Command(BaseCommand):
         @return: Set of paths
         @rtype:  Sizes
         """
-        sizes = []
-        for size in cd_image.size_set.size_set.all():
-            path = cd_image.thumbnail_path(size)
-            if os.path.exists(path):
-                yield path
+        if not cd_image.thumbnails_scanned:
+            cd_image.scan_thumbnails()
+
+        for slug in cd_image.thumbnail_manifest:
+            # manifest slugs of thumbs in other formats end in their extension
+            version_slug, extension = split_thumbnail_slug(slug)
+            yield cd_image.storage.path(cd_image.thumbnail_name(version_slug, extension=extension))
 
     def find_image_files(self, apps, query_set, only_originals):
         """
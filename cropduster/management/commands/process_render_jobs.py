@@ -0,0 +1,113 @@
+# Renders the thumbnails queued by cropduster.jobs.DatabaseBackend.
+# Run it under a process supervisor with --loop, or from cron without:
+# manage.py process_render_jobs --loop
+
+import time
+import logging
+import traceback
+from optparse import make_option
+
+from django.db.models import F, Q
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+from cropduster import jobs
+from cropduster.caching import local_cache, uncached
+from cropduster.models import RenderJob
+
+
+class Command(BaseCommand):
+    help = "Renders thumbnails queued in the database by cropduster."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop',
+                    action  = "store_true",
+                    dest    = "loop",
+                    default = False,
+                    help    = "Keeps waiting for new jobs once the queue is drained.  Default is False."),
+
+        make_option('--sleep',
+                    dest    = "sleep",
+                    type    = "float",
+                    default = 1.0,
+                    help    = "Seconds to wait between polls of an empty queue when looping.  Default is 1."),
+
+        make_option('--limit',
+                    dest    = "limit",
+                    type    = "int",
+                    default = 0,
+                    help    = "Stops after rendering this many jobs.  Default 0 renders all of them."),
+
+        make_option('--retry_failed',
+                    dest    = "retry_failed",
+                    action  = "store_true",
+                    default = False,
+                    help    = "Requeues failed jobs before starting.  Default is False."),
+    )
+
+    def claim_job(self):
+        """
+        Claims the oldest pending job, so that other workers skip it.  Jobs 
+        left running for longer than CROPDUSTER_QUEUE_TIMEOUT were claimed by
+        a worker that died, and are claimed again.
+
+        @return: The claimed job, or None if the queue is empty.
+        @rtype:  RenderJob
+        """
+        while True:
+            stale = Q(status=jobs.RUNNING) & (Q(claimed_at__lt=jobs.stale_cutoff()) | Q(claimed_at__isnull=True))
+            try:
+                job = RenderJob.objects.filter(Q(status=jobs.PENDING) | stale).order_by('id')[0]
+            except IndexError:
+                return None
+
+            if job.status == jobs.RUNNING:
+                logging.warning('Claiming job %s for image %s again, its worker has not finished it since %s' % (job.id, job.image_id, job.claimed_at))
+
+            # Another worker may have claimed it in the meantime
+            claimed = RenderJob.objects.filter(id=job.id, status=job.status, claimed_at=job.claimed_at)\
+                                       .update(status=jobs.RUNNING, claimed_at=timezone.now(), attempts=F('attempts') + 1)
+            if claimed:
+                return job
+
+    def run_job(self, job):
+        """
+        Renders a job's thumbnails.  Finished jobs are deleted, failed ones
+        are kept along with their error.
+
+        @param job: Job to render
+        @type  job: RenderJob
+        """
+        # Rows cached for earlier jobs may have changed since, such as a crop
+        # being redrawn, so the job's image and crop are read afresh
+        local_cache.clear()
+        try:
+            with uncached():
+                jobs.render(job.image, job.crop)
+        except Exception, e:
+            logging.exception('Failed to render thumbnails for image %s' % job.image_id)
+            RenderJob.objects.filter(id=job.id)\
+                             .update(status=jobs.FAILED, error=traceback.format_exc(e))
+        else:
+            RenderJob.objects.filter(id=job.id).delete()
+
+    def handle(self, *args, **options):
+        """
+        Drains the queue, then either exits or keeps polling for new jobs.
+        """
+        if options['retry_failed']:
+            RenderJob.objects.filter(status=jobs.FAILED).update(status=jobs.PENDING)
+
+        rendered = 0
+        while not options['limit'] or rendered < options['limit']:
+            job = self.claim_job()
+            if job is None:
+                if not options['loop']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+
+            self.run_job(job)
+            rendered += 1
+
+        self.stdout.write("Rendered %i jobs\n" % rendered)
@@ -0,0 +1,190 @@
+# Reads the dimensions, EXIF orientation, capture time, camera, GPS position
+# and color space of images uploaded before they were kept on Image:
+# manage.py read_image_metadata --processes 4
+
+import time
+import signal
+import multiprocessing
+from collections import deque
+from optparse import make_option
+
+from django.db import connections
+from django.core.management.base import BaseCommand
+
+from cropduster import utils
+from cropduster.caching import invalidate
+from cropduster.models import Image as CropDusterImage
+
+
+def init_worker():
+    """
+    Runs in each worker process as it starts.  Workers that replace killed
+    ones are forked after the parent has reconnected, so any connections 
+    inherited from it are closed.  Lets the parent handle Ctrl-C, so the
+    pool can be shut down cleanly.
+    """
+    for connection in connections.all():
+        connection.close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def read_chunk(images):
+    """
+    Reads the metadata of a chunk of images, in a worker process.  Only opens
+    the originals, the parent process does all the database work.  Never
+    raises, so that one bad image can't take down the pool.
+
+    @param images: Primary keys and file names of the images
+    @type  images: [(int, str), ...]
+
+    @return: Each image's primary key, its metadata fields, and any error
+    @rtype:  [(int, dict, str), ...]
+    """
+    storage = CropDusterImage._meta.get_field('image').storage
+    results = []
+    for pk, name in images:
+        try:
+            with storage.open(name, 'rb') as f:
+                results.append((pk, utils.image_metadata(f), None))
+        except Exception, e:
+            results.append((pk, None, '%s: %s' % (type(e).__name__, e)))
+    return results
+
+class Command(BaseCommand):
+    help = "Reads the metadata kept on cropduster images from their originals, "\
+           "for images uploaded before it was."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--force',
+                    action  = "store_true",
+                    dest    = "force",
+                    default = False,
+                    help    = "Reads every image, not only those without metadata.  Default is False."),
+
+        make_option('--processes',
+                    dest    = 'procs',
+                    type    = "int",
+                    default = multiprocessing.cpu_count(),
+                    help    = "How many processes read images at once.  Default is the number of CPUs."),
+
+        make_option('--chunk_size',
+                    dest    = 'chunk_size',
+                    type    = "int",
+                    default = 100,
+                    help    = "How many images each process reads at a time.  Default is 100."),
+
+        make_option('--task_timeout',
+                    dest    = 'task_timeout',
+                    type    = "int",
+                    default = 600,
+                    help    = "Seconds after which a chunk whose worker never answered, because it was killed, "
+                              "is given up on.  Default is 600."),
+    )
+
+    def get_chunks(self, query, chunk_size):
+        """
+        Streams the primary keys and file names of images in order, a chunk
+        at a time, so that huge tables never have to be loaded at once.
+
+        @param query: Images to read
+        @type  query: QuerySet
+
+        @param chunk_size: Number of images per chunk
+        @type  chunk_size: positive int
+
+        @return: Generator yielding chunks of primary keys and file names
+        @rtype:  <[(int, str), ...], ...>
+        """
+        last_pk = None
+        while True:
+            chunk = query.order_by('pk')
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            images = list(chunk.values_list('pk', 'image')[:chunk_size])
+            if not images:
+                return
+
+            yield images
+            last_pk = images[-1][0]
+
+    def save_chunk(self, results):
+        """
+        Saves the metadata read for a chunk of images, and drops them from the
+        row cache.
+
+        @return: Number of images saved and the errors of the others
+        @rtype:  (int, [(int, str), ...])
+        """
+        saved, failures = 0, []
+        for pk, fields, error in results:
+            if error:
+                failures.append((pk, error))
+                continue
+            CropDusterImage.objects.filter(pk=pk).update(**fields)
+            invalidate(CropDusterImage, CropDusterImage(pk=pk))
+            saved += 1
+        return saved, failures
+
+    def handle(self, *args, **options):
+        """
+        Hands chunks of images out to a pool of worker processes, a few per
+        worker at a time, and saves what they read as they finish.
+        """
+        started = time.time()
+        query = CropDusterImage.objects.all()
+        if not options['force']:
+            query = query.filter(width__isnull=True)
+        chunks = self.get_chunks(query, max(options['chunk_size'], 1))
+
+        procs = max(options['procs'], 1)
+        if procs > 1:
+            # Workers must not share the parent's database connections
+            for connection in connections.all():
+                connection.close()
+            pool = multiprocessing.Pool(procs, initializer=init_worker)
+            submit = lambda chunk: pool.apply_async(read_chunk, (chunk,))
+        else:
+            pool = None
+            submit = lambda chunk: read_chunk(chunk)
+
+        saved, failures = 0, []
+        pending = deque()
+        given_up = [False]
+
+        def collect():
+            chunk, result = pending.popleft()
+            if pool:
+                try:
+                    result = result.get(options['task_timeout'])
+                except multiprocessing.TimeoutError:
+                    # The pool never answers for chunks whose worker was killed
+                    given_up[0] = True
+                    result = [(pk, None, 'No result after %is, the worker may have been killed' % options['task_timeout'])
+                              for pk, name in chunk]
+            chunk_saved, chunk_failures = self.save_chunk(result)
+            failures.extend(chunk_failures)
+            return chunk_saved
+
+        try:
+            for chunk in chunks:
+                pending.append((chunk, submit(chunk)))
+                if len(pending) >= procs * 2:
+                    saved += collect()
+            while pending:
+                saved += collect()
+        except KeyboardInterrupt:
+            if pool is not None:
+                pool.terminate()
+                pool = None
+            raise
+        finally:
+            # The pool waits forever for the results of chunks given up on
+            if pool is not None:
+                if given_up[0]:
+                    pool.terminate()
+                else:
+                    pool.close()
+                pool.join()
+
+        for pk, error in failures:
+            self.stderr.write("Failed to read image %s: %s\n" % (pk, error))
+        self.stdout.write("Read the metadata of %i images in %.0fs, %i failed\n" % (saved, time.time() - started, len(failures)))
@@ -4,21 +4,25 @@
 #
 # Search for 'changeme' for lines that should be modified
 
-import sys
 import os
+import sys
+import json
+import time
 import logging
-import inspect
 import traceback
-from collections import namedtuple
+import multiprocessing
+from Queue import Queue, Empty
+from collections import namedtuple, deque
 from optparse import make_option
 
-from django.db.models.base import ModelBase
+from django.db import connections
+from django.db.models.loading import get_model
 from django.core.management.base import BaseCommand, CommandError
 
-from cropduster.models import Image as CropDusterImage,CropDusterField as CDF
-from cropduster.utils import create_cropped_image, rescale
+from cropduster.models import Image as CropDusterImage
+from cropduster.registry import registry
+from cropduster.caching import local_cache, uncached
 import apputils
-import Image
 
 def to_CE(f, *args, **kwargs):
     """
@@ -51,7 +55,209 @@ class PrettyError(object):
 
         return _f
 
-Size = namedtuple('Size', ('name', 'path', 'crop', 'width', 'height'))
+
+def init_worker():
+    """
+    Runs in each worker process as it starts.  Workers that replace those
+    past --max_tasks_per_child are forked after the parent has reconnected,
+    so any connections inherited from it are closed here, and each worker 
+    opens its own.
+    """
+    for connection in connections.all():
+        connection.close()
+
+    # Let the parent handle Ctrl-C, so the pool can be shut down cleanly
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def render_object(task):
+    """
+    Regenerates the thumbnails for one object, in a worker process.  Never
+    raises, so that one bad image can't take down the pool.
+
+    @param task: What to render
+    @type  task: Task
+
+    @return: The task and what was rendered for it, with any error.
+    @rtype:  Result
+    """
+    # Rows cached for earlier objects may have changed since
+    local_cache.clear()
+    try:
+        with uncached():
+            images, thumbnails, bytes = Command().render_object(task)
+    except Exception, e:
+        logging.exception('Error regenerating thumbnails for %s.%s %s' % (task.app_label, task.model_name, task.pk))
+        return Result(task, 0, 0, 0, '%s: %s' % (type(e).__name__, e))
+    return Result(task, images, thumbnails, bytes, None)
+
+Task = namedtuple('Task', ('app_label', 'model_name', 'pk', 'field_names', 'force', 'changed', 'stretch', 'attempt'))
+Result = namedtuple('Result', ('task', 'images', 'thumbnails', 'bytes', 'error'))
+
+class Stats(object):
+    """
+    Running totals for a regeneration pass, for throughput reports.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.objects = 0
+        self.images = 0
+        self.thumbnails = 0
+        self.bytes = 0
+        self.failures = []
+
+    def add(self, result):
+        self.objects += 1
+        self.images += result.images
+        self.thumbnails += result.thumbnails
+        self.bytes += result.bytes
+        if result.error:
+            self.failures.append(result)
+
+    def get_state(self):
+        return dict(elapsed=time.time() - self.started,
+                    objects=self.objects,
+                    images=self.images,
+                    thumbnails=self.thumbnails,
+                    bytes=self.bytes,
+                    failures=[list(result.task[:3]) + [result.error] for result in self.failures])
+
+    def set_state(self, state):
+        self.started = time.time() - state['elapsed']
+        self.objects = state['objects']
+        self.images = state['images']
+        self.thumbnails = state['thumbnails']
+        self.bytes = state['bytes']
+        self.failures = [Result(Task(app_label, model_name, pk, (), False, False, False, 0), 0, 0, 0, error)
+                         for app_label, model_name, pk, error in state['failures']]
+
+    def forget(self, task, pks):
+        """
+        Drops the failures of objects of the task's kind that are being tried
+        again, so they are only counted once they have been.
+        """
+        pks = set(pks)
+        failures = [result for result in self.failures
+                    if result.task[:2] != task[:2] or result.task.pk not in pks]
+        self.objects -= len(self.failures) - len(failures)
+        self.failures = failures
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        return "%i objects, %i images, %i thumbnails in %.0fs: %.1f images/sec, "\
+               "%.1f KB/sec written, %i failed" % (self.objects,
+                                                   self.images,
+                                                   self.thumbnails,
+                                                   elapsed,
+                                                   self.images / elapsed,
+                                                   self.bytes / 1024.0 / elapsed,
+                                                   len(self.failures))
+
+class Checkpoint(object):
+    """
+    Progress of a regeneration pass, saved to a file so that an interrupted
+    run can be resumed.  Objects finish out of order when there are several
+    workers, so for each model and set of fields the checkpoint keeps the 
+    highest primary key below which every object has finished, and the keys
+    of the objects that failed, to be tried again on resume.
+    """
+    def __init__(self, path, stats):
+        self.path = path
+        self.stats = stats
+        self.last_pks = {}
+        self.pending = {}
+        self.finished = {}
+        self.failed = {}
+        # keys of the failed objects being tried again, which are behind the last key
+        self.retrying = {}
+        self.args = None
+        self.complete = False
+
+    def key(self, task):
+        return '%s.%s:%s' % (task.app_label, task.model_name, ','.join(task.field_names))
+
+    def last_pk(self, task):
+        """
+        @return: Primary key that every earlier object of the task's kind has
+                 finished by, or None if none have.
+        @rtype:  object
+        """
+        return self.last_pks.get(self.key(task))
+
+    def retry(self, task):
+        """
+        Takes the objects of the task's kind that failed before the last key,
+        to be tried again.  Those after it are tried again anyway.
+
+        @return: Primary keys of the objects to try again.
+        @rtype:  [object, ...]
+        """
+        key = self.key(task)
+        last_pk = self.last_pks.get(key)
+        pks = [pk for pk in self.failed.pop(key, []) if last_pk is not None and pk <= last_pk]
+        self.stats.forget(task, pks)
+        self.retrying.setdefault(key, set()).update(pks)
+        return pks
+
+    def submitted(self, task):
+        if task.pk in self.retrying.get(self.key(task), ()):
+            return
+        self.pending.setdefault(self.key(task), deque()).append(task.pk)
+
+    def done(self, task, failed=False):
+        key = self.key(task)
+        if failed:
+            self.failed.setdefault(key, []).append(task.pk)
+
+        retrying = self.retrying.get(key, set())
+        if task.pk in retrying:
+            retrying.remove(task.pk)
+            return
+
+        pending = self.pending[key]
+        finished = self.finished.setdefault(key, set())
+        finished.add(task.pk)
+
+        # Move up to the last key of the unbroken run of finished objects
+        while pending and pending[0] in finished:
+            pk = pending.popleft()
+            finished.remove(pk)
+            self.last_pks[key] = pk
+
+    def load(self):
+        """
+        Loads a saved checkpoint.
+
+        @return: Whether there was one to load.
+        @rtype:  bool
+        """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except IOError:
+            return False
+
+        self.args = state['args']
+        self.last_pks = state['last_pks']
+        self.failed = state.get('failed', {})
+        self.complete = state['complete']
+        self.stats.set_state(state['stats'])
+        return True
+
+    def save(self):
+        """
+        Saves the checkpoint, replacing the last one only once it has been
+        completely written.
+        """
+        state = dict(args=self.args,
+                     last_pks=self.last_pks,
+                     failed=self.failed,
+                     complete=self.complete,
+                     stats=self.stats.get_state())
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=1)
+        os.rename(tmp_path, self.path)
 
 class Command(BaseCommand):
     args = "app_name[:model[.field]][, ...]"
@@ -65,6 +271,13 @@ class Command(BaseCommand):
                     default = False,
                     help    = "Resizes all images regardless of whether or not they already exist."),
 
+        make_option('--changed',
+                    action  = "store_true",
+                    dest    = "changed",
+                    default = False,
+                    help    = "Only resizes images whose original, crop or size has changed since their "
+                              "thumbnail was made.  Thumbnails made before this option existed are all redone once."),
+
         make_option('--query_set',
                     dest    = "query_set",
                     default = "all()",
@@ -96,13 +309,52 @@ class Command(BaseCommand):
                     dest='procs',
                     type="int",
                     default=1,
-                    help="Indicates how many procs to use for converting images. Default is 1")
+                    help="Indicates how many procs to use for converting images. Default is 1"),
+
+        make_option('--chunk_size',
+                    dest='chunk_size',
+                    type="int",
+                    default=1000,
+                    help="How many primary keys to fetch from the database at a time.  Default is 1000"),
+
+        make_option('--retries',
+                    dest='retries',
+                    type="int",
+                    default=2,
+                    help="How many more times to try an object whose images failed.  Default is 2"),
+
+        make_option('--max_tasks_per_child',
+                    dest='max_tasks',
+                    type="int",
+                    default=1000,
+                    help="Replaces each worker process after this many objects, to keep memory down.  Default is 1000"),
+
+        make_option('--task_timeout',
+                    dest='task_timeout',
+                    type="int",
+                    default=600,
+                    help="Seconds after which an object whose worker never answered, because it was killed, "
+                         "is given up on and retried.  Default is 600"),
+
+        make_option('--report_every',
+                    dest='report_every',
+                    type="int",
+                    default=30,
+                    help="Seconds between throughput reports.  Default is 30"),
+
+        make_option('--checkpoint_file',
+                    dest='checkpoint_file',
+                    default='regen_thumbs.checkpoint',
+                    help="Where progress is saved, for --resume.  Default regen_thumbs.checkpoint"),
+
+        make_option('--resume',
+                    dest='resume',
+                    action="store_true",
+                    default=False,
+                    help="Continues the run saved in the checkpoint file, with its apps and options, "
+                         "trying the objects that failed in it again.  Default False"),
     )
     
-    IMG_TYPE_PARAMS = {
-        'JPEG': dict(quality=95)
-    }
-    
     def get_queryset(self, model, query_str):
         """
         Gets the query set from the provided model based on the user's filters.
@@ -119,12 +371,13 @@ class Command(BaseCommand):
         query_str = 'model.objects.' + query_str.lstrip('.')
         return eval(query_str, dict(model=model))
 
-    def resize_image(self, image, sizes, force):
+    def resize_image(self, cd_image, sizes, force, changed=False):
         """
-        Resizes an image to the provided set sizes.
+        Resizes an image to the provided set sizes, decoding the original
+        once for each crop the sizes are made from.
 
-        @param image: Opened original image
-        @type  image: PIL.Image
+        @param cd_image: Cropduster image being resized
+        @type  cd_image: CropDusterImage
         
         @param sizes: Set of sizes to create.
         @type  sizes: [Size1, ...]
@@ -132,43 +385,35 @@ class Command(BaseCommand):
         @param force: Whether or not to recreate a thumbnail if it already exists.
         @type  force: bool
 
-        @return: 
-        @rtype: 
+        @param changed: Whether to recreate a thumbnail if its fingerprint has changed,
+                        rather than only if it doesn't exist.
+        @type  changed: bool
+
+        @return: Manifest entries of the thumbnails written
+        @rtype:  [Thumbnail, ...]
         """
-        img_params = (self.IMG_TYPE_PARAMS.get(image.format) or {}).copy()
+        needed = []
+        # the original is only looked at once for all the sizes
+        source_stat = cd_image.source_stat() if changed and not force else None
         for size in sizes:
-            
-            logging.debug('Converting image to size `%s` (%s x %s)' % (size.name,
+            logging.debug('Converting image to size `%s` (%s x %s)' % (size.slug,
                                                                        size.width,
                                                                        size.height))
             # Do we need to recreate the file?
-            if not force and os.path.isfile(size.path) and os.stat(size.path).st_size > 0:
-                logging.debug(' - Image `%s` exists, skipping...' % size.name)
+            if force:
+                pass
+            elif changed:
+                if not cd_image.thumbnail_changed(size, source_stat):
+                    logging.debug(' - Image `%s` is unchanged, skipping...' % size.slug)
+                    continue
+            elif cd_image.has_thumbnail(size.slug):
+                logging.debug(' - Image `%s` exists, skipping...' % size.slug)
                 continue
+            needed.append(size)
 
-            folder, _basename = os.path.split(size.path)
-            if not os.path.isdir(folder):
-                logging.debug(' - Directory %s does not exist.  Creating...' % folder)
-                os.makedirs(folder)
-
-            try:
-                # In place scaling, so we need to use a copy of the image.
-                thumbnail = rescale(image.copy(),
-                                    size.width,
-                                    size.height,
-                                    crop=size.crop)
-
-                tmp_path = size.path + '.tmp'
-
-                thumbnail.save(tmp_path, image.format, **img_params)
-
-            # No idea what this can throw, so catch them all
-            except Exception, e:
-                logging.exception('Error saving thumbnail to %s' % tmp_path)
-                raise SystemExit('Exiting...')
-                
-            else:
-                os.rename(tmp_path, size.path)
+        if not needed:
+            return []
+        return cd_image.create_thumbnails(needed, force_crop=True)
             
     def get_sizes(self, cd_image, stretch):
         """
@@ -182,23 +427,56 @@ class Command(BaseCommand):
         @type  stretch: bool
 
         @return: Set of sizes to use
-        @rtype:  set([Size, ...])
+        @rtype:  [Size, ...]
         """
         sizes = []
-        orig_width, orig_height = cd_image.image.width, cd_image.image.height
-        for size in cd_image.size_set.size_set.all():
+        orig_width, orig_height = cd_image.dimensions
+        for size in registry.sizes(cd_image.size_set_id):
 
             # Filter out thumbnail sizes which are larger than the original
             if stretch or (orig_width >= size.width and 
                            orig_height >= size.height):
+                sizes.append(size)
+        return sizes
+
+    def render_object(self, task):
+        """
+        Regenerates the thumbnails of every cropduster image on an object.
+
+        @param task: Object to render
+        @type  task: Task
+
+        @return: Number of images, thumbnails written and bytes written
+        @rtype:  (int, int, int)
+        """
+        model = get_model(task.app_label, task.model_name)
+        try:
+            obj = model._default_manager.get(pk=task.pk)
+        except model.DoesNotExist:
+            # Deleted since its key was read
+            return 0, 0, 0
+
+        images = thumbnails = bytes = 0
+        for field_name in task.field_names:
+
+            # Sanity check; we really should have a cropduster image here.
+            cd_image = getattr(obj, field_name)
+            if not (cd_image and isinstance(cd_image, CropDusterImage)):
+                continue
 
-                sizes.append( Size(size.slug,
-                                   cd_image.thumbnail_path(size),
-                                   size.auto_size,
-                                   size.width,
-                                   size.height) )
-        return set(sizes)
+            logging.info("Processing image %s" % cd_image.image.name)
 
+            # Images saved before the manifest and checksum were kept get them 
+            # here, rather than while pages are being rendered
+            cd_image.backfill()
+            sizes = self.get_sizes(cd_image, task.stretch)
+            written = self.resize_image(cd_image, sizes, task.force, task.changed)
+
+            images += 1
+            thumbnails += len(written)
+            bytes += sum(thumb.bytes for thumb in written)
+
+        return images, thumbnails, bytes
 
     def setup_logging(self, options):
         """
@@ -206,31 +484,59 @@ class Command(BaseCommand):
         """
         logging.basicConfig(filename=options['logfile'],
                             level = getattr(logging, options['loglevel'].upper()),
-                            format="%(asctime)s %(levelname)s %(message)s")
+                            format="%(asctime)s %(process)d %(levelname)s %(message)s")
 
         # Add stdout to logging, useful for short query sets.
-        if 'stdout' in options:
+        if options['stdout']:
             formatter = logging.root.handlers[0].formatter
             sh = logging.StreamHandler(sys.stdout)
             sh.formatter = formatter
             logging.root.addHandler( sh )
+
+    def get_keys(self, query, chunk_size):
+        """
+        Streams the primary keys of a queryset in order, a chunk at a time, so 
+        that huge tables never have to be loaded into memory at once.
+
+        @param query: Objects to get the keys of.
+        @type  query: QuerySet
+
+        @param chunk_size: Number of keys to fetch per query.
+        @type  chunk_size: positive int
+
+        @return: Generator yielding primary keys
+        @rtype:  <int, ...>
+        """
+        last_pk = None
+        while True:
+            chunk = query.order_by('pk')
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            keys = list(chunk.values_list('pk', flat=True)[:chunk_size])
+            if not keys:
+                return
+
+            for pk in keys:
+                yield pk
+            last_pk = keys[-1]
     
-    def get_images(self, apps, query_set, stretch):
+    def get_tasks(self, apps, options, checkpoint):
         """
-        Returns all original images and sizes for the given apps and query sets.
+        Returns a task for every object with cropduster images in the given apps
+        and query sets, after any already finished in the checkpoint.  Those 
+        that failed in it come first.
         
         @param apps: Set of django apps to resize.
         @type  apps: ["app:[model[.field]]", ..]
         
-        @param query_set: query_set to retrieve objects with.
-        @type  query_set: str.
-        
-        @param stretch: Whether or not to include sizes with dimensions larger 
-                        than the original image size.
-        @type  stretch: bool
+        @param options: Command options
+        @type  options: dict
 
-        @return: Generator yielding the raw Image and its sizes
-        @rtype: < (PIL.Image, [set([Size1, ...])), ... >
+        @param checkpoint: Progress so far
+        @type  checkpoint: Checkpoint
+
+        @return: Generator yielding a task per object
+        @rtype: < Task, ... >
         """
         # Figures out the models and cropduster fields on them
         for model, field_names in to_CE(apputils.resolve_apps, apps):
@@ -238,109 +544,144 @@ class Command(BaseCommand):
             logging.info("Processing model %s with fields %s" % (model, field_names))
 
             # Returns the queryset for each model
-            query = self.get_queryset(model, query_set)
+            query = self.get_queryset(model, options['query_set'])
             logging.info("Queryset return %i objects" % query.count())
-            for obj in query:
 
-                for field_name in field_names:
+            task = Task(model._meta.app_label,
+                        model._meta.object_name,
+                        None,
+                        tuple(field_names),
+                        options['force'],
+                        options['changed'],
+                        options['stretch'],
+                        1)
 
-                    # Sanity check; we really should have a cropduster image here.
-                    cd_image = getattr(obj, field_name)
-                    if not (cd_image and isinstance(cd_image, CropDusterImage)):
-                        continue
+            # Objects that failed in the run being resumed are tried again first
+            for pk in checkpoint.retry(task):
+                yield task._replace(pk=pk)
 
-                    file_name = cd_image.image.path
-                    logging.info("Processing image %s" % file_name)
-                    try:
-                        image = Image.open(file_name)
-                    except IOError:
-                        logging.warning('Could not open image %s' % file_name)
-                        continue
+            last_pk = checkpoint.last_pk(task)
+            if last_pk is not None:
+                logging.info("Resuming after primary key %s" % last_pk)
+                query = query.filter(pk__gt=last_pk)
 
-                    sizes = self.get_sizes(cd_image, stretch)
-                    #self.resize_image(image, sizes, options['force'])
-                    yield image, sizes
+            for pk in self.get_keys(query, options['chunk_size']):
+                yield task._replace(pk=pk)
 
-    def wait_all(self, proc_list):
-        """
-        Wait for all child procs to finish.
+    def resize_parallel(self, tasks, options, checkpoint):
         """
-        while True:
-            try:
-                os.wait()
-            except OSError,e:
-                # Excellent, no longer waiting on a child proc
-                if e.errno == 10:
-                    return
-                raise
-
-    def wait_one(self, proc_list):
-        """
-        Waits for any process to finish.  If any child terminated
-        abnormally, raise an OSError.
+        Resizes images in a pool of worker processes, which open the images
+        themselves.  Only a few tasks per worker are handed out at a time, so 
+        that the keys are streamed from the database as the workers need them. 
+        Objects that fail are retried, then reported at the end.  So are 
+        objects that get no result within --task_timeout, such as those whose
+        worker was killed, as the pool never reports those.
+
+        @param tasks: Iterator yielding the objects to resize.
+        @type  tasks: <Task, ...>
+        
+        @param options: Command options
+        @type  options: dict
 
-        @param proc_list: Set of child procs.
-        @type  proc_list: set(int, ...)
+        @param checkpoint: Progress so far, which is saved with every report.
+        @type  checkpoint: Checkpoint
 
-        @return: 
-        @rtype: 
-        """
-        pid, code = os.wait()
-        proc_list.remove(pid)
-        # If an error
-        if code > 0:
-            self.wait_all(proc_list)
-            raise OSError('Process %i died with %i' % (pid, code))
-
-    def resize_parallel(self, images, force, total_procs):
-        """
-        Resizes images in parallel.  
-        
-        Why not use multiprocessing?  First reason is that we don't care 
-        about return values, which makes the synchronization for Pool objects 
-        more than we need.
-
-        Secondly, Process() has issues with KeyboardInterrupt exceptions,
-        which is a bummer when testing. Further, we never know which Process 
-        finishes first without using os.wait, which at that point we have 
-        what we have below.  The other option would be to loop through each
-        process, calling its join() method with a timeout, which  basically
-        turns the parent process into a spin lock.
-
-        Thirdly, we want to throw away our process when we are done with each
-        image.  Forking is cheap due to copy-on-write, and this keeps the 
-        memory consumption down.
-
-        @param images: Iterator yield images with their size set.
-        @type  images: ((image, sizes), ...]
-        
-        @param force: Whether or not resize images which already exist.
-        @type  force: bool
-        
-        @param total_procs: Total number of processes to use.
-        @type  total_procs: positive int
+        @return: Totals for the run.
+        @rtype:  Stats
         """
-        proc_list = set()
-        try:
-            for image, size in images:
-                if len(proc_list) == total_procs:
-                    self.wait_one(proc_list)
-           
-                pid = os.fork()
-                if pid:
-                    proc_list.add(pid)
+        stats = checkpoint.stats
+        results = Queue()
+
+        procs = max(options['procs'], 1)
+        if procs > 1:
+            # Workers must not share the parent's database connections
+            for connection in connections.all():
+                connection.close()
+
+            pool = multiprocessing.Pool(procs,
+                                        initializer=init_worker,
+                                        maxtasksperchild=options['max_tasks'] or None)
+            submit = lambda task: pool.apply_async(render_object, (task,), callback=results.put)
+            max_in_flight = procs * 4
+        else:
+            pool = None
+            submit = lambda task: results.put(render_object(task))
+            max_in_flight = 1
+
+        # When each task in flight was submitted
+        in_flight = {}
+        given_up = [False]
+        last_report = [time.time()]
+
+        def wait():
+            """
+            Waits for the next result, or makes up a failed one for a task 
+            that has gone without one for too long.
+            """
+            while True:
+                try:
+                    result = results.get(timeout=1)
+                except Empty:
+                    now = time.time()
+                    for task, submitted in in_flight.items():
+                        if now - submitted > options['task_timeout']:
+                            given_up[0] = True
+                            return Result(task, 0, 0, 0, 'No result after %is, the worker may have been killed' % (now - submitted))
                     continue
 
-                # The child carries on
-                try:
-                    self.resize_image(image, size, force)
-                except:
-                    # Any error, doesn't matter what, must get caught.
-                    os._exit(1)
-                os._exit(0)
+                # Results of tasks already given up on are dropped
+                if result.task in in_flight:
+                    return result
+
+        def collect():
+            result = wait()
+            del in_flight[result.task]
+
+            if result.error and result.task.attempt <= options['retries']:
+                logging.warning('Retrying %s %s: %s' % (result.task.model_name, result.task.pk, result.error))
+                task = result.task._replace(attempt=result.task.attempt + 1)
+                in_flight[task] = time.time()
+                submit(task)
+                return
+
+            stats.add(result)
+            checkpoint.done(result.task, failed=bool(result.error))
+            if result.error:
+                logging.error('Failed %s %s: %s' % (result.task.model_name, result.task.pk, result.error))
+
+            if time.time() - last_report[0] >= options['report_every']:
+                logging.info(stats.report())
+                checkpoint.save()
+                last_report[0] = time.time()
+
+        try:
+            for task in tasks:
+                while len(in_flight) >= max_in_flight:
+                    collect()
+                in_flight[task] = time.time()
+                checkpoint.submitted(task)
+                submit(task)
+
+            while in_flight:
+                collect()
+            checkpoint.complete = True
+        except KeyboardInterrupt:
+            if pool is not None:
+                pool.terminate()
+                pool = None
+            raise
         finally:
-            # wait for the kids to finish, no zombies for us.
-            self.wait_all()
+            # wait for the workers to finish, no zombies for us.  The pool 
+            # waits forever for the results of tasks given up on.
+            if pool is not None:
+                if given_up[0]:
+                    pool.terminate()
+                else:
+                    pool.close()
+                pool.join()
+            checkpoint.save()
+
+        return stats
 
     @PrettyError("Failed to regenerate thumbs: %(error)s")
     def handle(self, *apps, **options):
@@ -351,9 +692,38 @@ class Command(BaseCommand):
         
         self.setup_logging(options)
 
-        # Get all images
-        images = self.get_images(apps, options['query_set'], options['stretch'])
+        checkpoint = Checkpoint(options['checkpoint_file'], Stats())
+        if options['resume']:
+            if not checkpoint.load():
+                raise CommandError('No checkpoint to resume at %s' % options['checkpoint_file'])
+            if checkpoint.complete and not checkpoint.failed:
+                sys.stdout.write("Already complete: %s\n" % checkpoint.stats.report())
+                return
+            checkpoint.complete = False
+
+            # Carry on with the same objects as before
+            apps = checkpoint.args['apps']
+            for name in ('query_set', 'force', 'changed', 'stretch'):
+                options[name] = checkpoint.args.get(name, options[name])
+            logging.info("Resuming from %s" % checkpoint.stats.report())
+        else:
+            checkpoint.args = dict(apps=apps,
+                                   query_set=options['query_set'],
+                                   force=options['force'],
+                                   changed=options['changed'],
+                                   stretch=options['stretch'])
+
+        # Get all objects with images
+        tasks = self.get_tasks(apps, options, checkpoint)
 
         # Go to town on the images.
-        self.resize_parallel(images, options['force'], options['procs'])
-
+        stats = self.resize_parallel(tasks, options, checkpoint)
+
+        logging.info(stats.report())
+        for result in stats.failures:
+            logging.error('Failed %s.%s %s: %s' % (result.task.app_label,
+                                                  result.task.model_name,
+                                                  result.task.pk,
+                                                  result.error))
+        # --stdout takes the place of the command's own stdout in the options
+        sys.stdout.write(stats.report() + "\n")
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RenderJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('status', models.CharField(default=b'pending', max_length=10, db_index=True, choices=[(b'pending', b'Pending'), (b'running', b'Running'), (b'done', b'Done'), (b'failed', b'Failed')])),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('claimed_at', models.DateTimeField(null=True, blank=True)),
+                ('error', models.TextField(default=b'', blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('crop', models.ForeignKey(related_name='render_jobs', blank=True, to='cropduster.Crop', null=True)),
+                ('image', models.ForeignKey(related_name='render_jobs', to='cropduster.Image')),
+            ],
+            options={
+                'db_table': 'cropduster_renderjob',
+            },
+            bases=(models.Model,),
+        ),
+    ]
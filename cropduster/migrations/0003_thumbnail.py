@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0002_renderjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Thumbnail',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('slug', models.CharField(max_length=60)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('bytes', models.PositiveIntegerField()),
+                ('mtime', models.FloatField()),
+                ('source_checksum', models.CharField(max_length=32)),
+                ('image', models.ForeignKey(related_name='thumbnails', to='cropduster.Image')),
+            ],
+            options={
+                'db_table': 'cropduster_thumbnail',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='thumbnail',
+            unique_together=set([('image', 'slug')]),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='checksum',
+            field=models.CharField(default=b'', max_length=32, editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='thumbnails_scanned',
+            field=models.BooleanField(default=False, editable=False),
+            preserve_default=True,
+        ),
+    ]
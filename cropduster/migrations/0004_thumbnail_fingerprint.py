@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0003_thumbnail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumbnail',
+            name='fingerprint',
+            field=models.CharField(default='', max_length=32, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0004_thumbnail_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='size',
+            name='formats',
+            field=models.CharField(default='', help_text=b'Comma separated formats to save thumbs in as well, such as webp,avif', max_length=50, verbose_name=b'Also save as', blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0005_size_formats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='size',
+            name='quality',
+            field=models.PositiveSmallIntegerField(help_text=b'1-100 for JPEG, WebP and AVIF thumbs.  Defaults to 95', null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='size',
+            name='progressive',
+            field=models.BooleanField(default=False, verbose_name=b'Progressive JPEG'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='size',
+            name='optimize',
+            field=models.BooleanField(default=False, help_text=b'Smaller JPEG and PNG thumbs, but slower to save'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='size',
+            name='subsampling',
+            field=models.CharField(default=b'', max_length=5, verbose_name=b'JPEG chroma subsampling', blank=True, choices=[(b'', b'Default'), (b'4:4:4', b'4:4:4, none'), (b'4:2:2', b'4:2:2, half horizontally'), (b'4:2:0', b'4:2:0, half both ways')]),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='size',
+            name='compress_level',
+            field=models.PositiveSmallIntegerField(help_text=b'0-9', null=True, verbose_name=b'PNG compression level', blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='size',
+            name='strip_metadata',
+            field=models.BooleanField(default=True, help_text=b"Leave the original's EXIF data and color profile out of thumbs"),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0006_size_encoder_settings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='size',
+            name='srcset',
+            field=models.CharField(default=b'', help_text=b'Comma separated pixel densities such as 1.5x,3x, or widths such as 480w,1200w, to make thumbs at for srcset', max_length=100, verbose_name=b'Responsive versions', blank=True),
+            preserve_default=True,
+        ),
+    ]
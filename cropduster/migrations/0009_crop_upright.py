@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0008_image_metadata'),
+    ]
+
+    operations = [
+        # crops drawn until now are of the image as stored
+        migrations.AddField(
+            model_name='crop',
+            name='upright',
+            field=models.BooleanField(default=False, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='crop',
+            name='upright',
+            field=models.BooleanField(default=True, editable=False),
+            preserve_default=True,
+        ),
+    ]
@@ -1,13 +1,20 @@
 from django.db import models
 from django.conf import settings
-import os, copy
-from cropduster import utils
+from django.core.files.storage import get_storage_class
+import os, re, copy, hashlib
+from collections import OrderedDict
+from cropduster import utils, jobs, locks
+from cropduster.registry import registry, ratio_key
 from PIL import Image as pil
 # from south.modelsinspector import add_introspection_rules
 from django.core.exceptions import ValidationError
+from django.db.models.signals import post_save, post_delete
+from cropduster.caching import CachingMixin, CachingManager, uncached, invalidate
 
 
 CROPDUSTER_UPLOAD_PATH = getattr(settings, "CROPDUSTER_UPLOAD_PATH", settings.MEDIA_ROOT)
+CROPDUSTER_FSYNC = getattr(settings, "CROPDUSTER_FSYNC", False)
+CROPDUSTER_STORAGE = getattr(settings, "CROPDUSTER_STORAGE", None)
 
 IMAGE_SAVE_PARAMS =  {
 	"quality" :95
@@ -23,12 +30,90 @@ GENERATION_CHOICES = (
 	(AUTO_SIZE, "Auto-Size"),
 )
 
+SUBSAMPLING_CHOICES = (
+	("", "Default"),
+	("4:4:4", "4:4:4, none"),
+	("4:2:2", "4:2:2, half horizontally"),
+	("4:2:0", "4:2:0, half both ways"),
+)
+
 RETINA_POSTFIX = "@2x"
 
+# srcset descriptors a size can have responsive versions at: pixel densities such as 1.5x, or widths such as 480w
+DESCRIPTOR_RE = re.compile(r"^(\d+(\.\d+)?x|\d+w)$")
+
+# Formats that thumbnails can also be saved in, alongside the original's, 
+# by extension: (PIL format, mimetype)
+OUTPUT_FORMATS = OrderedDict([
+	("webp", ("WEBP", "image/webp")),
+	("avif", ("AVIF", "image/avif")),
+])
+
+
+def thumbnail_slug(size_slug, retina=False, extension=None):
+	""" Manifest slug of a thumbnail: the size's slug, plus the retina postfix, plus the extension if it's in another format """
+	if retina:
+		size_slug += RETINA_POSTFIX
+	if extension:
+		size_slug += "." + extension
+	return size_slug
+
+def split_thumbnail_slug(slug):
+	""" The slug of the size or version a manifest slug is for, and its extension if it's in another format """
+	version_slug, extension = os.path.splitext(slug)
+	if extension[1:] in OUTPUT_FORMATS:
+		return version_slug, extension[1:]
+	# no extension, or the decimal point of a descriptor such as @1.5x
+	return slug, None
+
+
+def required_dimensions(sizes):
+	""" Gets the largest width and height needed to render all of the sizes, including retina and responsive thumbs """
+	
+	width = height = 0
+	for size in sizes:
+		largest = size.versions[0]
+		width = max(width, largest.width or 0)
+		height = max(height, largest.height or 0)
+		
+	return width, height
+
+
+def fits(size, source_size):
+	""" Whether a size can be rendered from an image of source_size without enlarging it """
+	return (size.width or 0) <= source_size[0] and (size.height or 0) <= source_size[1]
+
+
+def prefetch_images(images):
+	""" 
+	Loads the size sets, crops and thumbnail manifests for many images in a
+	fixed number of queries, so that rendering them doesn't query per image
+	"""
+	images = [image for image in images if image]
+	if not images:
+		return images
+		
+	size_set_ids = set(image.size_set_id for image in images)
+	image_ids = set(image.id for image in images)
+	
+	size_sets = SizeSet.objects.in_bulk(size_set_ids)
+	
+	crops = dict((image_id, []) for image_id in image_ids)
+	for crop in Crop.objects.filter(image__in=image_ids).select_related("size"):
+		crops[crop.image_id].append(crop)
+		
+	manifests = dict((image_id, {}) for image_id in image_ids)
+	for thumb in Thumbnail.objects.filter(image__in=image_ids):
+		manifests[thumb.image_id][thumb.slug] = thumb
+	
+	size_set_cache = Image._meta.get_field("size_set").get_cache_name()
+	for image in images:
+		setattr(image, size_set_cache, size_sets.get(image.size_set_id))
+		image._crops = crops[image.id]
+		image._thumbnail_manifest = manifests[image.id]
+		
+	return images
 
-class CachingMixin(object):
-	pass
-CachingManager = models.Manager
 
 class SizeSet(CachingMixin, models.Model):
 	objects = CachingManager()
@@ -46,13 +131,13 @@ class SizeSet(CachingMixin, models.Model):
 		"""
 		create_on_request =  not created
 		
-		size_query = Size.objects.all().filter(size_set__id=self.id, create_on_request=create_on_request)
+		# sizes come widest first, so this keeps the largest size of each ratio
+		sizes = {}
+		for size in registry.sizes(self.id):
+			if size.create_on_request == create_on_request:
+				sizes.setdefault(ratio_key(size.aspect_ratio), size)
 		
-		size_query.query.group_by = ["aspect_ratio"]
-		try:
-			return size_query
-		except ValueError:
-			return None
+		return sorted(sizes.values(), key=lambda size: size.aspect_ratio, reverse=True)
 
 
 class SizeManager(CachingManager):
@@ -60,17 +145,17 @@ class SizeManager(CachingManager):
 	def get_size_by_ratio(self, size_set, aspect_ratio_id):
 		""" Gets the largest image of a certain ratio in this size set """
 		
-		size_query = self.all().only("aspect_ratio").filter(size_set=size_set, auto_size=MANUALLY_CROP).order_by("-aspect_ratio")
+		size_set_id = getattr(size_set, "id", size_set)
 		
-		size_query.query.group_by = ["aspect_ratio"]
-
 		try:
-			size = size_query[aspect_ratio_id]
-			
-			# get the largest size with this aspect ratio
-			return self.all().filter(size_set=size_set, aspect_ratio=size.aspect_ratio, auto_size=MANUALLY_CROP).order_by("-width")[0]
+			aspect_ratio = registry.ratios(size_set_id, auto_size=MANUALLY_CROP)[aspect_ratio_id]
 		except IndexError:
 			return None
+		
+		# get the largest size with this aspect ratio
+		for size in registry.sizes_by_ratio(size_set_id, aspect_ratio):
+			if size.auto_size == MANUALLY_CROP:
+				return size
 
 class Size(CachingMixin, models.Model):
 	
@@ -94,6 +179,40 @@ class Size(CachingMixin, models.Model):
 	
 	retina = models.BooleanField("Auto-create retina thumb", default=False,)
 	
+	formats = models.CharField(
+		"Also save as", 
+		max_length=50, 
+		blank=True, 
+		default="", 
+		help_text="Comma separated formats to save thumbs in as well, such as webp,avif"
+	)
+	
+	# Encoder settings, so that sizes can trade saving time for bytes
+	
+	quality = models.PositiveSmallIntegerField(
+		blank=True, 
+		null=True, 
+		help_text="1-100 for JPEG, WebP and AVIF thumbs.  Defaults to %s" % IMAGE_SAVE_PARAMS["quality"]
+	)
+	
+	progressive = models.BooleanField("Progressive JPEG", default=False)
+	
+	optimize = models.BooleanField(default=False, help_text="Smaller JPEG and PNG thumbs, but slower to save")
+	
+	subsampling = models.CharField("JPEG chroma subsampling", max_length=5, blank=True, default="", choices=SUBSAMPLING_CHOICES)
+	
+	compress_level = models.PositiveSmallIntegerField("PNG compression level", blank=True, null=True, help_text="0-9")
+	
+	strip_metadata = models.BooleanField(default=True, help_text="Leave the original's EXIF data and color profile out of thumbs")
+	
+	srcset = models.CharField(
+		"Responsive versions", 
+		max_length=100, 
+		blank=True, 
+		default="", 
+		help_text="Comma separated pixel densities such as 1.5x,3x, or widths such as 480w,1200w, to make thumbs at for srcset"
+	)
+	
 	def clean(self):
 		if not (self.width or self.height):
 			raise ValidationError("Size requires either a width, a height, or both")
@@ -102,6 +221,26 @@ class Size(CachingMixin, models.Model):
 			# Raise a validation error if one of the sizes is not set for cropping.
 			# Auto-crop is the only one that can take a missing size.
 			raise ValidationError("Auto-crop requires both sizes be specified")
+			
+		for extension in self.formats.split(","):
+			extension = extension.strip().lower()
+			if extension and extension not in OUTPUT_FORMATS:
+				raise ValidationError("Unknown format %s, use one of %s" % (extension, ", ".join(OUTPUT_FORMATS)))
+				
+		if self.quality is not None and not 1 <= self.quality <= 100:
+			raise ValidationError("Quality must be from 1 to 100")
+			
+		if self.compress_level is not None and not 0 <= self.compress_level <= 9:
+			raise ValidationError("PNG compression level must be from 0 to 9")
+			
+		descriptors = [descriptor.strip() for descriptor in self.srcset.split(",") if descriptor.strip()]
+		for descriptor in descriptors:
+			if not DESCRIPTOR_RE.match(descriptor):
+				raise ValidationError("Responsive versions must be like 1.5x or 480w, not %s" % descriptor)
+		if len(set(descriptor[-1] for descriptor in descriptors)) > 1:
+			raise ValidationError("Responsive versions must be all pixel densities or all widths")
+		if self.auto_size == AUTO_SIZE and not self.width and any(descriptor.endswith("w") for descriptor in descriptors):
+			raise ValidationError("Responsive widths need the size to have a width")
 	
 	def save(self, *args, **kwargs):
 		self.aspect_ratio = utils.aspect_ratio(self.width, self.height)
@@ -114,15 +253,99 @@ class Size(CachingMixin, models.Model):
 		return u"%s: %sx%s" % (self.name, self.width, self.height)
 
 	
+	@property
+	def encoder_settings(self):
+		""" The encoder settings that have been changed from their defaults """
+		changed = {}
+		for field_name in ("quality", "progressive", "optimize", "subsampling", "compress_level", "strip_metadata"):
+			value = getattr(self, field_name)
+			if value != self._meta.get_field(field_name).get_default():
+				changed[field_name] = value
+		return changed
+	
+	def save_params(self, format, thumbnail=None):
+		""" Keyword arguments for saving a thumb of this size with PIL in a format, keeping the thumbnail's metadata if asked """
+		params = dict(IMAGE_SAVE_PARAMS, format=format)
+		if self.quality:
+			params["quality"] = self.quality
+			
+		if format == "JPEG":
+			if self.progressive:
+				params["progressive"] = True
+			if self.optimize:
+				params["optimize"] = True
+			if self.subsampling:
+				params["subsampling"] = self.subsampling
+		elif format == "PNG":
+			if self.optimize:
+				params["optimize"] = True
+			if self.compress_level is not None:
+				params["compress_level"] = self.compress_level
+				
+		if not self.strip_metadata and thumbnail is not None:
+			for key in ("icc_profile", "exif"):
+				if thumbnail.info.get(key):
+					params[key] = thumbnail.info[key]
+		return params
+	
+	@property
+	def output_formats(self):
+		""" Extensions of the other formats to save thumbs in, leaving out any this PIL can't write """
+		extensions = [extension.strip().lower() for extension in self.formats.split(",")]
+		return [
+			extension for extension in OUTPUT_FORMATS 
+			if extension in extensions and utils.can_save(OUTPUT_FORMATS[extension][0])
+		]
+	
 	@property
 	def retina_size(self):
 		""" Returns a Size object based on the current object but for the retina size """
 		retina_size = copy.copy(self)
-		retina_size.width = retina_size.width * 2
-		retina_size.height = retina_size.height * 2
+		retina_size.width = self.width and self.width * 2
+		retina_size.height = self.height and self.height * 2
 		retina_size.slug = u"%s%s" % (retina_size.slug, RETINA_POSTFIX)
 
 		return retina_size
+		
+	@property
+	def descriptors(self):
+		""" The srcset descriptors of the size's responsive versions, other than the retina one """
+		descriptors = []
+		for descriptor in self.srcset.split(","):
+			descriptor = descriptor.strip()
+			if DESCRIPTOR_RE.match(descriptor) and descriptor not in descriptors and descriptor != "1x":
+				if not (self.retina and RETINA_POSTFIX == "@" + descriptor):
+					descriptors.append(descriptor)
+		return descriptors
+		
+	def get_variant(self, descriptor):
+		""" Returns a Size object based on the current object but for a responsive version, such as 1.5x or 480w """
+		if descriptor.endswith("w"):
+			scale = float(descriptor[:-1]) / self.width
+		else:
+			scale = float(descriptor[:-1])
+		
+		variant = copy.copy(self)
+		variant.width = self.width and int(round(self.width * scale))
+		variant.height = self.height and int(round(self.height * scale))
+		variant.slug = u"%s@%s" % (self.slug, descriptor)
+		variant.descriptor = descriptor
+		return variant
+		
+	@property
+	def variants(self):
+		""" Size objects for the size's responsive versions, other than the retina one """
+		return [self.get_variant(descriptor) for descriptor in self.descriptors]
+		
+	@property
+	def versions(self):
+		""" The size itself with its retina and responsive versions, largest first """
+		versions = [self] + ([self.retina_size] if self.retina else []) + self.variants
+		return sorted(versions, key=lambda version: (version.width or 0, version.height or 0), reverse=True)
+		
+	def versions_within(self, source_size):
+		""" The versions that can be rendered from an image of source_size, always including the size itself """
+		return [version for version in self.versions if version is self or fits(version, source_size)]
 
 class Crop(CachingMixin, models.Model):
 	class Meta:
@@ -136,6 +359,10 @@ class Crop(CachingMixin, models.Model):
 	crop_w = models.PositiveIntegerField(default=0, blank=True, null=True)
 	crop_h = models.PositiveIntegerField(default=0, blank=True, null=True)
 	
+	# Whether the crop is of the image turned upright for its EXIF orientation, as crops drawn 
+	# since orientations were read are. Older ones are of the image as stored
+	upright = models.BooleanField(default=True, editable=False)
+	
 	size = models.ForeignKey(
 		"cropduster.Size", 
 		related_name = "size",
@@ -152,34 +379,56 @@ class Crop(CachingMixin, models.Model):
 
 
 	def save(self, *args, **kwargs):
-		""" 
-		Save the Crop object, and create the thumbnails by creating 
-		one rescaled version for each ratio and then resizing for each 
-		thumbnail within that ratio
-		"""
+		""" Save the Crop object, and queue creating the thumbnails for its aspect ratio """
 		super(Crop, self).save(*args, **kwargs)
 
 		if self.size:
-			# get all the manually cropped sizes with the same aspect ratio as this crop/size
-			sizes = Size.objects.all().filter(
-				aspect_ratio=self.size.aspect_ratio, 
-				size_set=self.size.size_set,
-				auto_size=0,
-			).order_by("-width")
+			jobs.enqueue(self.image, crop=self)
 			
-			if sizes:
-				# create the cropped image 
+	@uncached()
+	def create_thumbnails(self):
+		""" 
+		Create the thumbnails by creating one rescaled version for each ratio 
+		and then resizing for each thumbnail within that ratio
+		"""
+		# get all the manually cropped sizes with the same aspect ratio as this crop/size
+		sizes = [
+			size for size in registry.sizes_by_ratio(self.size.size_set_id, self.size.aspect_ratio)
+			if size.auto_size == MANUALLY_CROP
+		]
+		
+		if sizes:
+			# create the cropped image, decoded no larger than the largest size needs
+			min_width, min_height = required_dimensions(sizes)
+			with self.image.source as source:
 				cropped_image = utils.create_cropped_image(
-					self.image.path, 
+					source, 
 					self.crop_x, 
 					self.crop_y, 
 					self.crop_w, 
-					self.crop_h
+					self.crop_h,
+					min_width=min_width,
+					min_height=min_height,
+					orientation=self.image.orientation,
+					upright=self.upright,
 				)
+			
+			# loop through the other sizes of the same aspect ratio, and create those crops
+			return self.image.rescale_sizes(cropped_image, sizes, crop=self)
+		return []
+		
+	def turn_upright(self):
+		""" Moves a crop drawn on the image as stored onto the image turned upright, for the cropper to show and save it there """
+		if not self.upright:
+			if self.image.width and self.image.height:
+				left, top, right, bottom = utils.upright_box(
+					(self.crop_x, self.crop_y, self.crop_x + self.crop_w, self.crop_y + self.crop_h),
+					(self.image.width, self.image.height),
+					self.image.orientation,
+				)
+				self.crop_x, self.crop_y, self.crop_w, self.crop_h = left, top, right - left, bottom - top
+			self.upright = True
 				
-				# loop through the other sizes of the same aspect ratio, and create those crops
-				for size in sizes:
-					self.image.rescale(cropped_image, size=size)
 	def clean(self):
 	
 		if not hasattr(self, "crop_x") or not hasattr(self, "crop_y"):
@@ -201,7 +450,9 @@ class Image(CachingMixin, models.Model):
 	image = models.ImageField(
 		upload_to=CROPDUSTER_UPLOAD_PATH + "%Y/%m/%d", 
 		max_length=255, 
-		db_index=True
+		db_index=True,
+		# originals and thumbnails go in DEFAULT_FILE_STORAGE unless this is set
+		storage=get_storage_class(CROPDUSTER_STORAGE)() if CROPDUSTER_STORAGE else None,
 	)
 	
 	size_set = models.ForeignKey(
@@ -212,6 +463,29 @@ class Image(CachingMixin, models.Model):
 	
 	caption = models.CharField(max_length=255, blank=True, null=True)
 	
+	# Read from the original when it's uploaded, so nothing has to open it again for them
+	width = models.PositiveIntegerField(blank=True, null=True, editable=False)
+	
+	height = models.PositiveIntegerField(blank=True, null=True, editable=False)
+	
+	orientation = models.PositiveSmallIntegerField("EXIF orientation", blank=True, null=True, editable=False)
+	
+	taken = models.DateTimeField("Capture time", blank=True, null=True, editable=False, db_index=True)
+	
+	camera = models.CharField(max_length=255, blank=True, default="", editable=False)
+	
+	latitude = models.FloatField(blank=True, null=True, editable=False)
+	
+	longitude = models.FloatField(blank=True, null=True, editable=False)
+	
+	color_space = models.CharField(max_length=20, blank=True, default="", editable=False)
+	
+	# MD5 of the original, read when it's saved, so that writing thumbnails doesn't read the whole file
+	checksum = models.CharField(max_length=32, blank=True, default="", editable=False)
+	
+	# Whether thumbnails rendered before the manifest existed have been looked for in storage
+	thumbnails_scanned = models.BooleanField(default=False, editable=False)
+	
 	class Meta:
 		db_table = "cropduster_image"
 		verbose_name = "Image"
@@ -232,18 +506,40 @@ class Image(CachingMixin, models.Model):
 	@property
 	def extension(self):
 		if hasattr(self.image, "url"):
-			file_root, extension = os.path.splitext(self.image.path)
+			file_root, extension = os.path.splitext(self.image.name)
 			return extension
 		else:
 			return ""
+			
+	@property
+	def storage(self):
+		""" Storage the original and its thumbnails are kept in """
+		return self.image.storage
+		
 	@property
 	def path(self):
-		""" Path to the original image file """
+		""" Path to the original image file, only for storages on the local filesystem """
 		return self.image.path
 		
+	@property
+	def source(self):
+		""" Context giving the original image file to render from: its local path if it has one, otherwise the file opened from storage """
+		return utils.open_source(self.storage, self.image.name)
+		
+	@property
+	def folder_name(self):
+		""" Storage name of the folder containing the thumbnails, named after the original """
+		return os.path.splitext(self.image.name)[0]
+		
+	def thumbnail_name(self, size_slug, retina=False, extension=None):
+		""" Storage name of a thumbnail based on the slug, in the original's format unless given another extension """
+		if retina:
+			size_slug += RETINA_POSTFIX
+		return os.path.join(self.folder_name, size_slug + ("." + extension if extension else self.extension))
+		
 	@property
 	def folder_path(self):
-		""" System path to the folder containing the thumbnails """
+		""" System path to the folder containing the thumbnails, only for storages on the local filesystem """
 		file_path, file_name = os.path.split(self.image.path)
 		file_root, extension = os.path.splitext(file_name)
 		return u"%s" % os.path.join(file_path, file_root)
@@ -270,12 +566,12 @@ class Image(CachingMixin, models.Model):
 		else:
 			return ""
 		
-	def thumbnail_url(self, size_slug, retina=False):
-		""" Web URL for a thumbnail based on the size slug """
+	def thumbnail_url(self, size_slug, retina=False, extension=None):
+		""" Web URL for a thumbnail based on the size slug, in the original's format unless given another extension """
 		format = u"%s%s"
 		if retina:
 			format = u"%s" + RETINA_POSTFIX + "%s"
-		return format % (os.path.join(self.folder_url, size_slug), self.extension)
+		return format % (os.path.join(self.folder_url, size_slug), "." + extension if extension else self.extension)
 
 		
 	def retina_thumbnail_url(self, size_slug):
@@ -283,8 +579,197 @@ class Image(CachingMixin, models.Model):
 		return self.thumbnail_url(size_slug, retina=True)
 		
 			
+	def read_checksum(self, f=None):
+		""" Sets the checksum field to the MD5 of the original, or of f, an open copy of it such as the upload """
+		if f is None:
+			if not self.image._committed:
+				# a new file, not in storage yet
+				return self.read_checksum(self.image.file)
+			with self.storage.open(self.image.name, "rb") as f:
+				return self.read_checksum(f)
+		
+		checksum = hashlib.md5()
+		f.seek(0)
+		for chunk in iter(lambda: f.read(1024 * 1024), b""):
+			checksum.update(chunk)
+		f.seek(0)
+		self.checksum = checksum.hexdigest()
+	
+	def store(self, **fields):
+		""" Sets fields and writes them straight to the row, without the rest of saving """
+		for name, value in fields.items():
+			setattr(self, name, value)
+		if self.pk is not None:
+			Image.objects.filter(pk=self.pk).update(**fields)
+			invalidate(Image, self)
+	
+	def source_stat(self):
+		""" The size and modification time of the original, as (bytes, mtime) """
+		return utils.storage_stat(self.storage, self.image.name)
+		
+	def thumbnail_fingerprint(self, size, crop=None, source_stat=None):
+		""" 
+		Hash of everything a size's thumbnail is rendered from: the original file, the crop, 
+		the size's dimensions and the save parameters. If it changes, the thumbnail is out of date.
+		Pass the original's source_stat() when fingerprinting several sizes, so it's only taken once
+		"""
+		source_bytes, source_mtime = source_stat or self.source_stat()
+		parts = [self.image.name, source_bytes, int(source_mtime)]
+		if crop is not None:
+			parts += [crop.crop_x, crop.crop_y, crop.crop_w, crop.crop_h]
+		parts += [size.width, size.height, size.auto_size, size.retina]
+		parts += ["%s=%s" % item for item in sorted(IMAGE_SAVE_PARAMS.items())]
+		parts += ["%s=%s" % item for item in sorted(size.encoder_settings.items())]
+		if size.descriptors:
+			parts += size.descriptors
+		if self.orientation in utils.ORIENTATION_TRANSPOSES:
+			parts.append("orientation=%s" % self.orientation)
+			if crop is not None and not crop.upright:
+				parts.append("stored")
+		
+		# unicode() rather than repr() so that ints and longs from the database hash the same
+		return hashlib.md5(u"|".join(unicode(part) for part in parts).encode("utf-8")).hexdigest()
+		
+	def source_size(self, size, crop=None):
+		""" Width and height of the area a size's thumbs are rendered from, since versions larger than it aren't made """
+		if crop is None and not size.auto_size:
+			try:
+				crop = self.get_crop(size)
+			except Crop.DoesNotExist:
+				pass
+		if crop is not None:
+			return crop.crop_w, crop.crop_h
+		return self.dimensions
+	
+	@property
+	def dimensions(self):
+		""" 
+		Width and height of the original turned upright for its EXIF orientation, which crops and thumbs 
+		are of, as read when it was saved, or from the file if they haven't been
+		"""
+		if self.width and self.height:
+			return utils.oriented_size((self.width, self.height), self.orientation)
+		return self.image.width, self.image.height
+	
+	def read_metadata(self, f=None, exif_data=None):
+		""" 
+		Sets the dimensions, orientation, capture time, camera, GPS position and color space fields
+		from the original, or from f, an open copy of it such as the upload, and its EXIF data if given
+		"""
+		if f is None:
+			if not self.image._committed:
+				# a new file, not in storage yet
+				return self.read_metadata(self.image.file, exif_data)
+			with self.storage.open(self.image.name, "rb") as f:
+				return self.read_metadata(f, exif_data)
+		
+		for name, value in utils.image_metadata(f, exif_data).items():
+			setattr(self, name, value)
+		self._metadata_file = f
+		
+	def thumbnail_changed(self, size, source_stat=None):
+		""" 
+		Whether a size's thumbnail is missing, or was rendered from a different original, crop or size.
+		Pass the original's source_stat() when checking several sizes
+		"""
+		crop = None
+		if not size.auto_size:
+			try:
+				crop = self.get_crop(size)
+			except Crop.DoesNotExist:
+				pass
+		fingerprint = self.thumbnail_fingerprint(size, crop, source_stat)
+		
+		for slug, name in self.thumbnail_files(size, self.source_size(size, crop)):
+			entry = self.thumbnail_manifest.get(slug)
+			if entry is None or entry.fingerprint != fingerprint:
+				return True
+		return False
+	
+	@property
+	def thumbnail_manifest(self):
+		""" The thumbnails that have been written for this image, keyed by slug """
+		if "_thumbnail_manifest" not in self.__dict__:
+			self._thumbnail_manifest = dict((thumb.slug, thumb) for thumb in self.thumbnails.all())
+		return self._thumbnail_manifest
+		
+	def thumbnail_files(self, size, source_size=None):
+		""" 
+		Manifest slugs and storage names of all the thumbnails made for a size: in each format, 
+		and retina and responsive versions, leaving out versions too large for source_size if given
+		"""
+		files = []
+		for version in (size.versions if source_size is None else size.versions_within(source_size)):
+			for extension in [None] + size.output_formats:
+				files.append((
+					thumbnail_slug(version.slug, extension=extension), 
+					self.thumbnail_name(version.slug, extension=extension),
+				))
+		return files
+		
+	def record_thumbnail(self, slug, thumbnail, fingerprint="", name=None):
+		""" Adds a thumbnail that has just been written to the manifest """
+		entry = Thumbnail.objects.record(self, slug, thumbnail, fingerprint, name)
+		self.thumbnail_manifest[slug] = entry
+		return entry
+		
+	def backfill(self):
+		""" 
+		Reads the original's checksum and looks for thumbnails already in storage, for images saved before 
+		either was kept. Only the management commands do this, so that rendering pages never has to
+		"""
+		if not self.checksum:
+			self.read_checksum()
+			self.store(checksum=self.checksum)
+		if not self.thumbnails_scanned:
+			self.scan_thumbnails()
+		
+	def scan_thumbnails(self):
+		""" 
+		Adds the thumbnails already in storage to the manifest, for images rendered before it existed,
+		and notes that it has been done so it isn't done again for images that had none
+		"""
+		
+		# one listing rather than checking whether each thumbnail exists
+		try:
+			dirs, files = self.storage.listdir(self.folder_name)
+		except (OSError, IOError):
+			# nothing rendered
+			files = ()
+		files = set(files)
+		self.store(thumbnails_scanned=True)
+		
+		for size in registry.sizes(self.size_set_id):
+			for slug, name in self.thumbnail_files(size):
+				if slug in self.thumbnail_manifest or os.path.basename(name) not in files:
+					continue
+				try:
+					with self.storage.open(name, "rb") as f:
+						self.record_thumbnail(slug, pil.open(f), name=name)
+				except IOError:
+					# Unreadable, so leave it out to be rendered again
+					pass
+		
+	def has_thumbnail(self, size_slug, retina=False, extension=None):
+		""" 
+		Whether the thumbnail for a size has been written, according to the manifest. None if that isn't 
+		known, for images rendered before the manifest existed that regenerate_thumbs hasn't scanned yet
+		"""
+		if thumbnail_slug(size_slug, retina, extension) in self.thumbnail_manifest:
+			return True
+		if not self.thumbnails_scanned:
+			return None
+		return False
+			
+	def get_size(self, size_slug):
+		""" Gets the size with this slug from the image's size set """
+		size = registry.get(self.size_set_id, size_slug)
+		if size is None:
+			raise Size.DoesNotExist("No size %s in size set %s" % (size_slug, self.size_set_id))
+		return size
+			
 	def has_size(self, size_slug):
-		return self.size_set.size_set.filter(slug=size_slug).exists()
+		return registry.get(self.size_set_id, size_slug) is not None
 			
 	def get_absolute_url(self):
 		return settings.STATIC_URL + self.image
@@ -293,33 +778,86 @@ class Image(CachingMixin, models.Model):
 	def get_crop(self, size):
 		"""  Gets the crop for this image and size based on size set and aspect ratio """
 
-		return Crop.objects.filter(size__size_set=size.size_set, size__aspect_ratio=size.aspect_ratio, image=self).order_by("-crop_w")[0]
+		if "_crops" in self.__dict__:
+			crops = [crop for crop in self._crops if crop.size.size_set_id == size.size_set_id and crop.size.aspect_ratio == size.aspect_ratio]
+			crops.sort(key=lambda crop: crop.crop_w, reverse=True)
+			if crops:
+				return crops[0]
+		else:
+			# Crops are made against the largest size of their ratio, so try the sizes widest
+			# first with cached lookups by (size, image) rather than a join that can't be cached
+			for ratio_size in registry.sizes_by_ratio(size.size_set_id, size.aspect_ratio):
+				try:
+					return Crop.objects.get(size=ratio_size.id, image=self.id)
+				except Crop.DoesNotExist:
+					pass
+		
+		raise Crop.DoesNotExist("No crop for image %s at aspect ratio %s" % (self.id, size.aspect_ratio))
 
 
 	def save(self, *args, **kwargs):
 		""" 
-		Save the image object and create any auto-sized thumbnails that don't need crops
+		Save the image object and queue creating any auto-sized thumbnails that don't need crops
 		Also, delete any old thumbs that aren't being written over
 		"""
+		# the upload view reads the metadata along with the caption, this is for images saved 
+		# elsewhere, and for files replaced by new ones not yet read
+		replaced = self.image and not self.image._committed and self.image.file is not getattr(self, "_metadata_file", None)
+		if self.image and (self.width is None or replaced):
+			try:
+				self.read_metadata()
+			except IOError:
+				pass
+		
+		new_file = self.image and not self.image._committed
+		if new_file:
+			# with nothing rendered from it yet to look for
+			try:
+				self.read_checksum()
+			except IOError:
+				self.checksum = ""
+			self.thumbnails_scanned = True
+		
 		super(Image, self).save(*args, **kwargs)
 		
-		# get all the auto sized thumbnails and create them
-		sizes = self.size_set.size_set.all().filter(
-			auto_size__in=[AUTO_CROP, AUTO_SIZE], 
-			create_on_request=False
-		)
-		for size in sizes:
-			self.create_thumbnail(size)
+		if new_file:
+			# The thumbs of a file this one replaced are in its folder, not the new one's
+			self.thumbnails.all().delete()
+			self.__dict__.pop("_thumbnail_manifest", None)
+		
+		jobs.enqueue(self)
 		
 		# get all of the create on request sizes and delete the thumbnails
 		# in anticipation of them being rewritten
-		create_on_request_sizes = self.size_set.size_set.all().filter(
-			auto_size__in=[AUTO_CROP, AUTO_SIZE], 
-			create_on_request=True
-		)
+		create_on_request_sizes = [
+			size for size in registry.sizes(self.size_set_id)
+			if size.auto_size in (AUTO_CROP, AUTO_SIZE) and size.create_on_request
+		]
+		slugs = []
 		for size in create_on_request_sizes:
-			if os.path.exists(self.thumbnail_path(size.slug)):
-				os.remove(self.thumbnail_path(size.slug))
+			for slug, name in self.thumbnail_files(size):
+				try:
+					self.storage.delete(name)
+				except OSError:
+					pass
+				slugs.append(slug)
+		self.thumbnails.filter(slug__in=slugs).delete()
+		self.__dict__.pop("_thumbnail_manifest", None)
+				
+	@uncached()
+	def create_auto_thumbnails(self):
+		""" Create all the auto sized thumbnails that don't need crops """
+		
+		sizes = [
+			size for size in registry.sizes(self.size_set_id)
+			if size.auto_size in (AUTO_CROP, AUTO_SIZE) and not size.create_on_request
+		]
+		return self.create_thumbnails(sizes)
+				
+	@property
+	def render_status(self):
+		""" Whether the thumbnails are pending, running, done or failed to render """
+		return jobs.status(self)
 			
 	def clean(self):
 		""" Additional file validation for saving """
@@ -335,67 +873,149 @@ class Image(CachingMixin, models.Model):
 			except:
 				raise ValidationError("Unable to open image file")
 			
-			# Check for minimum size requirement 
+			# Check for minimum size requirement, of the image turned upright
 			if self.validate_image_size:
-				for size in self.size_set.size_set.all().order_by("-width"):
-					if size.width > pil_image.size[0] or size.height > pil_image.size[1]:
-						raise ValidationError("Uploaded image (%s x %s) is smaller than a required thumbnail size: %s" % (pil_image.size[0], pil_image.size[1], size))
+				orientation = utils.exif_orientation(utils.read_exif(self.image, ("Image Orientation",)))
+				width, height = utils.oriented_size(pil_image.size, orientation)
+				for size in registry.sizes(self.size_set_id):
+					if size.width > width or size.height > height:
+						raise ValidationError("Uploaded image (%s x %s) is smaller than a required thumbnail size: %s" % (width, height, size))
 						
 		return super(Image, self).clean()
 			
+	@uncached()
 	def create_thumbnail(self, size, force_crop=False):
 		""" Creates a thumbnail for an image at the specified size """
-	
-		if not size.auto_size:
-			try:
-				crop = self.get_crop(size)
+		return self.create_thumbnails([size], force_crop=force_crop)
+		
+	def create_thumbnail_once(self, size, slug=None, wait=locks.CROPDUSTER_LOCK_WAIT):
+		""" 
+		Creates a missing thumbnail on demand, unless another request is already creating it, 
+		in which case waits up to wait seconds for them to finish. Returns False if it timed out.
+		Checks for the thumbnail with the manifest slug given, by default the size's own
+		"""
+		slug = slug or size.slug
+		if self.has_thumbnail(slug):
+			return True
+		
+		lock = locks.RenderLock(self.id, size.slug)
+		if not lock.acquire(wait):
+			return False
+		try:
+			# whoever held the lock before may have just written it
+			self.__dict__.pop("_thumbnail_manifest", None)
+			if not self.has_thumbnail(slug):
+				self.create_thumbnail(size, force_crop=True)
+		finally:
+			lock.release()
+		return True
+		
+	def create_thumbnails(self, sizes, force_crop=False):
+		""" 
+		Creates thumbnails for several sizes, decoding the original once for each crop
+		they are made from. Returns the manifest entries of the thumbnails written
+		"""
+		
+		# manually cropped sizes come from their ratio's crop, everything else from the whole image
+		sources = OrderedDict()
+		for size in sizes:
+			if size.create_on_request and not force_crop:
+				continue
 				
-				cropped_image = utils.create_cropped_image(
-					self.image.path, 
-					crop.crop_x, 
-					crop.crop_y, 
-					crop.crop_w, 
-					crop.crop_h
-				)
-			except Crop.DoesNotExist:
-				# auto-crop if no crop is defined
-				cropped_image = pil.open(self.image.path)
-		else:
-			cropped_image = pil.open(self.image.path)
+			crop = None
+			if not size.auto_size:
+				try:
+					crop = self.get_crop(size)
+				except Crop.DoesNotExist:
+					# auto-crop if no crop is defined
+					pass
+			sources.setdefault(crop and crop.id, (crop, []))[1].append(size)
 		
-		self.rescale(cropped_image=cropped_image, size=size, force_crop=force_crop)
-
-
+		written = []
+		source_stat = self.source_stat() if sources else None
+		for crop, crop_sizes in sources.values():
+			min_width, min_height = required_dimensions(crop_sizes)
+			
+			with self.source as source:
+				if crop is None:
+					cropped_image = utils.open_image(source, min_width, min_height, orientation=self.orientation)
+				else:
+					cropped_image = utils.create_cropped_image(
+						source, 
+						crop.crop_x, 
+						crop.crop_y, 
+						crop.crop_w, 
+						crop.crop_h,
+						min_width=min_width,
+						min_height=min_height,
+						orientation=self.orientation,
+						upright=crop.upright,
+					)
 			
-	def rescale(self, cropped_image, size, force_crop=False):
-		""" Resizes and saves the image to other sizes of the same aspect ratio from a given cropped image """
+			written.extend(self.rescale_sizes(cropped_image, crop_sizes, force_crop=force_crop, crop=crop, source_stat=source_stat))
+		return written
 		
-		if force_crop or not size.create_on_request:
-			auto_crop = (size.auto_size == AUTO_CROP)
-			thumbnail = utils.rescale(cropped_image, size.width, size.height, auto_crop=auto_crop)
+	def rescale_sizes(self, cropped_image, sizes, force_crop=False, crop=None, source_stat=None):
+		""" 
+		Resizes and saves the image to several sizes from a given cropped image, largest first 
+		so the smaller sizes can be derived from the larger ones
+		"""
 		
-			# In case the thumbnail path hasn't been created yet
-			if not os.path.exists(self.folder_path):
-				try:
-					os.makedirs(self.folder_path)
-				except OSError:
-					# Handles weird race conditions if the path wasn't created just yet
-					if os.path.exists(self.folder_path):
-						pass
-					else: 
-						os.makedirs(self.folder_path)
-					
-			thumbnail.save(self.thumbnail_path(size.slug), **IMAGE_SAVE_PARAMS)
+		pyramid = utils.ResizePyramid(cropped_image)
+		source_stat = source_stat or self.source_stat()
+		
+		written = []
+		for size in sorted(sizes, key=lambda size: size.versions[0].width or 0, reverse=True):
+			written.extend(self.rescale(cropped_image, size, force_crop=force_crop, pyramid=pyramid, crop=crop, source_stat=source_stat))
+		return written
 			
-			# Create retina image
-			if size.retina:
-				retina_size = size.retina_size
+	def rescale(self, cropped_image, size, force_crop=False, pyramid=None, crop=None, source_stat=None):
+		""" 
+		Resizes and saves the image to other sizes of the same aspect ratio from a given cropped image.
+		Pass the same pyramid and source_stat() when rescaling one cropped image to several sizes, and 
+		the crop the image was cut with, if any. Returns the manifest entries of the thumbnails written
+		"""
+		
+		written = []
+		if force_crop or not size.create_on_request:
+			fingerprint = self.thumbnail_fingerprint(size, crop, source_stat)
+			
+			if pyramid is None:
+				pyramid = utils.ResizePyramid(cropped_image)
 				
-				# Only create retina image if cropped image is large enough
-				# If retina size is required, make a separate size
-				if retina_size.width <= cropped_image.size[0] and retina_size.height <= cropped_image.size[1]:
-					retina_thumbnail = utils.rescale(cropped_image, retina_size.width, retina_size.height, crop=retina_size.auto_size)
-					retina_thumbnail.save(self.thumbnail_path(retina_size.slug), **IMAGE_SAVE_PARAMS)
+			auto_crop = (size.auto_size == AUTO_CROP)
+			
+			# Retina and responsive versions are rendered first, largest first, so the smaller
+			# ones and the size itself are resampled from them rather than from the whole crop.
+			# They are only created if the cropped image is large enough, the size always is
+			for version in size.versions_within(cropped_image.size):
+				thumbnail = pyramid.rescale(version.width, version.height, auto_crop=auto_crop)
+				for extension in [None] + size.output_formats:
+					written.append(self.write_thumbnail(version.slug, thumbnail, fingerprint, extension, size))
+			
+		return written
+		
+	def write_thumbnail(self, slug, thumbnail, fingerprint="", extension=None, size=None):
+		""" 
+		Writes a thumbnail to storage, so readers of local and overwriting storages see either
+		the old file or the whole new one, and adds it to the manifest. Every thumbnail is written through here, in the original's
+		format or the one for the extension given, with the size's encoder settings
+		"""
+		name = self.thumbnail_name(slug, extension=extension)
+		format = OUTPUT_FORMATS[extension][0] if extension else utils.image_format(name)
+		if size is not None:
+			params = size.save_params(format, thumbnail)
+		else:
+			params = dict(IMAGE_SAVE_PARAMS, format=format)
+		
+		if extension:
+			# WebP and AVIF only take RGB, with or without alpha
+			if thumbnail.mode not in ("RGB", "RGBA"):
+				has_alpha = "A" in thumbnail.mode or "transparency" in thumbnail.info
+				thumbnail = thumbnail.convert("RGBA" if has_alpha else "RGB")
+		
+		utils.save_to_storage(thumbnail, self.storage, name, fsync=CROPDUSTER_FSYNC, **params)
+		return self.record_thumbnail(thumbnail_slug(slug, extension=extension), thumbnail, fingerprint, name)
 			
 	def tag(self, **kwargs):
 		from cropduster.templatetags.images import get_image
@@ -404,6 +1024,101 @@ class Image(CachingMixin, models.Model):
 
 
 
+class ThumbnailManager(models.Manager):
+	
+	def record(self, image, slug, thumbnail, fingerprint="", name=None):
+		""" Creates or updates the manifest entry for a thumbnail that has just been written, to name if not in the original's format """
+		
+		size, mtime = utils.storage_stat(image.storage, name or image.thumbnail_name(slug))
+		
+		entry, created = self.update_or_create(image=image, slug=slug, defaults={
+			"width": thumbnail.size[0],
+			"height": thumbnail.size[1],
+			"bytes": size,
+			"mtime": mtime,
+			"source_checksum": image.checksum,
+			"fingerprint": fingerprint,
+		})
+		return entry
+
+class Thumbnail(models.Model):
+	""" 
+	Manifest entry for a thumbnail written to disk, so that rendering and 
+	the management commands don't have to check the filesystem
+	"""
+	
+	objects = ThumbnailManager()
+	
+	image = models.ForeignKey(
+		Image,
+		related_name = "thumbnails",
+	)
+	
+	# Size slug, with the retina postfix for retina thumbnails
+	slug = models.CharField(max_length=60)
+	
+	width = models.PositiveIntegerField()
+	
+	height = models.PositiveIntegerField()
+	
+	bytes = models.PositiveIntegerField()
+	
+	mtime = models.FloatField()
+	
+	source_checksum = models.CharField(max_length=32)
+	
+	# Image.thumbnail_fingerprint of what it was rendered from, blank if unknown
+	fingerprint = models.CharField(max_length=32, blank=True, default="")
+	
+	class Meta:
+		db_table = "cropduster_thumbnail"
+		unique_together = (("image", "slug"),)
+	
+	def __unicode__(self):
+		return u"%s: %sx%s" % (self.slug, self.width, self.height)
+
+
+class RenderJob(models.Model):
+	""" A queued thumbnail rendering job for the database queue backend """
+	
+	image = models.ForeignKey(
+		Image,
+		related_name = "render_jobs",
+	)
+	
+	crop = models.ForeignKey(
+		Crop,
+		related_name = "render_jobs",
+		blank=True, 
+		null=True,
+	)
+	
+	status = models.CharField(max_length=10, choices=jobs.STATUS_CHOICES, default=jobs.PENDING, db_index=True)
+	
+	attempts = models.PositiveIntegerField(default=0)
+	
+	# When a worker last started rendering it
+	claimed_at = models.DateTimeField(blank=True, null=True)
+	
+	error = models.TextField(blank=True, default="")
+	
+	created = models.DateTimeField(auto_now_add=True)
+	
+	updated = models.DateTimeField(auto_now=True)
+	
+	class Meta:
+		db_table = "cropduster_renderjob"
+		
+	def __unicode__(self):
+		return u"%s: %s" % (self.image_id, self.status)
+
+
+# Reload the size registry whenever the sizes change
+for model in (SizeSet, Size):
+	post_save.connect(registry.invalidate, sender=model)
+	post_delete.connect(registry.invalidate, sender=model)
+
+
 class CropDusterField(models.ForeignKey):
 	pass	
 
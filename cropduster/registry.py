@@ -0,0 +1,107 @@
+"""
+In-process registry of the sizes in each size set, so that looking up a size
+by slug or aspect ratio doesn't query the database.
+
+Sizes are loaded on first use. Saving or deleting a Size or SizeSet reloads them
+straight away in the same process, and bumps a version stamp in the Django cache
+that other processes check every CROPDUSTER_SIZE_REGISTRY_INTERVAL seconds.
+"""
+import time
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+CROPDUSTER_SIZE_REGISTRY_INTERVAL = getattr(settings, "CROPDUSTER_SIZE_REGISTRY_INTERVAL", 5)
+
+VERSION_KEY = "cropduster:size_registry:version"
+
+
+def ratio_key(aspect_ratio):
+	""" Aspect ratios are stored as floats but calculated as decimals, so normalize them for lookups """
+	return round(float(aspect_ratio), 2)
+
+
+class SizeRegistry(object):
+
+	def __init__(self, interval=CROPDUSTER_SIZE_REGISTRY_INTERVAL):
+		self.interval = interval
+		self.lock = Lock()
+		self.version = None
+		self.checked = 0
+		self.loaded = False
+
+	def load(self, version):
+		""" Loads every size, replacing the lookups all at once so readers never see them half built """
+		from cropduster.models import Size
+
+		by_size_set = {}
+		by_slug = {}
+		by_ratio = {}
+
+		for size in Size.objects.all().order_by("-width", "id"):
+			by_size_set.setdefault(size.size_set_id, []).append(size)
+			by_slug[(size.size_set_id, size.slug)] = size
+			by_ratio.setdefault((size.size_set_id, ratio_key(size.aspect_ratio)), []).append(size)
+
+		self.by_size_set, self.by_slug, self.by_ratio = by_size_set, by_slug, by_ratio
+		self.version = version
+		self.loaded = True
+
+	def current_version(self):
+		version = cache.get(VERSION_KEY)
+		if version is None:
+			# Nothing has changed since the cache was cleared, start a new stamp
+			version = time.time()
+			cache.add(VERSION_KEY, version, None)
+			version = cache.get(VERSION_KEY, version)
+		return version
+
+	def ensure_loaded(self):
+		""" Loads the sizes if they haven't been yet, or if another process has changed them """
+		now = time.time()
+		if self.loaded and now - self.checked < self.interval:
+			return
+
+		with self.lock:
+			if self.loaded and now - self.checked < self.interval:
+				return
+
+			# A change made inside a transaction may not have been committed when
+			# the stamp was bumped, so recently changed sizes get loaded once more
+			version = self.current_version()
+			if not self.loaded or version != self.version or now - version < self.interval:
+				self.load(version)
+			self.checked = now
+
+	def invalidate(self, sender=None, **kwargs):
+		""" Signal handler for a size or size set changing, which reloads the sizes everywhere """
+		cache.set(VERSION_KEY, time.time(), None)
+		with self.lock:
+			self.loaded = False
+
+	def get(self, size_set_id, slug):
+		""" Gets a size by its slug, or None """
+		self.ensure_loaded()
+		return self.by_slug.get((size_set_id, slug))
+
+	def sizes(self, size_set_id):
+		""" Gets all the sizes in a size set, widest first """
+		self.ensure_loaded()
+		return list(self.by_size_set.get(size_set_id, []))
+
+	def sizes_by_ratio(self, size_set_id, aspect_ratio):
+		""" Gets all the sizes in a size set with this aspect ratio, widest first """
+		self.ensure_loaded()
+		return list(self.by_ratio.get((size_set_id, ratio_key(aspect_ratio)), []))
+
+	def ratios(self, size_set_id, auto_size=None):
+		""" Gets the distinct aspect ratios in a size set, largest first, optionally only of one generation type """
+		sizes = self.sizes(size_set_id)
+		if auto_size is not None:
+			sizes = [size for size in sizes if size.auto_size == auto_size]
+		return sorted(set(ratio_key(size.aspect_ratio) for size in sizes), reverse=True)
+
+
+registry = SizeRegistry()
@@ -2,58 +2,142 @@ from coffin import template
 from coffin.template.loader import get_template
 register = template.Library()
 from django.conf import settings
-from cropduster.models import Size
-from cropduster.models import AUTO_SIZE
-from os.path import exists
+from django.core.urlresolvers import reverse
+from cropduster.models import Size, Image as CropDusterImage
+from cropduster.models import AUTO_SIZE, RETINA_POSTFIX, OUTPUT_FORMATS, prefetch_images, fits
+from cropduster.registry import registry
 
 CROPDUSTER_CROP_ONLOAD = getattr(settings, "CROPDUSTER_CROP_ONLOAD", True)
 CROPDUSTER_PLACEHOLDER_MODE = getattr(settings, "CROPDUSTER_PLACEHOLDER_MODE", False)
+CROPDUSTER_SERVE_THUMBNAILS = getattr(settings, "CROPDUSTER_SERVE_THUMBNAILS", False)
 
 
-# preload a map of image sizes so it doesn"t make a DB call for each templatetag use
-IMAGE_SIZE_MAP = {}
-for size in Size.objects.all():
-	IMAGE_SIZE_MAP[(size.size_set_id, size.slug)] = size
+def ensure_thumbnail(image, size_name):
+	""" 
+	If CROPDUSTER_CROP_ONLOAD is set, checks the thumbnail manifest for the thumbnail and
+	if not there, creates the thumb based on predefined crop/size settings. Thumbs of images
+	rendered before the manifest existed are taken to be there until regenerate_thumbs scans them.
+	Returns False if the thumbnail couldn't be created, or another request creating it 
+	took longer than CROPDUSTER_LOCK_WAIT.
+	
+	With CROPDUSTER_SERVE_THUMBNAILS the thumbnail view renders missing thumbs instead, 
+	so only checks that there is such a size
+	"""
+	if CROPDUSTER_SERVE_THUMBNAILS:
+		return image.has_size(size_name)
+	if CROPDUSTER_CROP_ONLOAD and image.has_thumbnail(size_name) is False:
+		try:
+			size = image.get_size(size_name)
+		except Size.DoesNotExist:
+			return False
+		try:
+			if not image.create_thumbnail_once(size):
+				return False
+		except:
+			return False
+	return True
+	
+def thumbnail_url(image, size_name, retina=False, extension=None, descriptor=None):
+	""" 
+	URL of a thumbnail, or with CROPDUSTER_SERVE_THUMBNAILS, of the view that renders it if it hasn't been yet.
+	A descriptor such as 1.5x or 480w gets one of the size's responsive versions instead
+	"""
+	postfix = "@" + descriptor if descriptor else (RETINA_POSTFIX if retina else "")
+	if CROPDUSTER_SERVE_THUMBNAILS and image.has_thumbnail(size_name + postfix, extension=extension) is False:
+		return reverse("cropduster-thumbnail", kwargs={
+			"image_id": image.id,
+			"size_slug": size_name,
+			"descriptor": postfix,
+			"extension": extension or image.extension.lstrip("."),
+		})
+	return image.thumbnail_url(size_name + postfix, extension=extension)
+	
+def get_srcset(image, size, extension=None):
+	""" 
+	The srcset of a size's thumbnail with its retina and responsive versions, leaving out those 
+	the original was too small for. Densities such as 1x, 2x, or widths if the size has responsive widths
+	"""
+	versions = [(None, size)]
+	if size.retina:
+		versions.append((RETINA_POSTFIX[1:], size.retina_size))
+	versions += [(variant.descriptor, variant) for variant in size.variants]
+	
+	widths = any(descriptor.endswith("w") for descriptor in size.descriptors)
+	source_size = image.source_size(size) if CROPDUSTER_SERVE_THUMBNAILS else None
+	
+	candidates = []
+	for descriptor, version in versions:
+		if descriptor and not (
+			image.has_thumbnail(version.slug, extension=extension) 
+			or (source_size and fits(version, source_size))
+		):
+			continue
+		url = thumbnail_url(image, size.slug, extension=extension, descriptor=descriptor)
+		candidates.append(u"%s %s" % (url, "%sw" % version.width if widths else descriptor or "1x"))
+	return ", ".join(candidates)
+	
+def get_sources(image, size, retina=False, srcset=False):
+	""" The <source> type and URL, or with srcset all the versions, of the thumbnail in each other format the size is saved in """
+	sources = []
+	for extension in size.output_formats:
+		if CROPDUSTER_SERVE_THUMBNAILS or image.has_thumbnail(size.slug + (RETINA_POSTFIX if retina else ""), extension=extension):
+			sources.append({
+				"type": OUTPUT_FORMATS[extension][1],
+				"srcset": get_srcset(image, size, extension) if srcset else thumbnail_url(image, size.slug, retina, extension),
+			})
+	return sources
+	
+def resolve_images(images, field_name=None):
+	""" 
+	Gets the cropduster images with sizes, crops and manifests prefetched, from either 
+	the images themselves or from objects that have them in field_name 
+	"""
+	if field_name:
+		objects = list(images)
+		attname = objects[0]._meta.get_field(field_name).attname if objects else None
+		image_ids = [getattr(obj, attname) for obj in objects]
+		
+		found = CropDusterImage.objects.in_bulk([image_id for image_id in image_ids if image_id])
+		images = [found.get(image_id) for image_id in image_ids]
+	else:
+		images = list(images)
+	
+	prefetch_images(images)
+	return images
 
 
 @register.object
-def get_image(image, size_name=None, template_name="image.html", retina=False, **kwargs):
-	""" Templatetag to get the HTML for an image from a cropduster image object """
+def get_image(image, size_name=None, template_name="image.html", retina=False, formats=False, srcset=False, **kwargs):
+	""" 
+	Templatetag to get the HTML for an image from a cropduster image object.
+	With formats, wraps it in a <picture> offering the size's WebP or AVIF thumbs to browsers that take them.
+	With srcset, offers its retina and responsive versions, to go with a sizes attribute when they're widths
+	"""
 
 	if image:
 		
-		if CROPDUSTER_CROP_ONLOAD:
-		# If set, will check for thumbnail existence
-		# if not there, will create the thumb based on predefiend crop/size settings
-		
-			thumb_path = image.thumbnail_path(size_name)
-			if not exists(thumb_path) and exists(image.image.path):
-				try:
-					size = image.size_set.size_set.get(slug=size_name)
-				except Size.DoesNotExist:
-					return ""
-				try:
-					image.create_thumbnail(size, force_crop=True)
-				except:
-					return ""
+		if not ensure_thumbnail(image, size_name):
+			return ""
 		
-		if retina:	
-			image_url = image.retina_thumbnail_url(size_name)
-		else:
-			image_url = image.thumbnail_url(size_name)
+		image_url = thumbnail_url(image, size_name, retina=retina)
 			
 		
 		if not image_url:
 			return ""
 			
-		try:
-			image_size = IMAGE_SIZE_MAP[(image.size_set_id, size_name)]
-		except KeyError:
+		# the size registry keeps the sizes in memory, so this doesn't make a DB call for each templatetag use
+		image_size = registry.get(image.size_set_id, size_name)
+		if image_size is None:
 			return ""
 	
 		# Set all the args that get passed to the template
 		
 		kwargs["image_url"] = image_url
+		
+		if srcset:
+			kwargs["srcset"] = get_srcset(image, image_size)
+		if formats:
+			kwargs["sources"] = get_sources(image, image_size, retina=retina, srcset=srcset)
 
 		if hasattr(image_size, "auto_size") and image_size.auto_size != AUTO_SIZE:
 			kwargs["width"] = image_size.width if hasattr(image_size, "width") else ""
@@ -77,6 +161,27 @@ def get_image(image, size_name=None, template_name="image.html", retina=False, *
 	else:
 		return ""
 
+
+@register.object
+def get_images(images, size_name=None, field_name=None, template_name="image.html", retina=False, **kwargs):
+	""" 
+	Templatetag to get the HTML for many images at once, in a fixed number of queries.
+	Takes either cropduster image objects, or objects with a cropduster image in field_name.
+	Returns the HTML for each image in order, empty where there isn't one
+	"""
+	return [
+		get_image(image, size_name, template_name=template_name, retina=retina, **kwargs)
+		for image in resolve_images(images, field_name)
+	]
+
+@register.object
+def get_image_urls(images, size_name=None, field_name=None, retina=False):
+	""" Like get_images, but returns the thumbnail URL for each image instead of the HTML """
 	
-		
-		
\ No newline at end of file
+	urls = []
+	for image in resolve_images(images, field_name):
+		if image and ensure_thumbnail(image, size_name):
+			urls.append(thumbnail_url(image, size_name, retina=retina))
+		else:
+			urls.append("")
+	return urls
@@ -0,0 +1,72 @@
+import shutil
+import tempfile
+from io import BytesIO
+
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
+
+from cropduster import models
+
+
+def image_file(size, name, format="PNG", color="black"):
+	f = BytesIO()
+	Image.new("RGB", size, color).save(f, format)
+	return ContentFile(f.getvalue(), name=name)
+
+
+class RemoteStorage(Storage):
+	""" Stand-in for a storage without local paths, such as S3, keeping its files in a local folder """
+	
+	def __init__(self, location, file_overwrite=False):
+		self.local = FileSystemStorage(location)
+		self.file_overwrite = file_overwrite
+	
+	def _open(self, name, mode="rb"):
+		return self.local.open(name, mode)
+	
+	def _save(self, name, content):
+		if self.file_overwrite and self.local.exists(name):
+			self.local.delete(name)
+		return self.local.save(name, content)
+	
+	def get_available_name(self, name):
+		return name if self.file_overwrite else super(RemoteStorage, self).get_available_name(name)
+	
+	def exists(self, name):
+		return self.local.exists(name)
+	
+	def delete(self, name):
+		self.local.delete(name)
+	
+	def listdir(self, path):
+		return self.local.listdir(path)
+	
+	def size(self, name):
+		return self.local.size(name)
+	
+	def modified_time(self, name):
+		return self.local.modified_time(name)
+	
+	def url(self, name):
+		return self.local.url(name)
+
+
+class MediaMixin(object):
+	""" Keeps the originals and thumbnails of the images a test saves in a temporary folder """
+	
+	def setUp(self):
+		super(MediaMixin, self).setUp()
+		self.location = tempfile.mkdtemp()
+		self.storage = FileSystemStorage(self.location, base_url="/media/")
+		
+		# uploads otherwise go under MEDIA_ROOT
+		self.field = models.Image._meta.get_field("image")
+		self.field_storage, self.field.storage = self.field.storage, self.storage
+		self.upload_to, self.field.upload_to = self.field.upload_to, "uploads"
+	
+	def tearDown(self):
+		self.field.storage = self.field_storage
+		self.field.upload_to = self.upload_to
+		shutil.rmtree(self.location)
+		super(MediaMixin, self).tearDown()
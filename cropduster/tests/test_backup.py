@@ -0,0 +1,32 @@
+import os
+
+from django.test import TestCase
+
+from cropduster import models
+from cropduster.management.commands.backup_images import Command
+from cropduster.tests.base import MediaMixin, image_file
+
+
+class BackupTestCase(MediaMixin, TestCase):
+	
+	def test_derived_paths(self):
+		size_set = models.SizeSet.objects.create(name="Set", slug="set")
+		sizes = [
+			models.Size.objects.create(name="Large", slug="large", width=400, height=300, size_set=size_set),
+			models.Size.objects.create(name="Small", slug="small", width=200, height=150, size_set=size_set, retina=True, formats="webp"),
+		]
+		image = models.Image(size_set=size_set)
+		image.image = image_file((800, 600), "photo.jpg", "JPEG")
+		image.save()
+		image.create_thumbnails(sizes)
+		
+		paths = list(Command().get_derived_paths(models.Image.objects.get(pk=image.pk)))
+		self.assertEqual(sorted(os.path.relpath(path, self.location) for path in paths), [
+			"uploads/photo/large.jpg",
+			"uploads/photo/small.jpg",
+			"uploads/photo/small.webp",
+			"uploads/photo/small@2x.jpg",
+			"uploads/photo/small@2x.webp",
+		])
+		for path in paths:
+			self.assertTrue(os.path.exists(path), path)
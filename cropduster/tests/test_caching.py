@@ -0,0 +1,87 @@
+from django.core.cache import cache
+from django.test import TestCase
+
+from cropduster.caching import local_cache, uncached
+from cropduster.models import Crop, Image, Size, SizeSet
+
+
+class RowCacheTestCase(TestCase):
+
+	def setUp(self):
+		self.size_set = SizeSet.objects.create(name="Set", slug="set")
+		self.empty_caches()
+
+	def tearDown(self):
+		self.empty_caches()
+
+	def empty_caches(self):
+		""" As when rows were last written long ago, in a new request """
+		cache.clear()
+		local_cache.clear()
+
+	def get(self, **kwargs):
+		return SizeSet.objects.get(**kwargs)
+
+	def test_cached(self):
+		self.get(pk=self.size_set.pk)
+		with self.assertNumQueries(0):
+			self.assertEqual(self.get(pk=self.size_set.pk).name, "Set")
+			self.assertEqual(self.get(id__exact=str(self.size_set.pk)).name, "Set")
+			local_cache.clear()
+			self.assertEqual(self.get(pk=self.size_set.pk).name, "Set")
+
+		# only gets by a unique key are
+		with self.assertNumQueries(2):
+			self.get(slug="set")
+			self.get(slug="set")
+
+	def test_save(self):
+		self.get(pk=self.size_set.pk)
+		self.size_set.name = "Renamed"
+		self.size_set.save()
+		self.assertEqual(self.get(pk=self.size_set.pk).name, "Renamed")
+
+		# and until the write has surely been committed, the row is read from the database
+		with self.assertNumQueries(2):
+			self.get(pk=self.size_set.pk)
+			local_cache.clear()
+			self.get(pk=self.size_set.pk)
+
+	def test_delete(self):
+		self.get(pk=self.size_set.pk)
+		self.size_set.delete()
+		with self.assertRaises(SizeSet.DoesNotExist):
+			self.get(pk=self.size_set.pk)
+
+	def test_miss(self):
+		with self.assertRaises(SizeSet.DoesNotExist):
+			self.get(pk=999)
+		with self.assertNumQueries(0):
+			with self.assertRaises(SizeSet.DoesNotExist):
+				self.get(pk=999)
+
+		SizeSet.objects.create(pk=999, name="Created", slug="created")
+		self.assertEqual(self.get(pk=999).name, "Created")
+
+	def test_uncached(self):
+		self.get(pk=self.size_set.pk)
+		# written without signals, as by another process
+		SizeSet.objects.filter(pk=self.size_set.pk).update(name="Updated")
+		self.assertEqual(self.get(pk=self.size_set.pk).name, "Set")
+		with uncached():
+			self.assertEqual(self.get(pk=self.size_set.pk).name, "Updated")
+
+	def test_unique_together(self):
+		size = Size.objects.create(name="Large", slug="large", width=40, height=30, size_set=self.size_set)
+		Image.objects.bulk_create([Image(size_set=self.size_set, image="a.png")])
+		image = Image.objects.get(image="a.png")
+		Crop.objects.bulk_create([Crop(image=image, size=size)])
+		self.empty_caches()
+
+		crop = Crop.objects.get(image=image, size=size)
+		with self.assertNumQueries(0):
+			self.assertEqual(Crop.objects.get(size_id=size.pk, image_id=image.pk).pk, crop.pk)
+
+		crop.delete()
+		with self.assertRaises(Crop.DoesNotExist):
+			Crop.objects.get(image=image, size=size)
@@ -0,0 +1,159 @@
+import os
+import struct
+import shutil
+import tempfile
+from io import BytesIO
+
+from PIL import Image
+from django.test import SimpleTestCase
+
+from cropduster import exif
+
+
+ASCII, SHORT, LONG, RATIONAL, UNDEFINED = 2, 3, 4, 5, 7
+
+IMAGE_TAGS = [
+	(0x010E, ASCII, b"A caption"),
+	(0x010F, ASCII, b"Canon"),
+	(0x0110, ASCII, b"Canon EOS 5D Mark II"),
+	(0x0112, SHORT, [6]),
+	(0x011A, RATIONAL, [(72, 1)]),
+	(0x0132, ASCII, b"2014:03:01 12:30:45"),
+]
+
+EXIF_TAGS = [
+	(0x829A, RATIONAL, [(1, 250)]),
+	(0x8827, SHORT, [400]),
+	(0x9003, ASCII, b"2014:03:01 12:30:45"),
+	(0x9286, UNDEFINED, b"ASCII\0\0\0A comment"),
+	(0xA001, SHORT, [1]),
+	(0xA002, LONG, [5616]),
+]
+
+GPS_TAGS = [
+	(0x0001, ASCII, b"N"),
+	(0x0002, RATIONAL, [(40, 1), (26, 1), (4632, 100)]),
+	(0x0003, ASCII, b"W"),
+	(0x0004, RATIONAL, [(79, 1), (58, 1), (5616, 100)]),
+]
+
+
+def pack_value(byte_order, field_type, value):
+	""" The bytes of a tag's value, and its count """
+	if field_type == ASCII:
+		return value + b"\0", len(value) + 1
+	if field_type == UNDEFINED:
+		return value, len(value)
+	if field_type == RATIONAL:
+		return b"".join(struct.pack(byte_order + "II", num, den) for num, den in value), len(value)
+	return b"".join(struct.pack(byte_order + {SHORT: "H", LONG: "I"}[field_type], item) for item in value), len(value)
+
+def pack_ifd(byte_order, tags, offset):
+	""" An IFD at offset in the TIFF data, followed by the values of its tags that don't fit in an entry """
+	data_offset = offset + 2 + 12 * len(tags) + 4
+	entries, data = struct.pack(byte_order + "H", len(tags)), b""
+	for tag, field_type, value in sorted(tags):
+		value, count = pack_value(byte_order, field_type, value)
+		if len(value) <= 4:
+			entries += struct.pack(byte_order + "HHI", tag, field_type, count) + value.ljust(4, b"\0")
+		else:
+			entries += struct.pack(byte_order + "HHII", tag, field_type, count, data_offset + len(data))
+			data += value + b"\0" * (len(value) % 2)
+	return entries + struct.pack(byte_order + "I", 0) + data
+
+def tiff_data(byte_order):
+	""" TIFF data with IFD0 and the EXIF and GPS IFDs it points to """
+	header = (b"II" if byte_order == "<" else b"MM") + struct.pack(byte_order + "HI", 42, 8)
+
+	# the pointers are the same length whatever they point to
+	image_length = len(pack_ifd(byte_order, IMAGE_TAGS + [(0x8769, LONG, [0]), (0x8825, LONG, [0])], 8))
+	exif_offset = 8 + image_length
+	exif_ifd = pack_ifd(byte_order, EXIF_TAGS, exif_offset)
+	gps_offset = exif_offset + len(exif_ifd)
+	image_ifd = pack_ifd(byte_order, IMAGE_TAGS + [(0x8769, LONG, [exif_offset]), (0x8825, LONG, [gps_offset])], 8)
+	return header + image_ifd + exif_ifd + pack_ifd(byte_order, GPS_TAGS, gps_offset)
+
+def jpeg_data(byte_order):
+	""" A JPEG with the TIFF data in its APP1 segment """
+	f = BytesIO()
+	Image.new("RGB", (8, 8)).save(f, "JPEG")
+	app1 = b"Exif\0\0" + tiff_data(byte_order)
+	return f.getvalue()[:2] + b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1 + f.getvalue()[2:]
+
+
+# The printable values of the tags, as the parser read them before it read with struct
+EXPECTED = {
+	"Image ImageDescription": "A caption",
+	"Image Make": "Canon",
+	"Image Model": "Canon EOS 5D Mark II",
+	"Image Orientation": "Rotated 90 CW",
+	"Image XResolution": "72",
+	"Image DateTime": "2014:03:01 12:30:45",
+	"Image ExifOffset": "176",
+	"Image GPSInfo": "300",
+	"EXIF ExposureTime": "1/250",
+	"EXIF ISOSpeedRatings": "400",
+	"EXIF DateTimeOriginal": "2014:03:01 12:30:45",
+	"EXIF UserComment": "A comment",
+	"EXIF ColorSpace": "sRGB",
+	"EXIF ExifImageWidth": "5616",
+	"GPS GPSLatitudeRef": "N",
+	"GPS GPSLatitude": "[40, 26, 1158/25]",
+	"GPS GPSLongitudeRef": "W",
+	"GPS GPSLongitude": "[79, 58, 1404/25]",
+}
+
+
+class ExifTestCase(SimpleTestCase):
+
+	def setUp(self):
+		self.location = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.location)
+
+	def printable(self, tags):
+		return dict((name, tag.printable) for name, tag in tags.items())
+
+	def files(self):
+		""" The test files, in both byte orders, in memory and on disk """
+		for name, data in (("jpeg", jpeg_data), ("tiff", tiff_data)):
+			for byte_order in "<>":
+				path = os.path.join(self.location, "%s%s" % (name, ord(byte_order)))
+				with open(path, "wb") as f:
+					f.write(data(byte_order))
+				yield BytesIO(data(byte_order))
+				with open(path, "rb") as f:
+					yield f
+
+	def test_parity(self):
+		for f in self.files():
+			self.assertEqual(self.printable(exif.process_file(f)), EXPECTED)
+
+	def test_some_tags(self):
+		tags = ["Image Orientation", "EXIF DateTimeOriginal", "GPS GPSLatitude"]
+		# along with the pointers to the IFDs they're in
+		expected = tags + ["Image ExifOffset", "Image GPSInfo"]
+		for f in self.files():
+			read = self.printable(exif.process_file(f, tags=tags))
+			self.assertEqual(read, dict((tag, EXPECTED[tag]) for tag in expected))
+
+	def test_unmapped(self):
+		mapped = []
+		map_file = exif.map_file
+		def record(f):
+			mapped.append(map_file(f))
+			return mapped[-1]
+		exif.map_file = record
+		try:
+			for f in self.files():
+				exif.process_file(f)
+		finally:
+			exif.map_file = map_file
+
+		# the TIFFs on disk are memory mapped, and closed after
+		self.assertEqual(len(mapped), 4)
+		mapped = [m for m in mapped if not isinstance(m, memoryview)]
+		self.assertEqual(len(mapped), 2)
+		for m in mapped:
+			self.assertRaises(ValueError, m.read, 1)
@@ -0,0 +1,90 @@
+import json
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from cropduster import jobs
+from cropduster import models
+from cropduster.tests.base import MediaMixin, image_file
+
+
+class QueuedPool(object):
+	""" Stand-in for a thread pool that keeps the jobs queued on it, for the test to run """
+	
+	def __init__(self):
+		self.queued = []
+	
+	def apply_async(self, func, args):
+		self.queued.append(args)
+
+
+class ThreadPoolBackendTestCase(MediaMixin, TestCase):
+	
+	def setUp(self):
+		super(ThreadPoolBackendTestCase, self).setUp()
+		self.size_set = models.SizeSet.objects.create(name="Set", slug="set")
+		self.size = models.Size.objects.create(name="Large", slug="large", width=40, height=30, size_set=self.size_set)
+		
+		self.backend = jobs.ThreadPoolBackend(threads=1)
+		self.backend.pool.terminate()
+		self.backend.pool = QueuedPool()
+		self.rendered = []
+		self.backend_was, jobs._backend = jobs._backend, self.backend
+		self.render, jobs.render = jobs.render, lambda image, crop=None: self.rendered.append((image.image.name, crop and crop.crop_x))
+	
+	def tearDown(self):
+		jobs._backend = self.backend_was
+		jobs.render = self.render
+		super(ThreadPoolBackendTestCase, self).tearDown()
+	
+	def run_queued(self):
+		# in this thread, whose database connection has the test's rows
+		while self.backend.pool.queued:
+			self.backend.run(*self.backend.pool.queued.pop(0))
+	
+	def test_queued_once(self):
+		image = models.Image(size_set=self.size_set)
+		image.image = image_file((80, 60), "a.png")
+		image.save()
+		crop = models.Crop.objects.create(image=image, size=self.size, crop_x=0, crop_y=0, crop_w=40, crop_h=30)
+		
+		# saved again while waiting
+		crop.crop_x = 10
+		crop.save()
+		image.image = image_file((80, 60), "b.png")
+		image.save()
+		self.assertEqual(len(self.backend.pool.queued), 2)
+		self.assertEqual(image.render_status, jobs.PENDING)
+		
+		# rendered as last saved
+		self.run_queued()
+		self.assertEqual(sorted(self.rendered), [("uploads/b.png", None), ("uploads/b.png", 10)])
+		self.assertEqual(image.render_status, jobs.DONE)
+	
+	def test_failed(self):
+		image = models.Image(size_set=self.size_set)
+		image.image = image_file((80, 60), "a.png")
+		image.save()
+		# deleted before it was rendered
+		models.Image.objects.filter(pk=image.pk).delete()
+		self.run_queued()
+		self.assertEqual(image.render_status, jobs.FAILED)
+		
+		# until queued again
+		image.save()
+		self.assertEqual(image.render_status, jobs.PENDING)
+
+
+@override_settings(ROOT_URLCONF="cropduster.urls")
+class RenderStatusTestCase(TestCase):
+	
+	def test_render_status(self):
+		size_set = models.SizeSet.objects.create(name="Set", slug="set")
+		models.Image.objects.bulk_create([models.Image(size_set=size_set, image="a/photo.jpg")])
+		image = models.Image.objects.get(image="a/photo.jpg")
+		
+		response = self.client.get("/status/", {"image_id": image.id})
+		self.assertEqual(json.loads(response.content), {"status": jobs.DONE})
+		
+		self.assertEqual(self.client.get("/status/", {"image_id": image.id + 1}).status_code, 404)
+		self.assertEqual(self.client.get("/status/", {"image_id": "a"}).status_code, 404)
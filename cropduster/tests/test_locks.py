@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+from unittest import skipIf
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from cropduster import locks
+
+
+@skipIf(locks.fcntl is None, "file locks need fcntl")
+class RenderLockTestCase(SimpleTestCase):
+	
+	def setUp(self):
+		self.lock_dir, locks.CROPDUSTER_LOCK_DIR = locks.CROPDUSTER_LOCK_DIR, tempfile.mkdtemp()
+	
+	def tearDown(self):
+		shutil.rmtree(locks.CROPDUSTER_LOCK_DIR)
+		locks.CROPDUSTER_LOCK_DIR = self.lock_dir
+		cache.clear()
+	
+	def test_single_flight(self):
+		first, second = locks.RenderLock(1, "large"), locks.RenderLock(1, "large")
+		self.assertTrue(first.acquire(0))
+		self.assertFalse(second.acquire(0))
+		self.assertTrue(locks.RenderLock(1, "small").acquire(0))
+		
+		first.release()
+		self.assertTrue(second.acquire(0))
+		second.release()
+	
+	def test_files_removed(self):
+		lock = locks.RenderLock(1, "large")
+		self.assertTrue(lock.acquire(0))
+		self.assertEqual(os.listdir(locks.CROPDUSTER_LOCK_DIR), [os.path.basename(lock.path)])
+		lock.release()
+		self.assertEqual(os.listdir(locks.CROPDUSTER_LOCK_DIR), [])
+		
+		# and by those who gave up waiting, only if they had the file lock
+		lock.acquire(0)
+		waiting = locks.RenderLock(1, "large")
+		self.assertFalse(waiting.acquire(0))
+		self.assertTrue(os.path.exists(lock.path))
+		lock.release()
+	
+	def test_file_removed_while_waiting(self):
+		first, second = locks.RenderLock(1, "large"), locks.RenderLock(1, "large")
+		self.assertTrue(first.acquire_file())
+		# opened the file that is removed when the first lets go
+		self.assertFalse(second.acquire_file())
+		first.close()
+		
+		third = locks.RenderLock(1, "large")
+		self.assertTrue(third.acquire_file())
+		self.assertFalse(second.acquire_file())
+		third.close()
+		self.assertTrue(second.acquire_file())
+		self.assertTrue(os.path.exists(second.path))
+		second.close()
+		self.assertEqual(os.listdir(locks.CROPDUSTER_LOCK_DIR), [])
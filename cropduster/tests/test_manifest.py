@@ -0,0 +1,107 @@
+import hashlib
+import shutil
+import tempfile
+
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import TestCase
+
+from cropduster import utils
+from cropduster import models
+from cropduster.tests.base import MediaMixin, RemoteStorage, image_file
+
+
+class ScanThumbnailsTestCase(TestCase):
+	
+	def setUp(self):
+		self.location = tempfile.mkdtemp()
+		size_set = models.SizeSet.objects.create(name="Set", slug="set")
+		models.Size.objects.create(name="Large", slug="large", width=400, height=300, size_set=size_set)
+		models.Size.objects.create(name="Small", slug="small", width=200, height=150, size_set=size_set, formats="webp")
+		models.Image.objects.bulk_create([models.Image(size_set=size_set, image="a/photo.jpg", width=800, height=600)])
+		self.image = models.Image.objects.get(image="a/photo.jpg")
+	
+	def tearDown(self):
+		shutil.rmtree(self.location)
+	
+	def test_scan_thumbnails(self):
+		for storage_class in (FileSystemStorage, RemoteStorage):
+			storage = storage_class(tempfile.mkdtemp(dir=self.location))
+			models.Thumbnail.objects.all().delete()
+			image = models.Image.objects.get(pk=self.image.pk)
+			image.image.storage = storage
+			
+			utils.save_to_storage(Image.new("RGB", (800, 600)), storage, "a/photo.jpg")
+			utils.save_to_storage(Image.new("RGB", (400, 300)), storage, "a/photo/large.jpg")
+			utils.save_to_storage(Image.new("RGB", (200, 150)), storage, "a/photo/small.jpg")
+			storage.save("a/photo/small.webp", ContentFile(b"not an image"))
+			
+			image.scan_thumbnails()
+			self.assertEqual(sorted(image.thumbnail_manifest), ["large", "small"])
+			self.assertEqual((image.thumbnail_manifest["large"].width, image.thumbnail_manifest["large"].height), (400, 300))
+			self.assertEqual(image.thumbnail_manifest["small"].bytes, storage.size("a/photo/small.jpg"))
+			self.assertTrue(image.has_thumbnail("small"))
+			self.assertFalse(image.has_thumbnail("small", extension="webp"))
+	
+	def test_unscanned(self):
+		# storage isn't looked at while pages render, and the thumbnails it may have are taken to be there
+		image = models.Image.objects.get(pk=self.image.pk)
+		image.image.storage = None
+		self.assertIsNone(image.has_thumbnail("large"))
+		self.assertFalse(models.Image.objects.get(pk=self.image.pk).thumbnails_scanned)
+	
+	def test_backfill(self):
+		storage = FileSystemStorage(self.location)
+		storage.save("a/photo.jpg", ContentFile(b"original"))
+		image = models.Image.objects.get(pk=self.image.pk)
+		image.image.storage = storage
+		image.backfill()
+		self.assertEqual(image.checksum, "919c8b643b7133116b02fc0d9bb7df3f")
+		self.assertFalse(image.has_thumbnail("large"))
+		
+		image = models.Image.objects.get(pk=self.image.pk)
+		self.assertEqual(image.checksum, "919c8b643b7133116b02fc0d9bb7df3f")
+		self.assertTrue(image.thumbnails_scanned)
+		# and isn't looked at again
+		image.image.storage = None
+		image.backfill()
+		self.assertFalse(image.has_thumbnail("large"))
+
+
+class ManifestTestCase(MediaMixin, TestCase):
+	
+	def setUp(self):
+		super(ManifestTestCase, self).setUp()
+		self.size_set = models.SizeSet.objects.create(name="Set", slug="set")
+		self.size = models.Size.objects.create(name="Large", slug="large", width=40, height=30, size_set=self.size_set)
+	
+	def test_new_file(self):
+		f = image_file((80, 60), "a.png")
+		checksum = hashlib.md5(f.read()).hexdigest()
+		image = models.Image(size_set=self.size_set)
+		image.image = f
+		image.save()
+		self.assertEqual(image.checksum, checksum)
+		# and the whole file was saved after it was read
+		with image.storage.open(image.image.name) as saved:
+			self.assertEqual(hashlib.md5(saved.read()).hexdigest(), checksum)
+		self.assertTrue(image.thumbnails_scanned)
+		self.assertFalse(image.has_thumbnail("large"))
+	
+	def test_replaced_file(self):
+		image = models.Image(size_set=self.size_set)
+		image.image = image_file((80, 60), "a.png")
+		image.save()
+		models.Crop.objects.bulk_create([models.Crop(image=image, size=self.size, crop_w=80, crop_h=60)])
+		image.create_thumbnail(self.size, force_crop=True)
+		self.assertTrue(image.has_thumbnail("large"))
+		
+		# the new file's thumbnails go in a folder of their own, with none in it yet
+		image.image = image_file((80, 60), "b.png", color="white")
+		image.save()
+		self.assertFalse(image.has_thumbnail("large"))
+		self.assertFalse(models.Image.objects.get(pk=image.pk).has_thumbnail("large"))
+		
+		image.create_thumbnail(self.size, force_crop=True)
+		self.assertEqual(image.thumbnail_manifest["large"].source_checksum, image.checksum)
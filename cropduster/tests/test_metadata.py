@@ -0,0 +1,58 @@
+from datetime import datetime
+from unittest import skipIf
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from cropduster import utils
+from cropduster import models
+from cropduster.tests.base import MediaMixin, image_file
+
+try:
+	import pytz
+except ImportError:
+	pytz = None
+
+
+class MetadataTestCase(MediaMixin, TestCase):
+	
+	def setUp(self):
+		super(MetadataTestCase, self).setUp()
+		self.size_set = models.SizeSet.objects.create(name="Set", slug="set")
+	
+	def test_replaced_file(self):
+		image = models.Image(size_set=self.size_set)
+		image.image = image_file((40, 30), "a.png")
+		image.save()
+		self.assertEqual(image.dimensions, (40, 30))
+		
+		image.image = image_file((60, 20), "b.png")
+		image.save()
+		self.assertEqual(image.dimensions, (60, 20))
+		
+		# saving again without a new file keeps what was read
+		image.width = 1
+		image.save()
+		self.assertEqual(image.width, 1)
+	
+	def test_read_before_saving(self):
+		# as the upload view does, from the upload
+		image = models.Image(size_set=self.size_set)
+		image.image = image_file((40, 30), "a.png")
+		image.read_metadata(image.image.file)
+		image.width = 1
+		image.save()
+		self.assertEqual(image.width, 1)
+	
+	@skipIf(pytz is None, "pytz is needed for time zones with daylight saving time")
+	@override_settings(USE_TZ=True, TIME_ZONE="America/New_York")
+	def test_taken_during_clock_change(self):
+		f = image_file((40, 30), "a.png")
+		for taken, expected in (
+			("2015:07:04 12:00:00", datetime(2015, 7, 4, 16, 0, tzinfo=pytz.utc)),
+			# repeated, and skipped
+			("2015:11:01 01:30:00", None),
+			("2015:03:08 02:30:00", None),
+		):
+			metadata = utils.image_metadata(f, {"EXIF DateTimeOriginal": taken})
+			self.assertEqual(metadata["taken"], expected)
@@ -0,0 +1,127 @@
+import struct
+from io import BytesIO
+
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase
+
+from cropduster import utils
+from cropduster import models
+from cropduster.tests.base import MediaMixin
+
+
+def exif_with_orientation(orientation, byte_order="<"):
+	""" APP1 EXIF data holding only an orientation, in an IFD0 of one entry """
+	header = (b"II" if byte_order == "<" else b"MM") + struct.pack(byte_order + "HI", 42, 8)
+	ifd = struct.pack(byte_order + "H", 1) + struct.pack(byte_order + "HHIHH", 0x0112, 3, 1, orientation, 0) + struct.pack(byte_order + "I", 0)
+	return b"Exif\0\0" + header + ifd
+
+def read_orientation(exif):
+	byte_order = "<" if exif[6:8] == b"II" else ">"
+	return struct.unpack_from(byte_order + "H", exif, 6 + 8 + 2 + 8)[0]
+
+
+class OrientationTestCase(SimpleTestCase):
+
+	def stored_image(self, size=(6, 4)):
+		""" An image with a different color at every pixel, as a camera would store it """
+		img = Image.new("RGB", size)
+		img.putdata([(x * 40, y * 40, 0) for y in range(size[1]) for x in range(size[0])])
+		return img
+
+	def test_orient_size(self):
+		img = self.stored_image()
+		for orientation in range(1, 9):
+			self.assertEqual(utils.orient(img, orientation).size, utils.oriented_size(img.size, orientation))
+
+	def test_stored_box(self):
+		# Cropping the stored image and turning the crop upright must give the crop of the upright image
+		img = self.stored_image()
+		for orientation in range(1, 9):
+			upright = utils.orient(img, orientation)
+			width, height = upright.size
+			for box in ((0, 0, width, height), (1, 0, 3, 2), (0, 1, 2, 4), (width - 2, height - 3, width, height)):
+				left, top, right, bottom = utils.stored_box(box, img.size, orientation)
+				self.assertTrue(0 <= left < right <= img.size[0] and 0 <= top < bottom <= img.size[1])
+				cropped = utils.orient(img.crop((left, top, right, bottom)), orientation)
+				self.assertEqual(list(cropped.getdata()), list(upright.crop(box).getdata()), "orientation %s, box %s" % (orientation, box))
+
+	def test_orient_resets_exif(self):
+		for byte_order in "<>":
+			for orientation in range(1, 9):
+				img = self.stored_image()
+				img.info["exif"] = exif_with_orientation(orientation, byte_order)
+				oriented = utils.orient(img, orientation)
+				self.assertEqual(read_orientation(oriented.info["exif"]), 1 if orientation > 1 else orientation)
+
+	def test_orient_drops_unreadable_exif(self):
+		img = self.stored_image()
+		img.info["exif"] = b"Exif\0\0II*\0"
+		self.assertNotIn("exif", utils.orient(img, 6).info)
+
+	def test_upright_box(self):
+		img = self.stored_image()
+		for orientation in range(1, 9):
+			width, height = utils.oriented_size(img.size, orientation)
+			for box in ((0, 0, width, height), (1, 0, 3, 2), (0, 1, 2, 4)):
+				self.assertEqual(utils.upright_box(utils.stored_box(box, img.size, orientation), img.size, orientation), box)
+	
+	def test_stored_crop(self):
+		# A crop drawn on the 6x4 image as stored, before orientations were read
+		img = self.stored_image()
+		f = BytesIO()
+		img.save(f, "PNG")
+		for orientation in range(1, 9):
+			f.seek(0)
+			cropped = utils.create_cropped_image(f, 1, 0, 5, 4, orientation=orientation, upright=False)
+			self.assertEqual(list(cropped.getdata()), list(img.crop((1, 0, 6, 4)).getdata()))
+			
+			# and moved onto the upright image, the same area turned upright
+			left, top, right, bottom = utils.upright_box((1, 0, 6, 4), img.size, orientation)
+			f.seek(0)
+			cropped = utils.create_cropped_image(f, left, top, right - left, bottom - top, orientation=orientation)
+			self.assertEqual(list(cropped.getdata()), list(utils.orient(img.crop((1, 0, 6, 4)), orientation).getdata()))
+
+
+class StoredCropTestCase(MediaMixin, TestCase):
+	
+	def setUp(self):
+		super(StoredCropTestCase, self).setUp()
+		size_set = models.SizeSet.objects.create(name="Set", slug="set")
+		self.size = models.Size.objects.create(name="Large", slug="large", width=40, height=30, size_set=size_set)
+		
+		# stored sideways, red at the top and blue at the bottom
+		img = Image.new("RGB", (80, 60), "blue")
+		img.paste((255, 0, 0), (0, 0, 80, 30))
+		f = BytesIO()
+		img.save(f, "JPEG", exif=exif_with_orientation(6))
+		self.image = models.Image(size_set=size_set)
+		self.image.image = ContentFile(f.getvalue(), name="a.jpg")
+		self.image.save()
+		
+		# drawn on the top half as stored, before orientations were read
+		models.Crop.objects.bulk_create([models.Crop(image=self.image, size=self.size, crop_x=0, crop_y=0, crop_w=40, crop_h=30, upright=False)])
+		self.crop = models.Crop.objects.get(image=self.image)
+	
+	def thumbnail(self):
+		with self.image.storage.open(self.image.thumbnail_name("large")) as f:
+			return Image.open(f).convert("RGB")
+	
+	def assertRed(self, thumbnail):
+		red, green, blue = thumbnail.getpixel((thumbnail.size[0] // 2, thumbnail.size[1] // 2))
+		self.assertTrue(red > 200 and blue < 50, (red, green, blue))
+	
+	def test_stored_crop(self):
+		self.assertEqual(self.image.orientation, 6)
+		self.crop.create_thumbnails()
+		thumbnail = self.thumbnail()
+		self.assertEqual(thumbnail.size, (40, 30))
+		self.assertRed(thumbnail)
+	
+	def test_turn_upright(self):
+		# as the cropper shows it, then saves it
+		self.crop.turn_upright()
+		self.assertEqual((self.crop.crop_x, self.crop.crop_y, self.crop.crop_w, self.crop.crop_h), (30, 0, 30, 40))
+		self.crop.save()
+		self.assertTrue(models.Crop.objects.get(pk=self.crop.pk).upright)
+		self.assertRed(self.thumbnail())
@@ -0,0 +1,107 @@
+import os
+import sys
+import json
+import logging
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from cropduster import models
+from cropduster.tests.base import MediaMixin, image_file
+
+
+class RegenerateThumbsTestCase(MediaMixin, TestCase):
+
+	def setUp(self):
+		super(RegenerateThumbsTestCase, self).setUp()
+		self.size_set = models.SizeSet.objects.create(name="Set", slug="set")
+		self.size = models.Size.objects.create(name="Large", slug="large", width=40, height=30, size_set=self.size_set, auto_size=models.AUTO_CROP)
+
+		# the crops are the objects regenerated, each with the image it's on
+		self.images = []
+		for i in range(3):
+			image = models.Image(size_set=self.size_set)
+			image.image = image_file((80, 60), "%s.png" % i)
+			image.save()
+			self.images.append(image)
+		models.Crop.objects.bulk_create([models.Crop(image=image, size=self.size) for image in self.images])
+
+		# the command logs to a file in the folder
+		self.handlers = logging.root.handlers[:]
+	
+	def tearDown(self):
+		for handler in logging.root.handlers[:]:
+			if handler not in self.handlers:
+				logging.root.removeHandler(handler)
+				handler.close()
+		super(RegenerateThumbsTestCase, self).tearDown()
+
+	def regenerate(self, **options):
+		options.setdefault("checkpoint_file", os.path.join(self.location, "checkpoint"))
+		# the command reports to sys.stdout, as its --stdout option takes the name of Django's
+		stdout, sys.stdout = sys.stdout, StringIO()
+		try:
+			call_command("regenerate_thumbs", "cropduster:Crop.image", logfile=os.path.join(self.location, "log"), **options)
+			return sys.stdout.getvalue()
+		finally:
+			sys.stdout = stdout
+
+	def checkpoint(self):
+		with open(os.path.join(self.location, "checkpoint")) as f:
+			return json.load(f)
+
+	def test_resume_failed(self):
+		# the second image's original is missing, so it fails
+		os.rename(self.images[1].image.path, self.images[1].image.path + ".moved")
+		self.regenerate(force=True, retries=0)
+		checkpoint = self.checkpoint()
+		self.assertTrue(checkpoint["complete"])
+		self.assertEqual(checkpoint["stats"]["objects"], 3)
+		self.assertEqual(checkpoint["stats"]["thumbnails"], 2)
+		self.assertEqual(len(checkpoint["stats"]["failures"]), 1)
+
+		# and is tried again on resume, on its own
+		os.rename(self.images[1].image.path + ".moved", self.images[1].image.path)
+		self.regenerate(resume=True)
+		checkpoint = self.checkpoint()
+		self.assertTrue(checkpoint["complete"])
+		self.assertEqual(checkpoint["failed"], {})
+		self.assertEqual(checkpoint["stats"]["objects"], 3)
+		self.assertEqual(checkpoint["stats"]["thumbnails"], 3)
+		self.assertEqual(checkpoint["stats"]["failures"], [])
+
+		self.assertIn("Already complete", self.regenerate(resume=True))
+
+	def test_changed(self):
+		# the thumbs rendered when the images were saved are up to date
+		self.regenerate(changed=True)
+		self.assertEqual(self.checkpoint()["stats"]["thumbnails"], 0)
+
+		self.size.width = 20
+		self.size.save()
+		self.regenerate(changed=True)
+		self.assertEqual(self.checkpoint()["stats"]["thumbnails"], 3)
+
+		# as if the original had been replaced
+		stat = os.stat(self.images[0].image.path)
+		os.utime(self.images[0].image.path, (stat.st_atime, stat.st_mtime - 60))
+		self.regenerate(changed=True)
+		self.assertEqual(self.checkpoint()["stats"]["thumbnails"], 1)
+
+	def test_changed_stat_once(self):
+		models.Size.objects.create(name="Small", slug="small", width=20, height=15, size_set=self.size_set, auto_size=models.AUTO_CROP)
+		stats = []
+		source_stat = models.Image.source_stat
+		def counted(image):
+			stats.append(image.pk)
+			return source_stat(image)
+		models.Image.source_stat = counted
+		try:
+			self.regenerate(changed=True)
+		finally:
+			models.Image.source_stat = source_stat
+
+		# once for each image to check its sizes, and once more to render the small one
+		self.assertEqual(sorted(stats), sorted([image.pk for image in self.images] * 2))
+		self.assertEqual(self.checkpoint()["stats"]["thumbnails"], 3)
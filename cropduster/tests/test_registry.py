@@ -0,0 +1,51 @@
+import time
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from cropduster.models import Size, SizeSet
+from cropduster.registry import SizeRegistry, registry, VERSION_KEY
+
+
+class SizeRegistryTestCase(TestCase):
+
+	def setUp(self):
+		cache.delete(VERSION_KEY)
+		self.size_set = SizeSet.objects.create(name="Set", slug="set")
+		self.size = Size.objects.create(name="Large", slug="large", width=40, height=30, size_set=self.size_set)
+
+	def test_changes_reload(self):
+		self.assertEqual(registry.get(self.size_set.id, "large").width, 40)
+
+		self.size.width = 80
+		self.size.save()
+		self.assertEqual(registry.get(self.size_set.id, "large").width, 80)
+		self.assertEqual(registry.sizes(self.size_set.id), [self.size])
+
+		self.size.delete()
+		self.assertIsNone(registry.get(self.size_set.id, "large"))
+		self.assertEqual(registry.sizes(self.size_set.id), [])
+
+	def test_version_bumped(self):
+		for change in (self.size.save, self.size_set.save, self.size.delete):
+			cache.set(VERSION_KEY, 1, None)
+			change()
+			self.assertGreater(cache.get(VERSION_KEY), 1)
+
+	def test_other_process(self):
+		# a registry in another process only sees the version stamp change
+		other = SizeRegistry(interval=5)
+		self.assertEqual(other.get(self.size_set.id, "large").width, 40)
+
+		Size.objects.filter(pk=self.size.pk).update(width=80)
+		cache.set(VERSION_KEY, time.time() - 60, None)
+		self.assertEqual(other.get(self.size_set.id, "large").width, 40)
+
+		# until it next checks the stamp
+		other.checked -= other.interval
+		self.assertEqual(other.get(self.size_set.id, "large").width, 80)
+
+		# and a stamp that hasn't changed since isn't reloaded for
+		Size.objects.filter(pk=self.size.pk).update(width=120)
+		other.checked -= other.interval
+		self.assertEqual(other.get(self.size_set.id, "large").width, 80)
@@ -0,0 +1,73 @@
+from PIL import Image, ImageChops, ImageStat
+from django.test import SimpleTestCase
+
+from cropduster import utils
+
+
+def photo(size=(1200, 900)):
+	""" An image with gradients and noise in it, so resampling differences show up as they would in a photo """
+	return Image.merge("RGB", [
+		Image.linear_gradient("L").resize(size),
+		Image.radial_gradient("L").resize(size),
+		Image.effect_noise(size, 64),
+	])
+
+
+class ResizePyramidTestCase(SimpleTestCase):
+
+	def setUp(self):
+		self.img = photo()
+
+	def assertClose(self, thumb, expected):
+		""" The thumbnail is framed as the direct rescale is, and differs from it by no more than resampling does """
+		self.assertEqual(thumb.size, expected.size)
+		stat = ImageStat.Stat(ImageChops.difference(thumb, expected))
+		mean = sum(stat.mean) / len(stat.mean)
+		largest = max(high for low, high in stat.extrema)
+		self.assertTrue(mean < 1 and largest <= 16, (thumb.size, mean, largest))
+
+	def test_matches_direct(self):
+		# a size set largest first: retina and responsive versions, other ratios, fitted and one-sided sizes
+		targets = [
+			(800, 600, True), (400, 300, True), (200, 150, True),
+			(600, 600, True), (300, 300, True), (100, 100, True),
+			(500, 200, True), (250, 100, True),
+			(600, 600, False), (150, 150, False),
+			(320, 0, True), (0, 90, True), (80, 0, False),
+		]
+		pyramid = utils.ResizePyramid(self.img)
+		for width, height, auto_crop in targets:
+			self.assertClose(
+				pyramid.rescale(width, height, auto_crop=auto_crop),
+				utils.rescale(self.img, width, height, auto_crop=auto_crop),
+			)
+
+	def test_retina_reused(self):
+		pyramid = utils.ResizePyramid(self.img)
+		retina = pyramid.rescale(400, 400)
+		self.assertIs(pyramid.source_for(200, 200), retina)
+
+	def test_framing(self):
+		pyramid = utils.ResizePyramid(self.img)
+		square = pyramid.rescale(600, 600)
+		# a square crop can't stand in for the source at another ratio, or for a fitted size
+		self.assertIs(pyramid.source_for(200, 100), self.img)
+		self.assertIs(pyramid.source_for(150, 150, auto_crop=False), self.img)
+
+		fitted = pyramid.rescale(400, 300, auto_crop=False)
+		self.assertIs(pyramid.source_for(150, 150, auto_crop=False), fitted)
+		# a fitted level keeps the source's ratio, so any size can be cut from it
+		self.assertIs(pyramid.source_for(100, 50), fitted)
+		self.assertIs(pyramid.source_for(0, 100), fitted)
+		# and a square crop still gives smaller squares
+		self.assertIs(pyramid.source_for(250, 250), square)
+
+	def test_too_small(self):
+		pyramid = utils.ResizePyramid(self.img)
+		level = pyramid.rescale(400, 300)
+		self.assertIs(pyramid.source_for(201, 150), self.img)
+		self.assertIs(pyramid.source_for(200, 150), level)
+
+		pyramid = utils.ResizePyramid(self.img, min_factor=3)
+		pyramid.rescale(400, 300)
+		self.assertIs(pyramid.source_for(200, 150), self.img)
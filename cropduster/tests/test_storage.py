@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase
+
+from cropduster import utils
+from cropduster.tests.base import RemoteStorage
+
+
+class StorageTestCase(SimpleTestCase):
+	
+	def setUp(self):
+		self.location = tempfile.mkdtemp()
+		self.storages = [
+			FileSystemStorage(self.location),
+			RemoteStorage(self.location),
+			RemoteStorage(self.location, file_overwrite=True),
+		]
+	
+	def tearDown(self):
+		shutil.rmtree(self.location)
+	
+	def test_storage_stat(self):
+		with open(os.path.join(self.location, "a.jpg"), "wb") as f:
+			f.write(b"x" * 100)
+		os.utime(f.name, (1000000000, 1000000000))
+		
+		for storage in self.storages:
+			size, mtime = utils.storage_stat(storage, "a.jpg")
+			self.assertEqual(size, 100)
+			self.assertEqual(int(mtime), 1000000000)
+	
+	def test_save_to_storage(self):
+		for storage in self.storages:
+			for color in ("red", "blue"):
+				name = utils.save_to_storage(Image.new("RGB", (20, 10), color), storage, "thumbs/a.png")
+				self.assertEqual(name, "thumbs/a.png")
+				self.assertEqual(os.listdir(os.path.join(self.location, "thumbs")), ["a.png"])
+				with storage.open(name) as f:
+					img = Image.open(f)
+					self.assertEqual(img.getpixel((0, 0)), (255, 0, 0) if color == "red" else (0, 0, 255))
+	
+	def test_save_to_storage_renamed(self):
+		# written again by someone else between deleting the old file and saving the new one
+		storage = RemoteStorage(self.location)
+		storage.local.save("a.png", ContentFile(b"other"))
+		storage.delete = lambda name: None
+		
+		self.assertRaises(IOError, utils.save_to_storage, Image.new("RGB", (20, 10)), storage, "a.png")
+	
+	def test_open_source(self):
+		with open(os.path.join(self.location, "a.jpg"), "wb") as f:
+			f.write(b"x")
+		
+		with utils.open_source(self.storages[0], "a.jpg") as source:
+			self.assertEqual(source, os.path.join(self.location, "a.jpg"))
+		
+		with utils.open_source(self.storages[1], "a.jpg") as source:
+			self.assertEqual(source.read(), b"x")
+		self.assertTrue(source.closed)
+	
+	def test_save_image(self):
+		path = os.path.join(self.location, "a.png")
+		for umask, mode in ((022, 0644), (077, 0600)):
+			umask = os.umask(umask)
+			try:
+				utils.save_image(Image.new("RGB", (20, 10)), path)
+			finally:
+				os.umask(umask)
+			self.assertEqual(os.stat(path).st_mode & 0777, mode)
+		
+		# a failed write leaves the old file, and no temporary one
+		self.assertRaises(KeyError, utils.save_image, Image.new("RGB", (20, 10)), path, format="NONE")
+		self.assertEqual(os.listdir(self.location), ["a.png"])
@@ -0,0 +1,76 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from cropduster import models
+from cropduster.tests.base import MediaMixin, image_file
+
+
+@override_settings(ROOT_URLCONF="cropduster.urls")
+class ThumbnailViewTestCase(MediaMixin, TestCase):
+	
+	def setUp(self):
+		super(ThumbnailViewTestCase, self).setUp()
+		size_set = models.SizeSet.objects.create(name="Set", slug="set")
+		self.size = models.Size.objects.create(name="Large", slug="large", width=40, height=30, size_set=size_set, formats="webp", srcset="1.5x")
+		self.image = models.Image(size_set=size_set)
+		self.image.image = image_file((80, 60), "a.png")
+		self.image.save()
+	
+	def get(self, path, **headers):
+		return self.client.get("/thumbnail/%s/%s" % (self.image.id, path), **headers)
+	
+	def test_thumbnail(self):
+		response = self.get("large.png")
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response["Content-Type"], "image/png")
+		self.assertIn("public", response["Cache-Control"])
+		with self.storage.open("uploads/a/large.png") as f:
+			self.assertEqual(b"".join(response.streaming_content), f.read())
+		self.assertEqual(int(response["Content-Length"]), self.storage.size("uploads/a/large.png"))
+		self.assertTrue(self.image.thumbnails.filter(slug="large").exists())
+		
+		# conditional requests
+		self.assertEqual(self.get("large.png", HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+		self.assertEqual(self.get("large.png", HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]).status_code, 304)
+		self.assertEqual(self.get("large.png", HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+	
+	def test_other_formats(self):
+		response = self.get("large.webp")
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response["Content-Type"], "image/webp")
+		self.assertEqual(self.get("large@1.5x.webp")["Content-Type"], "image/webp")
+	
+	def test_unknown(self):
+		for path in ("large@3x.png", "large@2x.png", "large.avif", "small.png"):
+			self.assertEqual(self.get(path).status_code, 404, path)
+		self.assertEqual(self.client.get("/thumbnail/%s/large.png" % (self.image.id + 1)).status_code, 404)
+		
+		# too small for the version
+		self.size.srcset = "3x"
+		self.size.save()
+		self.assertEqual(self.get("large@3x.png").status_code, 404)
+	
+	def test_being_rendered(self):
+		# by another request, which didn't finish in time
+		create_thumbnail_once = models.Image.create_thumbnail_once
+		models.Image.create_thumbnail_once = lambda image, size, slug=None: False
+		try:
+			response = self.get("large.png")
+		finally:
+			models.Image.create_thumbnail_once = create_thumbnail_once
+		self.assertEqual(response.status_code, 503)
+		self.assertEqual(response["Retry-After"], "1")
+		self.assertNotIn("public", response["Cache-Control"])
+	
+	def test_manifest_trusted(self):
+		self.get("large.png")
+		entry = self.image.thumbnails.get(slug="large")
+		self.storage.exists = None
+		self.assertEqual(self.get("large.png").status_code, 200)
+		
+		# until the file can't be opened, when it's rendered again
+		self.storage.delete("uploads/a/large.png")
+		response = self.get("large.png")
+		self.assertEqual(response.status_code, 200)
+		self.assertTrue(self.storage.open("uploads/a/large.png"))
+		self.assertNotEqual(self.image.thumbnails.get(slug="large").pk, entry.pk)
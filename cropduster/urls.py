@@ -8,4 +8,8 @@ urlpatterns = patterns('',
 	
 	url(r'^ratio/$', "cropduster.views.get_ratio", name='cropduster-ratio'),
 	
+	url(r'^status/$', "cropduster.views.get_render_status", name='cropduster-status'),
+	
+	url(r'^thumbnail/(?P<image_id>\d+)/(?P<size_slug>[-\w]+?)(?P<descriptor>@[0-9.]+[xw])?\.(?P<extension>\w+)$', "cropduster.views.thumbnail", name='cropduster-thumbnail'),
+	
 )
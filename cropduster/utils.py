@@ -1,5 +1,31 @@
 from PIL import Image
 from decimal import Decimal
+from datetime import datetime
+import math
+import os
+import uuid
+import errno
+import struct
+import time
+import tempfile
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+from cropduster.exif import process_file
+
+try:
+	from pytz.exceptions import InvalidTimeError
+except ImportError:
+	# without pytz, time zones have no ambiguous or missing times to raise for
+	class InvalidTimeError(Exception):
+		pass
+
+try:
+	# registers AVIF with PIL, for AVIF thumbnails
+	import pillow_avif
+except ImportError:
+	pass
 
 def aspect_ratio(width, height):
 	""" Defines aspect ratio from two sizes with consistent rounding method """
@@ -73,19 +99,486 @@ def rescale(img, width=0, height=0, auto_crop=True, **kwargs):
 
 	return img
 
-def create_cropped_image(path=None, x=0, y=0, width=0, height=0):
+
+# A pyramid level is only used as the resampling source for a size when it is
+# at least this many times larger, so the filter blur of the intermediate step
+# stays below what is visible in the final thumbnail.
+PYRAMID_MIN_FACTOR = 2
+
+class ResizePyramid(object):
+	""" 
+		Rescales one image to many sizes, deriving each size from the smallest
+		previously rendered level that is still large enough to resample from.
+		
+		Sizes should be requested largest first, so the total resampling work is
+		proportional to the largest output rather than to the number of sizes.
+	"""
+	
+	def __init__(self, img, min_factor=PYRAMID_MIN_FACTOR):
+		self.source = img
+		self.min_factor = min_factor
+		# (image, auto_crop) of each size rendered so far
+		self.levels = []
+		
+	def source_for(self, width=0, height=0, auto_crop=True):
+		""" Gets the smallest level that can stand in for the source image at the given size """
+		
+		src_width, src_height = self.source.size
+		src_ratio = float(src_width) / float(src_height)
+		
+		if width <= 0:
+			width = height * src_ratio
+		if height <= 0:
+			height = width / src_ratio
+		dst_ratio = float(width) / float(height)
+		
+		best = self.source
+		for level, level_auto_crop in self.levels:
+			level_width, level_height = level.size
+			
+			if level_width < width * self.min_factor or level_height < height * self.min_factor:
+				continue
+				
+			# The level must keep the framing of the source (to within a pixel at the
+			# requested size), otherwise the output would differ from a direct rescale.
+			# A level cut to the requested aspect ratio the same way also has it, such 
+			# as a retina thumb for the size itself
+			level_ratio = float(level_width) / float(level_height)
+			same_framing = abs(level_ratio - src_ratio) * height < 1 or (
+				level_auto_crop == auto_crop and abs(level_ratio - dst_ratio) * height < 1
+			)
+			if not same_framing:
+				continue
+			
+			if level_width < best.size[0]:
+				best = level
+				
+		return best
+	
+	def rescale(self, width=0, height=0, auto_crop=True):
+		""" Rescales to the given size and keeps the result as a level for smaller sizes """
+		
+		img = rescale(self.source_for(width, height, auto_crop), width, height, auto_crop=auto_crop)
+		self.levels.append((img, auto_crop))
+		return img
+		
+
+# JPEGs are only decoded at a reduced scale while they stay at least this many 
+# times larger than needed, since the DCT scaling is a much cruder filter than
+# the resampling done afterwards.
+DRAFT_MIN_FACTOR = 2
+
+def draft(img, min_width=0, min_height=0, min_factor=DRAFT_MIN_FACTOR):
+	""" 
+		Lets a JPEG decode at 1/2, 1/4 or 1/8 scale using libjpeg's DCT scaling, 
+		as long as the decoded image still covers min_width x min_height.
+		Must be called before the image is loaded. 
+		
+		Returns the factor the image was scaled down by (1 when unchanged)
+	"""
+	
+	if not (min_width or min_height) or img.format != "JPEG":
+		return 1
+		
+	full_width, full_height = img.size
+	img.draft(img.mode, (
+		max(int((min_width or 0) * min_factor), 1), 
+		max(int((min_height or 0) * min_factor), 1),
+	))
+	
+	return float(full_width) / float(img.size[0])
+
+# The transposes that turn an image stored at each EXIF orientation upright
+ORIENTATION_TRANSPOSES = {
+	2: Image.FLIP_LEFT_RIGHT,
+	3: Image.ROTATE_180,
+	4: Image.FLIP_TOP_BOTTOM,
+	5: Image.TRANSPOSE,
+	6: Image.ROTATE_270,
+	7: Image.TRANSVERSE,
+	8: Image.ROTATE_90,
+}
+
+def oriented_size(size, orientation=None):
+	""" The width and height of an image stored at size, once turned upright for its EXIF orientation """
+	width, height = size
+	if orientation in (5, 6, 7, 8):
+		return height, width
+	return width, height
+
+def stored_box(box, size, orientation=None):
 	""" 
-		Crop image given a starting (x, y) position and a width and height of the cropped area 
+		The box of an image stored at size, at an EXIF orientation, that becomes box
+		once the image is turned upright, so it can be cropped before turning it
+	"""
+	left, top, right, bottom = box
+	width, height = size
+	# where the upright image's (x, y) is in the stored one
+	to_stored = {
+		2: lambda x, y: (width - x, y),
+		3: lambda x, y: (width - x, height - y),
+		4: lambda x, y: (x, height - y),
+		5: lambda x, y: (y, x),
+		6: lambda x, y: (y, height - x),
+		7: lambda x, y: (width - y, height - x),
+		8: lambda x, y: (width - y, x),
+	}.get(orientation)
+	if to_stored is None:
+		return box
+	
+	(x1, y1), (x2, y2) = to_stored(left, top), to_stored(right, bottom)
+	return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+# Turning the other way undoes each transpose
+INVERSE_ORIENTATIONS = {6: 8, 8: 6}
+
+def upright_box(box, size, orientation=None):
+	""" The box of an image stored at size, at an EXIF orientation, once the image is turned upright: the reverse of stored_box """
+	return stored_box(box, oriented_size(size, orientation), INVERSE_ORIENTATIONS.get(orientation, orientation))
+
+def upright_exif(exif):
+	""" 
+		APP1 EXIF data with the orientation in its first IFD set to 1, upright, as it is
+		once the image has been turned. None if the data can't be parsed
+	"""
+	start = 6 if exif.startswith(b"Exif\0\0") else 0
+	byte_order = {b"II": "<", b"MM": ">"}.get(exif[start:start + 2])
+	if byte_order is None:
+		return None
+	
+	try:
+		ifd = start + struct.unpack_from(byte_order + "I", exif, start + 4)[0]
+		entries = struct.unpack_from(byte_order + "H", exif, ifd)[0]
+		for entry in range(ifd + 2, ifd + 2 + entries * 12, 12):
+			tag, field_type = struct.unpack_from(byte_order + "HH", exif, entry)
+			if tag == 0x0112 and field_type == 3:
+				# a short, held in the entry's value
+				return exif[:entry + 8] + struct.pack(byte_order + "H", 1) + exif[entry + 10:]
+	except struct.error:
+		return None
+	return exif
+
+def orient(img, orientation=None):
+	""" 
+		Turns a decoded image upright for its EXIF orientation, setting the orientation in
+		any EXIF data it keeps to upright, so thumbs that keep it aren't turned again by viewers
+	"""
+	transpose = ORIENTATION_TRANSPOSES.get(orientation)
+	if transpose is None:
+		return img
+	
+	img = img.transpose(transpose)
+	if img.info.get("exif"):
+		exif = upright_exif(img.info["exif"])
+		if exif is None:
+			del img.info["exif"]
+		else:
+			img.info["exif"] = exif
+	return img
+	
+def open_image(path=None, min_width=0, min_height=0, orientation=None):
+	""" 
+		Open the whole image, from a path or file, decoding at a reduced scale when it 
+		is larger than the biggest size to be rendered from it, and turned upright for 
+		its EXIF orientation if given
+	"""
+	
+	if path is None:
+		raise ValueError("A path must be specified")
+	
+	img = Image.open(path)
+	draft(img, *oriented_size((min_width, min_height), orientation))
+	img.load()
+	
+	return orient(img, orientation)
+
+def create_cropped_image(path=None, x=0, y=0, width=0, height=0, min_width=0, min_height=0, orientation=None, upright=True):
+	""" 
+		Crop image, from a path or file, given a starting (x, y) position and a width and height of the cropped area 
+		
+		If min_width/min_height are given, the image may be decoded at a reduced scale
+		so long as the cropped area still covers them; the crop is then smaller than
+		width x height by the same factor
+		
+		Given the image's EXIF orientation, the crop is of the image turned upright. The
+		area is cropped out of the image as stored, and only then turned. Crops drawn on 
+		the image as stored, before orientations were read, are not upright, and are 
+		cropped and left as they were
 	"""
 	
 	if path is None:
 		raise ValueError("A path must be specified")
 
 	img = Image.open(path)
-	img.copy()
+	
+	if not upright:
+		orientation = None
+	if orientation in ORIENTATION_TRANSPOSES:
+		left, top, right, bottom = stored_box((x, y, x + width, y + height), img.size, orientation)
+		x, y, width, height = left, top, right - left, bottom - top
+		min_width, min_height = oriented_size((min_width, min_height), orientation)
+	
+	scale = 1
+	if width and height and (min_width or min_height):
+		# Scale the size needed within the crop up to the size needed for the whole image
+		full_width, full_height = img.size
+		scale = draft(
+			img,
+			int(math.ceil(float(min_width or 0) * full_width / width)),
+			int(math.ceil(float(min_height or 0) * full_height / height)),
+		)
+	
 	img.load()
+	
+	if scale != 1:
+		x, y, width, height = [int(round(value / scale)) for value in (x, y, width, height)]
+		
 	img = img.crop((x, y, x + width, y + height))
 	img.load()
 	
-	return img
+	return orient(img, orientation)
+
+def temporary_file(folder, prefix="", suffix=""):
+	""" 
+		Creates a new file in folder and opens it for writing, returning (fd, path). Unlike 
+		mkstemp's files that only their owner can read, it has the permissions open() gives files
+	"""
+	while True:
+		path = os.path.join(folder, "%s%s%s" % (prefix, uuid.uuid4().hex, suffix))
+		try:
+			return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0666), path
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+
+def save_image(img, path, fsync=False, **params):
+	"""
+		Saves an image by writing it to a temporary file alongside path and renaming it 
+		over path, so that nothing ever reads a half written file
+		
+		With fsync, the file and then its folder are flushed to disk before returning,
+		so that the new file is there in full even after a crash
+	"""
+	
+	folder, file_name = os.path.split(path)
+	file_root, extension = os.path.splitext(file_name)
+	
+	format = params.pop("format", None) or image_format(path)
+	
+	# dot files in the same folder, so the rename can't cross filesystems and listings skip them
+	fd, tmp_path = temporary_file(folder, prefix="." + file_root + ".", suffix=extension)
+	try:
+		with os.fdopen(fd, "wb") as f:
+			img.save(f, format=format, **params)
+			if fsync:
+				f.flush()
+				os.fsync(f.fileno())
+		os.rename(tmp_path, path)
+	except:
+		try:
+			os.remove(tmp_path)
+		except OSError:
+			pass
+		raise
+	
+	if fsync:
+		fsync_folder(folder)
+
+def fsync_folder(folder):
+	""" Flushes a folder's entries to disk, such as a file renamed into it """
+	try:
+		fd = os.open(folder, os.O_RDONLY)
+	except OSError:
+		# folders can't be opened on Windows, where renames are already durable
+		return
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+# Thumbnails written to storage without a local path are buffered in memory up to 
+# this many bytes, and in a temporary file beyond it
+SPOOL_MAX_SIZE = 1024 * 1024
+
+def can_save(format):
+	""" Whether this PIL can write images in a format, which depends on the libraries it was built with """
+	Image.init()
+	return format in Image.SAVE
+
+def image_format(path):
+	""" The PIL format an image is saved in by its file extension """
+	Image.init()
+	return Image.EXTENSION[os.path.splitext(path)[1].lower()]
+
+def storage_path(storage, name):
+	""" Local path of a file in a storage, or None if the storage isn't on the local filesystem """
+	try:
+		return storage.path(name)
+	except NotImplementedError:
+		return None
+
+def storage_stat(storage, name):
+	""" The size and modification time of a file in a storage, as (bytes, mtime) """
+	path = storage_path(storage, name)
+	if path is not None:
+		stat = os.stat(path)
+		return stat.st_size, stat.st_mtime
+	
+	try:
+		mtime = time.mktime(storage.modified_time(name).timetuple())
+	except NotImplementedError:
+		mtime = 0.0
+	return storage.size(name), mtime
+
+@contextmanager
+def open_source(storage, name):
+	""" 
+		Gives something to open an image in a storage from: its path on the local filesystem, 
+		or failing that, the file opened through the storage, which is closed afterwards
+	"""
+	path = storage_path(storage, name)
+	if path is not None:
+		yield path
+		return
+	
+	f = storage.open(name, "rb")
+	try:
+		yield f
+	finally:
+		f.close()
+
+def save_to_storage(img, storage, name, fsync=False, **params):
+	"""
+		Saves an image to a storage. Local storages get the atomic save_image, others 
+		get the encoded image streamed from a buffer. Storages that overwrite files, 
+		such as S3 with file_overwrite, replace the old file in one go. Others pick a 
+		new name rather than overwrite, so the old file is deleted first, and readers 
+		can briefly find neither
+		
+		Returns the name the image was saved under
+	"""
+	
+	path = storage_path(storage, name)
+	if path is not None:
+		folder = os.path.dirname(path)
+		if not os.path.exists(folder):
+			try:
+				os.makedirs(folder)
+			except OSError:
+				# Handles weird race conditions if the path wasn't created just yet
+				if not os.path.exists(folder):
+					raise
+		save_image(img, path, fsync=fsync, **params)
+		return name
+	
+	format = params.pop("format", None) or image_format(name)
+	
+	buf = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+	try:
+		img.save(buf, format=format, **params)
+		buf.seek(0)
+		
+		if storage.get_available_name(name) != name:
+			storage.delete(name)
+		saved_name = storage.save(name, File(buf, name=name))
+	finally:
+		buf.close()
+	
+	if saved_name != name:
+		# the file was written again since it was deleted, and this copy would never be read
+		storage.delete(saved_name)
+		raise IOError("%s was written while it was being replaced" % name)
+	return name
 
+
+# The EXIF tags the metadata kept on images is read from
+METADATA_TAGS = (
+	"Image Orientation",
+	"Image Make",
+	"Image Model",
+	"EXIF DateTimeOriginal",
+	"EXIF ColorSpace",
+	"GPS GPSLatitude",
+	"GPS GPSLatitudeRef",
+	"GPS GPSLongitude",
+	"GPS GPSLongitudeRef",
+)
+
+def read_exif(f, tags=None):
+	""" 
+		The EXIF tags of an open image file, only those named in tags if given, reading 
+		from the start of the file. Malformed EXIF data is ignored, rather than failing uploads
+	"""
+	try:
+		f.seek(0)
+		return process_file(f, tags=tags)
+	except Exception:
+		return {}
+	finally:
+		f.seek(0)
+
+def gps_degrees(tags, name):
+	""" A GPS latitude or longitude in degrees, negative to the south and west, or None """
+	if "GPS %s" % name not in tags:
+		return None
+	
+	degrees = 0.0
+	for index, ratio in enumerate(tags["GPS %s" % name].values[:3]):
+		if not ratio.den:
+			return None
+		degrees += float(ratio.num) / ratio.den / 60 ** index
+	
+	if str(tags.get("GPS %sRef" % name, "")).strip() in ("S", "W"):
+		degrees = -degrees
+	return degrees
+
+def exif_orientation(exif_data):
+	""" The EXIF orientation, 1 to 8, in an image's EXIF tags, or None """
+	tag = exif_data.get("Image Orientation")
+	if tag and tag.values and tag.values[0] in range(1, 9):
+		return tag.values[0]
+	return None
+
+def image_metadata(f, exif_data=None):
+	""" 
+		The dimensions, EXIF orientation, capture time, camera, GPS position and color space
+		of an open image file, by the names of the Image fields they're kept in. Reads the 
+		METADATA_TAGS out of the EXIF data unless they're given, read along with others
+	"""
+	if exif_data is None:
+		exif_data = read_exif(f, METADATA_TAGS)
+	
+	f.seek(0)
+	# only reads the header
+	width, height = Image.open(f).size
+	f.seek(0)
+	
+	orientation = exif_orientation(exif_data)
+	
+	try:
+		taken = datetime.strptime(str(exif_data["EXIF DateTimeOriginal"]).strip(), "%Y:%m:%d %H:%M:%S")
+	except (KeyError, ValueError):
+		taken = None
+	if taken is not None and settings.USE_TZ:
+		# EXIF times are the camera's local time
+		try:
+			taken = timezone.make_aware(taken, timezone.get_default_timezone())
+		except InvalidTimeError:
+			# skipped or repeated when the clocks changed, so there's no telling when it was
+			taken = None
+	
+	make = str(exif_data.get("Image Make", "")).strip()
+	model = str(exif_data.get("Image Model", "")).strip()
+	camera = model if model.startswith(make) else "%s %s" % (make, model)
+	
+	return {
+		"width": width,
+		"height": height,
+		"orientation": orientation,
+		"taken": taken,
+		"camera": camera.strip().decode("ascii", "replace")[:255],
+		"latitude": gps_degrees(exif_data, "GPSLatitude"),
+		"longitude": gps_degrees(exif_data, "GPSLongitude"),
+		"color_space": str(exif_data.get("EXIF ColorSpace", "")).strip()[:20],
+	}
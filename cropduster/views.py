@@ -1,5 +1,10 @@
-import os, io
-from django.http import HttpResponse
+import os, mimetypes
+from datetime import datetime
+from wsgiref.util import FileWrapper
+from django.http import HttpResponse, StreamingHttpResponse, Http404
+from django.views.decorators.http import condition
+from django.utils.cache import patch_cache_control
+from django.utils.http import quote_etag, http_date
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.forms import TextInput
@@ -7,15 +12,20 @@ from django.views.decorators.csrf import csrf_exempt
 from django.forms import ModelForm
 from django.conf import settings
 
-from cropduster.models import Image as CropDusterImage, Crop, Size, SizeSet
-from cropduster.exif import process_file
-from cropduster.utils import aspect_ratio
+from cropduster.models import Image as CropDusterImage, Crop, Size, SizeSet, thumbnail_slug, RETINA_POSTFIX, OUTPUT_FORMATS
+from cropduster.registry import registry
+from cropduster.caching import uncached
+from cropduster.utils import aspect_ratio, read_exif, METADATA_TAGS
 
 import json
 
 
 BROWSER_WIDTH = 800
 CROPDUSTER_EXIF_DATA = getattr(settings, "CROPDUSTER_EXIF_DATA", True)
+CROPDUSTER_THUMBNAIL_MAX_AGE = getattr(settings, "CROPDUSTER_THUMBNAIL_MAX_AGE", 60 * 60 * 24)
+
+# The EXIF tags the caption and attribution are filled in from, the only ones read on upload
+EXIF_TAGS = ("Image ImageDescription", "EXIF UserComment")
 
 def get_ratio(request): 
 	return HttpResponse(json.dumps(
@@ -23,6 +33,121 @@ def get_ratio(request):
 	))
 
 
+def get_render_status(request):
+	""" Whether an image's thumbnails are pending, running, done or failed to render """
+	image_id = request.GET.get("image_id")
+	try:
+		image = CropDusterImage.objects.get(id=image_id)
+	except (CropDusterImage.DoesNotExist, ValueError):
+		raise Http404("No image %s" % image_id)
+	return HttpResponse(json.dumps({"status": image.render_status}))
+
+
+def get_thumbnail_entry(request, image_id, size_slug, descriptor=None, extension=None):
+	""" 
+	Gets the image, the manifest entry and the storage name for a thumbnail, rendering it 
+	first if it hasn't been. The entry is None if another request is rendering it and didn't 
+	finish in time. Kept on the request, since the ETag, Last-Modified and view functions all need it.
+	Storage isn't checked for thumbnails in the manifest, only when serving one fails
+	"""
+	if not hasattr(request, "_cropduster_thumbnail"):
+		try:
+			image = CropDusterImage.objects.get(id=image_id)
+		except CropDusterImage.DoesNotExist:
+			raise Http404("No image %s" % image_id)
+		
+		size = registry.get(image.size_set_id, size_slug)
+		descriptor = descriptor or ""
+		
+		# thumbnails are in the original's format, or another one the size is also saved in, 
+		# and either the size itself, its retina version or one of its responsive versions
+		if size is not None and image.extension == "." + extension:
+			extension = None
+		if (
+			size is None or (extension and extension not in size.output_formats) 
+			or (descriptor and not (descriptor == RETINA_POSTFIX and size.retina) and descriptor[1:] not in size.descriptors)
+		):
+			raise Http404("No thumbnail %s for image %s" % (thumbnail_slug(size_slug + descriptor, extension=extension), image_id))
+		
+		slug = thumbnail_slug(size.slug + descriptor, extension=extension)
+		name = image.thumbnail_name(size.slug + descriptor, extension=extension)
+		
+		entry = None
+		if image.create_thumbnail_once(size, slug):
+			# retina and responsive thumbnails aren't made when the original is too small for them
+			entry = image.thumbnail_manifest.get(slug)
+			if entry is None:
+				raise Http404("Image %s is too small for thumbnail %s" % (image_id, slug))
+		request._cropduster_thumbnail = (image, entry, name)
+	
+	return request._cropduster_thumbnail
+	
+def thumbnail_etag(request, **kwargs):
+	image, entry, name = get_thumbnail_entry(request, **kwargs)
+	return "%s-%s-%s" % (entry.fingerprint or entry.source_checksum, entry.bytes, int(entry.mtime))
+
+def thumbnail_last_modified(request, **kwargs):
+	image, entry, name = get_thumbnail_entry(request, **kwargs)
+	return datetime.utcfromtimestamp(int(entry.mtime))
+
+def rendering_response():
+	""" 503 for a thumbnail that another request is still rendering """
+	response = HttpResponse("Thumbnail is being rendered", status=503, content_type="text/plain")
+	response["Retry-After"] = 1
+	patch_cache_control(response, no_cache=True)
+	return response
+
+@condition(etag_func=thumbnail_etag, last_modified_func=thumbnail_last_modified)
+def serve_thumbnail(request, **kwargs):
+	image, entry, name = get_thumbnail_entry(request, **kwargs)
+	rendered_again = False
+	try:
+		f = image.storage.open(name, "rb")
+	except (IOError, OSError):
+		# In the manifest but gone from storage, so rendered again
+		image.thumbnails.filter(pk=entry.pk).delete()
+		del request._cropduster_thumbnail
+		image, entry, name = get_thumbnail_entry(request, **kwargs)
+		if entry is None:
+			return rendering_response()
+		f = image.storage.open(name, "rb")
+		rendered_again = True
+	
+	extension = os.path.splitext(name)[1][1:].lower()
+	if extension in OUTPUT_FORMATS:
+		# not in every host's mime types
+		content_type = OUTPUT_FORMATS[extension][1]
+	else:
+		content_type = mimetypes.guess_type(name)[0]
+	
+	# streamed from storage, and closed once sent
+	response = StreamingHttpResponse(FileWrapper(f), content_type=content_type)
+	response["Content-Length"] = entry.bytes
+	if rendered_again:
+		# rather than those of the thumbnail that was gone
+		response["ETag"] = quote_etag(thumbnail_etag(request, **kwargs))
+		response["Last-Modified"] = http_date(int(entry.mtime))
+	return response
+
+def thumbnail(request, image_id, size_slug, descriptor=None, extension=None):
+	""" 
+	Serves a thumbnail, rendering it first if it hasn't been, so that pages can link 
+	to thumbnails without waiting for them. Answers conditional requests with a 304, 
+	and lets caches such as a CDN keep thumbnails for CROPDUSTER_THUMBNAIL_MAX_AGE seconds
+	"""
+	kwargs = dict(image_id=image_id, size_slug=size_slug, descriptor=descriptor, extension=extension)
+	
+	image, entry, name = get_thumbnail_entry(request, **kwargs)
+	if entry is None:
+		# still being rendered by another request
+		return rendering_response()
+	
+	response = serve_thumbnail(request, **kwargs)
+	if response.status_code in (200, 304):
+		patch_cache_control(response, public=True, max_age=CROPDUSTER_THUMBNAIL_MAX_AGE)
+	return response
+
+
 # Create the form class.
 class ImageForm(ModelForm):
 	class Meta:
@@ -38,6 +163,7 @@ class CropForm(ModelForm):
 
 	
 @csrf_exempt
+@uncached()
 def upload(request):
 	
 	size_set = SizeSet.objects.get(id=request.GET["size_set"])
@@ -72,6 +198,7 @@ def upload(request):
 	# Get the current crop
 	try:
 		crop = Crop.objects.get(image=image.id, size=size.id)
+		crop.turn_upright()
 	except Crop.DoesNotExist:
 		crop = Crop()
 		crop.crop_w = size.width
@@ -91,13 +218,14 @@ def upload(request):
 			
 			if formset.is_valid():
 				
+				# Read the exif data once from the uploaded file, in memory or on disk,
+				# for the metadata kept on the image and the caption/attribution
+				upload = formset.cleaned_data["image"]
+				exif_data = read_exif(upload, METADATA_TAGS + (EXIF_TAGS if CROPDUSTER_EXIF_DATA else ()))
+				formset.instance.read_metadata(upload, exif_data)
+				
 				if CROPDUSTER_EXIF_DATA:
 					# Check for exif data and use it to populate caption/attribution
-					try:
-						exif_data = process_file(io.BytesIO(b"%s" % formset.cleaned_data["image"].file.getvalue()))
-					except AttributeError:
-						exif_data = {}
-						
 					if not formset.cleaned_data["caption"] and "Image ImageDescription" in exif_data:
 						formset.data["caption"] = exif_data["Image ImageDescription"].__str__()
 					if not formset.cleaned_data["attribution"] and "EXIF UserComment" in exif_data:
@@ -152,6 +280,7 @@ def upload(request):
 					if size:
 						try:
 							crop = Crop.objects.get(image=image.id, size=size.id)
+							crop.turn_upright()
 							crop_formset = CropForm(instance=crop)
 						except Crop.DoesNotExist:
 							crop = Crop()
@@ -198,7 +327,7 @@ def upload(request):
 			"formset": formset,
 			"image": image,
 			"image_element_id" : request.GET["image_element_id"],
-			"image_exists": image.image and os.path.exists(image.image.path),
+			"image_exists": image.image and image.storage.exists(image.image.name),
 			"min_w"  : size.width,
 			"min_h"  : size.height,
 			"static_url": settings.STATIC_URL,
@@ -216,6 +345,7 @@ def upload(request):
 		context = {
 			"image": image,
 			"image_thumbs": image_thumbs,
+			"render_status": image.render_status,
 			"image_element_id" : request.GET["image_element_id"],
 			"static_url": settings.STATIC_URL,
 		}